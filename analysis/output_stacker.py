@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import os
-import json
 import awkward as ak
 import numpy as np
 import argparse
 import hist
+from tamalero.event_io import read_events, write_events, find_events_file
 
 if __name__ == '__main__':
 
@@ -15,6 +15,7 @@ if __name__ == '__main__':
     argParser.add_argument("--rb", action='store', type=int, default=0, help="RB to run")
     argParser.add_argument("--specific_runs", action='store', nargs="+", help="List of specific runs to stack, formated xxx yyy zzz. Can handle an arbitrary number of runs, user is recommened not to use more than a few")
     argParser.add_argument("--module", action='store', default='37', help="Module number for the runs")
+    argParser.add_argument("--format", action='store', default='parquet', choices=['parquet', 'json'], help="Output format of the stacked events")
     args = argParser.parse_args()
 
 here = os.path.dirname(os.path.abspath(__file__))
@@ -28,14 +29,12 @@ fail_list=[]
 #TODO: reconfigure to work with glob for better flexibility in names
 if args.specific_runs:
     for run in args.specific_runs:
-        with open("{}/../ETROC_output/output_run_{}_rb{}.json".format(here, run, args.rb), "r") as f:
-            files_to_stack.append(ak.from_json(json.load(f)))
+        files_to_stack.append(read_events(find_events_file("{}/../ETROC_output/output_run_{}_rb{}".format(here, run, args.rb))))
         print("Run {} contains {} events".format(run,len(files_to_stack[-1])))
 else:
     for run in range(args.first_run, args.last_run+1):
         try:
-            with open("{}/../ETROC_output/output_run_{}_rb{}.json".format(here, run, args.rb), "r") as f:
-                files_to_stack.append(ak.from_json(json.load(f)))
+            files_to_stack.append(read_events(find_events_file("{}/../ETROC_output/output_run_{}_rb{}".format(here, run, args.rb))))
             print("Run {} contains {} events".format(run,len(files_to_stack[-1])))
         except:
             print("Run {} failed to be added to the stack, will continue without it".format(run))
@@ -50,12 +49,10 @@ if args.specific_runs:
     for run in args.specific_runs:
         specific_name+=(str(run)+"_")
     specific_name+="stacked"
-    with open(specific_name+".json", "w") as f:
-            json.dump(ak.to_json(stacked), f)
+    write_events(stacked, specific_name+"."+args.format)
 else:
     stacked_name="{}/../ETROC_output/module_{}_output_run_{}_to_{}_stacked".format(here, args.module, args.first_run,args.last_run)+fail_string
-    with open(stacked_name+".json", "w") as f:
-            json.dump(ak.to_json(stacked), f)
+    write_events(stacked, stacked_name+"."+args.format)
 
 # make some plots
 import matplotlib.pyplot as plt
@@ -20,12 +20,17 @@ if __name__ == '__main__':
             eye_data = json.load(openfile)
         print("Plotting %s..." %args.filename)
     else:
-        list_of_files = glob.glob('eye_scan_results/*')
+        list_of_files = glob.glob('eye_scan_results/*.json')
         latest_file = max(list_of_files, key=os.path.getctime)
         with open(latest_file, 'r') as openfile:
             eye_data = json.load(openfile)
         print("Plotting %s..." %latest_file)
 
+    if isinstance(eye_data, dict):
+        # raw counter values, normalize them
+        counts = np.array(eye_data['counts'])
+        eye_data = 100*(counts.max() - counts)/max(counts.max() - counts.min(), 1)
+
     (fig, axs) = plt.subplots(1, 1, figsize=(10, 8))
     print ("fig type = " + str(type(fig)))
     print ("axs type = " + str(type(axs)))
@@ -2,6 +2,7 @@ from tamalero.ETROC import ETROC
 from tamalero.utils import get_kcu
 from tamalero.colors import green, red, yellow
 from tamalero.ReadoutBoard import ReadoutBoard
+from tamalero.Calibration import calibrate_thresholds
 import time
 import numpy as np
 from pathlib import Path
@@ -149,45 +150,11 @@ def calibrate_baselines(etroc_chips):
     """Calibrate baseline for all pixels"""
     print(f"\n2. Calibrating 256 pixel baselines...")
     
-    baseline_storage = {}
-    etroc_configs = []
-    failed_pixels = {}
-    
-    all_pixels = [(row, col) for row in range(16) for col in range(16)]
-
-    for i, etroc, in enumerate(etroc_chips):
-
-        chip_name = ETROC_NAMES[i]
-        baseline_storage[chip_name] = {
-            'row': [], 'col': [], 'baseline': [],
-            'noise_width': [], 'timestamp': []
-        }
-        
-        for pixel_row, pixel_col in tqdm(all_pixels, desc = f"{chip_name} pixels"):
-
-            baseline, noise_width = 0, 0  # Default values for failure case
-            
-            try:
-                baseline, noise_width = etroc.auto_threshold_scan(
-                    row=pixel_row,
-                    col=pixel_col,
-                    broadcast=False,
-                    offset='auto',
-                    use=False,
-                    verbose=True
-                )
-            
-                time.sleep(0.03)
-            
-            except Exception as e:
-                print(red(f"  Pixel ({pixel_row},{pixel_col}): SCAN FAILED - {e}"))
-
-            # 4. Append data for EVERY pixel (values are None on failure)
-            baseline_storage[chip_name]['row'].append(pixel_row)
-            baseline_storage[chip_name]['col'].append(pixel_col)
-            baseline_storage[chip_name]['baseline'].append(baseline)
-            baseline_storage[chip_name]['noise_width'].append(noise_width)
-            baseline_storage[chip_name]['timestamp'].append(datetime.now().isoformat(sep=' '))
+    # chips on different I2C masters are calibrated in parallel
+    etrocs = {ETROC_NAMES[i]: etroc for i, etroc in enumerate(etroc_chips) if etroc is not None}
+    result = calibrate_thresholds(etrocs, offset='auto', use=False, verbose=True, delay=0.03)
+    result.summary()
+    baseline_storage = result.storage()
 
     for key, val in baseline_storage.items():
         bl_nw_df = convert_dict_to_pandas(val, key)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the software side of the DAQ chain, without any hardware.
+A synthetic FIFO stream is generated with the ETROC2 emulator, and every processing
+stage is timed separately. Results are written as json, e.g. to compare tags.
+
+Run from the repository root:
+    python3 -m benchmarks.daq_benchmark --n_l1a 100000 --occupancy 0.01 --output benchmark.json
+"""
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import awkward as ak
+
+from tamalero.DataFrame import DataFrame
+from tamalero.RawReader import RawReader
+from tamalero.event_io import write_events, read_events
+from data_dumper import merge_words, EventBuilder
+from benchmarks.synthetic_stream import synthetic_stream
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def get_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--tags', '--always', '--dirty'],
+            cwd=here, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+def get_environment():
+    env = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'awkward': ak.__version__,
+    }
+    for module in ['pyarrow', 'uproot']:
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            env[module] = None
+    return env
+
+class Benchmark:
+
+    def __init__(self, repeat=3, verbose=True):
+        '''
+        repeat - number of times every stage is run, the minimum time is reported
+        '''
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+
+    def run(self, name, func, n_words=None, n_events=None, repeat=None):
+        '''
+        Time func, and store the result under name. Returns the output of the last call of func.
+        '''
+        times = []
+        for i in range(repeat if repeat is not None else self.repeat):
+            start = time.perf_counter()
+            res = func()
+            times.append(time.perf_counter() - start)
+        result = {'time': min(times), 'times': times}
+        if n_words is not None:
+            result['n_words'] = n_words
+            result['words_per_s'] = n_words / min(times)
+        if n_events is not None:
+            result['n_events'] = n_events
+            result['events_per_s'] = n_events / min(times)
+        self.results[name] = result
+        if self.verbose:
+            rate = f", {result['events_per_s']:.3g} events/s" if n_events else f", {result['words_per_s']:.3g} words/s" if n_words else ""
+            print(f"{name:<24} {min(times):9.4f} s{rate}")
+        return res
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        if self.verbose:
+            print(f"{name:<24} skipped ({reason})")
+
+def run_benchmarks(n_l1a=10000, occupancy=0.01, n_etrocs=1, n_template=1000, repeat=3, n_python=None, tmp_dir=None, seed=1):
+    '''
+    n_l1a - number of L1As in the synthetic stream
+    occupancy - fraction of pixels with a hit per L1A
+    n_etrocs - number of ETROCs that are read out per L1A
+    n_template - number of L1As that are actually run on the emulator, the rest are copies
+    n_python - number of words used for the per-word (pure python) stages, default is all
+    tmp_dir - directory for the files that are written, default is a temporary directory
+    '''
+    bench = Benchmark(repeat=repeat)
+    config = {
+        'n_l1a': n_l1a,
+        'occupancy': occupancy,
+        'n_etrocs': n_etrocs,
+        'n_template': n_template,
+        'repeat': repeat,
+        'seed': seed,
+    }
+
+    fifo = bench.run('generate', lambda: synthetic_stream(n_l1a, occupancy=occupancy, n_etrocs=n_etrocs, n_template=n_template, seed=seed), repeat=1)
+    n_fifo = len(fifo)
+    config['n_fifo_words'] = n_fifo
+
+    clean_tmp = tmp_dir is None
+    tmp_dir = tempfile.mkdtemp() if tmp_dir is None else tmp_dir
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        f_raw = os.path.join(tmp_dir, 'output_run_0_rb0.dat')
+        fifo.tofile(f_raw)
+
+        # merging of the 32 bit FIFO words
+        fifo_list = fifo.tolist()
+        words = np.array(bench.run('merge_words', lambda: merge_words(fifo_list), n_words=n_fifo), dtype=np.uint64)
+        reader = RawReader(f_raw)
+        bench.run('raw_reader', lambda: np.concatenate(list(reader.chunks())), n_words=n_fifo)
+        n_words = len(words)
+
+        # decoding
+        n_python = n_words if n_python is None else min(n_python, n_words)
+        words_python = words[:n_python].tolist()
+        df = DataFrame('ETROC2')
+        bench.run('dataframe_read', lambda: [df.read(w) for w in words_python], n_words=n_python)
+        bench.run('dataframe_read_many', lambda: df.read_many(words), n_words=n_words)
+
+        # event building
+        def build():
+            builder = EventBuilder(DataFrame('ETROC2'), skip_trigger_check=False)
+            for chunk in reader.chunks():
+                builder.process(chunk)
+            return builder.events()
+        events = bench.run('event_builder', build, n_words=n_words, n_events=n_l1a)
+        n_events = len(events)
+        config['n_events'] = n_events
+        config['n_hits'] = int(ak.sum(events.nhits))
+
+        # output and loading
+        f_json = os.path.join(tmp_dir, 'output_run_0_rb0.json')
+        bench.run('write_json', lambda: write_events(events, f_json), n_events=n_events)
+        bench.run('read_json', lambda: read_events(f_json), n_events=n_events)
+        config['size_json'] = os.path.getsize(f_json)
+
+        try:
+            import pyarrow
+            f_parquet = os.path.join(tmp_dir, 'output_run_0_rb0.parquet')
+            bench.run('write_parquet', lambda: write_events(events, f_parquet), n_events=n_events)
+            bench.run('read_parquet', lambda: read_events(f_parquet), n_events=n_events)
+            config['size_parquet'] = os.path.getsize(f_parquet)
+        except ImportError:
+            bench.skip('write_parquet', 'pyarrow not installed')
+            bench.skip('read_parquet', 'pyarrow not installed')
+
+        try:
+            from root_dumper import dump_to_root
+            f_root = os.path.join(tmp_dir, 'output_run_0_rb0.root')
+            bench.run('write_root', lambda: dump_to_root(f_root, events), n_events=n_events)
+            config['size_root'] = os.path.getsize(f_root)
+        except ImportError:
+            bench.skip('write_root', 'uproot not installed')
+
+        # what the analysis scripts do after loading
+        def analysis():
+            ev = read_events(f_json)
+            with np.errstate(divide='ignore'):
+                ev['bin'] = 3.125 / ev.cal_code
+                ev['toa'] = 12.5 - ev.bin * ev.toa_code
+            hits = np.zeros([16, 16])
+            np.add.at(hits, (ak.to_numpy(ak.flatten(ev.row)), ak.to_numpy(ak.flatten(ev.col))), 1)
+            return hits
+        bench.run('analysis_loader', analysis, n_events=n_events)
+    finally:
+        if clean_tmp:
+            shutil.rmtree(tmp_dir)
+
+    return {
+        'config': config,
+        'environment': get_environment(),
+        'time': time.time(),
+        'stages': bench.results,
+    }
+
+if __name__ == '__main__':
+
+    argParser = argparse.ArgumentParser(description = "Argument parser")
+    argParser.add_argument('--n_l1a', action='store', default=10000, type=int, help="Number of L1As")
+    argParser.add_argument('--occupancy', action='store', default=0.01, type=float, help="Fraction of pixels with a hit per L1A")
+    argParser.add_argument('--n_etrocs', action='store', default=1, type=int, help="Number of ETROCs read out per L1A")
+    argParser.add_argument('--n_template', action='store', default=1000, type=int, help="Number of L1As run on the emulator, the rest are copies")
+    argParser.add_argument('--n_python', action='store', default=None, type=int, help="Number of words for the per-word python decoder")
+    argParser.add_argument('--repeat', action='store', default=3, type=int, help="Number of repetitions per stage")
+    argParser.add_argument('--seed', action='store', default=1, type=int, help="Random seed")
+    argParser.add_argument('--tmp_dir', action='store', default=None, help="Keep the written files in this directory")
+    argParser.add_argument('--output', action='store', default=None, help="Output json file, printed to stdout if not given")
+    args = argParser.parse_args()
+
+    res = run_benchmarks(
+        n_l1a=args.n_l1a,
+        occupancy=args.occupancy,
+        n_etrocs=args.n_etrocs,
+        n_template=args.n_template,
+        repeat=args.repeat,
+        n_python=args.n_python,
+        tmp_dir=args.tmp_dir,
+        seed=args.seed,
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        print(json.dumps(res, indent=2))
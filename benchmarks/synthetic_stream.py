@@ -0,0 +1,89 @@
+"""
+Synthetic FIFO streams from the software ETROC2 emulator, in the same layout as the
+raw DAQ output: every 40 bit ETROC word (plus the elink meta data from bit 40 on)
+is split into two 32 bit FIFO words, lower half first.
+"""
+import numpy as np
+from statistics import NormalDist
+from tamalero.ETROC_Emulator import ETROC2_Emulator
+from tamalero.DataFrame import DataFrame
+
+def make_emulators(n_etrocs=1, occupancy=0.01, seed=None):
+    '''
+    n_etrocs - number of emulated ETROCs, read out on elinks 0, 1, ...
+    occupancy - fraction of pixels with a hit per L1A
+    '''
+    if seed is not None:
+        np.random.seed(seed)
+    emulators = []
+    for i in range(n_etrocs):
+        em = ETROC2_Emulator(chipid=(i+1)<<2, elink=i)
+        # flat baseline and noise, so that the occupancy is the same for all pixels
+        em.bl_means = [[700.]*16 for y in range(16)]
+        em.bl_stdevs = [[1.]*16 for y in range(16)]
+        em.set_Vth_mV(700 + NormalDist().inv_cdf(1 - min(max(occupancy, 1e-6), 1 - 1e-6)))
+        emulators.append(em)
+    return emulators
+
+def make_events(emulators, n_l1a, bcid_step=(200, 3000), seed=None):
+    '''
+    Run n_l1a L1As on all emulators and return the merged 64 bit words.
+    The BCID of consecutive L1As differs by a random step in bcid_step,
+    which keeps the double trigger check of the event builder quiet.
+    '''
+    rng = np.random.default_rng(seed)
+    words = []
+    bcid = 0
+    for i in range(n_l1a):
+        bcid = (bcid + int(rng.integers(*bcid_step))) % 3564
+        for em in emulators:
+            em.data['bcid'] = bcid
+            words += [w | (em.elink << 40) for w in em.run(1)]
+    return np.array(words, dtype=np.uint64)
+
+def restamp(words, n_l1a, emulators_per_l1a, bcid_step=(200, 3000), seed=None):
+    '''
+    Build a stream of n_l1a L1As from a smaller template stream by repeating it
+    and assigning new L1A counters and BCIDs to the headers of the copies.
+    Trailer CRCs are not recomputed.
+    '''
+    data_format = DataFrame('ETROC2').format
+    header = data_format['data']['header']
+    identifier = data_format['identifiers']['header']
+    rng = np.random.default_rng(seed)
+
+    is_header = (words & np.uint64(identifier['mask'])) == np.uint64(identifier['frame'])
+    n_template = int(is_header.sum()) // emulators_per_l1a
+    reps = -(-n_l1a // n_template)
+    stream = np.tile(words, reps)
+    headers = np.flatnonzero(np.tile(is_header, reps))
+    n_headers = n_l1a*emulators_per_l1a
+    if len(headers) > n_headers:
+        # cut the stream right before the first header of L1A number n_l1a
+        stream = stream[:headers[n_headers]]
+        headers = headers[:n_headers]
+
+    l1a = np.arange(n_l1a).repeat(emulators_per_l1a).astype(np.uint64)
+    bcid = (np.cumsum(rng.integers(*bcid_step, size=n_l1a)) % 3564).repeat(emulators_per_l1a).astype(np.uint64)
+    l1a_mask, bcid_mask = np.uint64(header['l1counter']['mask']), np.uint64(header['bcid']['mask'])
+    stream[headers] = (stream[headers] & ~(l1a_mask | bcid_mask)) \
+        | ((l1a << np.uint64(header['l1counter']['shift'])) & l1a_mask) \
+        | ((bcid << np.uint64(header['bcid']['shift'])) & bcid_mask)
+    return stream
+
+def to_fifo(words):
+    '''
+    Split merged 64 bit words into the pairs of 32 bit words that are read from the FIFO
+    '''
+    return np.ascontiguousarray(words, dtype='<u8').view('<u4')
+
+def synthetic_stream(n_l1a=10000, occupancy=0.01, n_etrocs=1, n_template=1000, seed=1):
+    '''
+    Return the 32 bit FIFO words for n_l1a L1As.
+    At most n_template L1As are run on the emulator, the rest are copies with new L1A counters and BCIDs.
+    '''
+    emulators = make_emulators(n_etrocs=n_etrocs, occupancy=occupancy, seed=seed)
+    words = make_events(emulators, min(n_l1a, n_template), seed=seed)
+    if n_l1a > n_template:
+        words = restamp(words, n_l1a, n_etrocs, seed=seed)
+    return to_fifo(words)
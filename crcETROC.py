@@ -3,6 +3,7 @@ import struct
 import numpy as np
 import awkward as ak
 from tamalero.DataFrame import DataFrame
+from tamalero.RawReader import RawReader
 
 # DISCLAIMER
 # This is still work in progress, when finalized it should be included in the 
@@ -63,25 +64,26 @@ if __name__ == '__main__':
 
     df = DataFrame('ETROC2')
 
-    with open(args.input, 'rb') as f:
-        bin_data = f.read()
-        raw_data = struct.unpack('<{}I'.format(int(len(bin_data)/4)), bin_data)
-
-    merged_data = merge_words(raw_data)
     #handy functions
     etrocmask = np.vectorize(lambda x : x & 0xFFFFFFFFFF) #mask 64 bits words to 40bits
     hexstr5=np.vectorize(lambda x: f'{x:05x}') #40bits 5 hex
     binstr40=np.vectorize(lambda x: f'{x:040b}') #40bits
-    words = ak.Array(hexstr5(etrocmask(merged_data)))
-    bitwords = ak.Array(binstr40(etrocmask(merged_data)))
-    #FIXME vectorize this abomination
-    header_idx=[]
-    for i,word in enumerate(words):
-        if '3c5c' in word: header_idx.append(i)
-    header_idx.append(len(words))
-    dataframes = ak.unflatten(words,np.diff(header_idx))
-    bitframes = ak.unflatten(bitwords,np.diff(header_idx))
-    
-    merged_frames = ["".join(x) for x in bitframes]
     poly = '100101111'
-    crc_checks = np.array([mod2div(frame,poly) for frame in merged_frames])
+    crc_checks = []
+    # chunks end at event boundaries, so every frame is checked within one chunk
+    for merged_data in RawReader(args.input).chunks():
+        words = ak.Array(hexstr5(etrocmask(merged_data)))
+        bitwords = ak.Array(binstr40(etrocmask(merged_data)))
+        #FIXME vectorize this abomination
+        header_idx=[]
+        for i,word in enumerate(words):
+            if '3c5c' in word: header_idx.append(i)
+        if not header_idx:
+            continue
+        header_idx.append(len(words))
+        dataframes = ak.unflatten(words[header_idx[0]:],np.diff(header_idx))
+        bitframes = ak.unflatten(bitwords[header_idx[0]:],np.diff(header_idx))
+
+        merged_frames = ["".join(x) for x in bitframes]
+        crc_checks += [mod2div(frame,poly) for frame in merged_frames]
+    crc_checks = np.array(crc_checks)
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 import struct
 import os
-import uhal
+try:
+    import uhal
+    from uhal._core import exception as uhal_exception
+except ModuleNotFoundError:
+    # only the software stand-in works without uhal, see tamalero.KCU
+    uhal = None
+    from tamalero.SoftIPbus import exception as uhal_exception
 import argparse
 import time
+import queue
 from tamalero.utils import get_kcu
+from tamalero.StreamWriter import StreamWriter
+from tamalero.FIFO import blocks_per_dispatch, queue_block_reads
 from yaml import load, dump
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -28,9 +37,12 @@ class MultiThread:
             time.sleep(sleep)
 
     def run_limited(self, iterations=1):
-        for it in range(iterations):
-            self.fun(**self.args)
-        self._running = False
+        try:
+            for it in range(iterations):
+                self.fun(**self.args)
+        finally:
+            # also clear the flag if fun fails, otherwise the main loop waits forever
+            self._running = False
 
 def stream_daq_multi(fun, args):
     from threading import Thread
@@ -56,13 +68,19 @@ def get_occupancy(hw, rb):
         occupancy = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY").read()
         hw.dispatch()
         occ = occupancy.value()
-    except uhal._core.exception:
+    except uhal_exception:
         print("uhal UPDP error when trying to get occupancy. Returning 0.")
         occ = 0
     return occ * 4  # not sure where the factor of 4 comes from, but it's needed
 
-def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superblock=100, block=128, run=1, ext_l1a=False, lock=None, verbose=False):
-    uhal.disableLogging()
+def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superblock=100, block=128, run=1, ext_l1a=False, lock=None, verbose=False, stream=False, rotate_size=None, rotate_time=None, fsync=None, start_event=None, stop_event=None):
+    '''
+    stream - hand every block to a writer thread instead of keeping the full run in memory.
+             rotate_size (bytes), rotate_time (s) and fsync are passed to tamalero.StreamWriter
+    start_event, stop_event - events set by a run coordinator, take precedence over lock and run_time
+    '''
+    if uhal is not None:
+        uhal.disableLogging()
     hw = kcu.hw
     rate_setting = l1a_rate / 25E-9 / (0xffffffff) * 10000
 
@@ -98,8 +116,43 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
     #f_out = f"output/output_rb_{rb}_run_{run}_time_{start}.dat"  # USED TO BE THIS, keeping for reference and debugging
     occupancy_block = []
     reads = []
-    with open(f_out, mode="wb") as f:
-        if lock is not None:
+    max_payload_size = kcu.get_max_payload_size()
+    if stream:
+        writer = StreamWriter(f_out, rotate_size=rotate_size, rotate_time=rotate_time, fsync=fsync)  # started by the with statement below
+        store = writer.put
+    else:
+        store = reads.append
+    with open(f_out, mode="wb") if not stream else writer as f:
+        def read_blocks(occupancy):
+            num_blocks_to_read = blocks_per_dispatch(occupancy, block=block, max_payload_size=max_payload_size)
+            occupancy_block.append(num_blocks_to_read)
+
+            # read the blocks together with the occupancy for the next iteration, in a single dispatch
+            # slow control (e.g. monitoring) only gets the link in between these reads, see KCU.LinkArbiter
+            try:
+                with kcu.arbiter.daq():
+                    reads_tmp, next_occupancy = queue_block_reads(hw, rb, num_blocks_to_read, block=block)
+                    hw.dispatch()
+                for read in reads_tmp:
+                    store(read)
+                next_occupancy = next_occupancy.value() * 4  # same factor of 4 as in get_occupancy
+                kcu.arbiter.set_backlog(next_occupancy // block > blocks_per_dispatch(next_occupancy, block=block, max_payload_size=max_payload_size), key=rb)
+                return next_occupancy
+            except uhal_exception:
+                print("uhal UDP error in reading FIFO")
+                with kcu.arbiter.daq():
+                    return get_occupancy(hw, rb)
+
+        if stop_event is not None:
+            # Run coordinator based DAQ, see run_coordinator
+            print(f"Waiting for the start command for rb {rb}.")
+            start_event.wait()
+            print("Start data taking")
+            occupancy = get_occupancy(hw, rb)
+            while not stop_event.is_set():
+                occupancy = read_blocks(occupancy)
+
+        elif lock is not None:
             # External lock file based DAQ
             iteration = 0
             Running = get_kcu_flag(lock=lock)
@@ -111,43 +164,18 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
 
             print("Start data taking")
             Running = get_kcu_flag(lock=lock)
+            occupancy = get_occupancy(hw, rb)
             while (Running.lower() != "false" and Running.lower() != "stop"):
                 Running = get_kcu_flag(lock=lock)
-                num_blocks_to_read = 0
-                occupancy = get_occupancy(hw, rb)
-                num_blocks_to_read = occupancy // block
-                occupancy_block.append(num_blocks_to_read)
-
-                # read the blocks
-                if (num_blocks_to_read)>0:
-                    try:
-                        for x in range(num_blocks_to_read):
-                            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                            hw.dispatch()  # NOTE this is necessary
-                    except uhal._core.exception:
-                        print("uhal UDP error in reading FIFO")
+                occupancy = read_blocks(occupancy)
 
         else:
+            occupancy = get_occupancy(hw, rb)
             while (start + run_time > time.time()):
                 # Time based DAQ
-                # We read the data into memory (small)
-                # and write to disk once we're done
-                num_blocks_to_read = 0
-                occupancy = get_occupancy(hw, rb)
-                num_blocks_to_read = occupancy // block
-                occupancy_block.append(num_blocks_to_read)
-
-                # read the blocks
-                if (num_blocks_to_read)>0:
-                    #if num_blocks_to_read>1 and verbose:
-                    #    print(occupancy, num_blocks_to_read)
-                    try:
-                        for x in range(num_blocks_to_read):
-                            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                            hw.dispatch()  # NOTE this is necessary
-                    except uhal._core.exception:
-                        print("uhal UDP error in reading FIFO")
+                occupancy = read_blocks(occupancy)
 
+        kcu.arbiter.set_backlog(False, key=rb)
         print("Resetting L1A rate back to 0")
         hw.getNode("SYSTEM.L1A_RATE").write(0)
         hw.dispatch()
@@ -156,17 +184,14 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
         # Read data that might still be in the FIFO
         occupancy = get_occupancy(hw, rb)
         print(f"Occupancy before last read: {occupancy}")
-        num_blocks_to_read = occupancy // block
-        remainder = occupancy % block
-        if (num_blocks_to_read)>0:
-            for x in range(num_blocks_to_read):
-                reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                hw.dispatch()
-            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(remainder)]
-        else:
-            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(occupancy)]
-
-        hw.dispatch()
+        while occupancy > 0:
+            num_blocks_to_read = blocks_per_dispatch(occupancy, block=block, max_payload_size=max_payload_size)
+            remainder = occupancy % block if num_blocks_to_read == occupancy // block else 0
+            reads_tmp, _ = queue_block_reads(hw, rb, num_blocks_to_read, block=block, last_block=remainder)
+            hw.dispatch()
+            for read in reads_tmp:
+                store(read)
+            occupancy -= num_blocks_to_read*block + remainder
         for i, read in enumerate(reads):
             data+= read.value()
 
@@ -192,8 +217,14 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
                 for read in reads:
                     data += read.value()
             occupancy = get_occupancy(hw, rb)
+        if stream:
+            writer.put(data)
+            data = []
 
         len_data += len(data)
+        if stream:
+            writer.close()
+            len_data = writer.n_words
 
         # Get some stats
         timediff = time.time() - start
@@ -218,7 +249,8 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
         print("Speed = %f Mbps" % speed)
 
         # Actually write to disk
-        f.write(struct.pack('<{}I'.format(len(data)), *data))
+        if not stream:
+            f.write(struct.pack('<{}I'.format(len(data)), *data))
 
     hw.getClient().write(hw.getNode(f"READOUT_BOARD_{rb}.FIFO_RESET").getAddress(), 0x1)
     hw.dispatch()
@@ -244,6 +276,153 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
 
     return f_out
 
+def start_monitor(kcu, rb, run, config='default', probes=None):
+    '''
+    Sample the environmental probes of readout board rb with tamalero.Sampler, in the gaps between the DAQ reads.
+    The sampler has to run in the same process as stream_daq, the link arbiter of the KCU does not reach other processes.
+    config - readout board configuration
+    probes - yaml file with a list of probes, tamalero.Sampler.default_probes if None
+    Samples are stored in ETROC_output/monitor_run_{run}_rb{rb}.dat, stop the sampler with Sampler.stop.
+    Returns None if the monitoring could not be started, data taking goes ahead without it.
+    '''
+    from tamalero.ReadoutBoard import ReadoutBoard
+    from tamalero.Sampler import rb_sampler, default_probes
+    try:
+        if probes is not None:
+            with open(probes, 'r') as f:
+                probes = load(f, Loader=Loader)
+        readout_board = ReadoutBoard(rb, trigger=False, kcu=kcu, config=config, poke=True)
+        return rb_sampler(
+            readout_board,
+            probes = default_probes if probes is None else probes,
+            f_out = f"ETROC_output/monitor_run_{run}_rb{rb}.dat",
+        )
+    except Exception as e:
+        print(f"Could not start the monitoring of rb {rb}, continuing without it: {e!r}")
+        return None
+
+def stream_daq_process(kcu_address, rb, status, start_event, stop_event, host='localhost', daq_args={}, monitor=None):
+    '''
+    Worker for the process per readout board DAQ.
+    Opens its own controlhub connection, and reports back to the run coordinator through status.
+    monitor - None, or keyword arguments of start_monitor to sample the environmental probes during the run
+    '''
+    sampler = None
+    try:
+        kcu = get_kcu(kcu_address, control_hub=True, host=host, quiet=True)
+        if monitor is not None:
+            sampler = start_monitor(kcu, rb, daq_args.get('run', 1), **monitor)
+        status.put(('ready', rb, None))
+        f_out = stream_daq(kcu=kcu, rb=rb, start_event=start_event, stop_event=stop_event, **daq_args)
+        status.put(('done', rb, f_out))
+    except Exception as e:
+        status.put(('error', rb, repr(e)))
+    finally:
+        if sampler is not None:
+            sampler.stop()
+
+def merge_logs(run, rbs):
+    '''
+    Merge the per readout board yaml logs of a run into ETROC_output/log_run_{run}.yaml
+    '''
+    merged = {'rbs': {}}
+    for rb in rbs:
+        log_in = f"ETROC_output/log_run_{run}_rb{rb}.yaml"
+        if not os.path.isfile(log_in):
+            print(f"Could not find log file {log_in}")
+            continue
+        with open(log_in, 'r') as f:
+            merged['rbs'][rb] = load(f, Loader=Loader)
+    if merged['rbs']:
+        merged['start_time'] = min(log['start_time'] for log in merged['rbs'].values())
+        merged['stop_time'] = max(log['stop_time'] for log in merged['rbs'].values())
+        merged['nevents'] = sum(log['nevents'] for log in merged['rbs'].values())
+    log_out = f"ETROC_output/log_run_{run}.yaml"
+    with open(log_out, 'w') as f:
+        dump(merged, f)
+    return log_out
+
+def get_status(status, processes, rbs, done, errors, timeout=1):
+    '''
+    Wait for the next status message of the DAQ workers of run_coordinator.
+    Workers that died without reporting (e.g. segfault or kill) are added to errors.
+    done - rbs that have already reported
+    Returns (msg, rb, res), msg is None if nothing arrived within timeout.
+    '''
+    # only workers that were already dead before waiting are declared lost,
+    # anything they put on the queue before exiting arrives within the timeout
+    dead = [(rb, p) for rb, p in zip(rbs, processes) if not p.is_alive()]
+    try:
+        return status.get(timeout=timeout)
+    except queue.Empty:
+        for rb, p in dead:
+            if rb not in done and rb not in errors:
+                print(f"DAQ process for rb {rb} died with exit code {p.exitcode}")
+                errors[rb] = f"exit code {p.exitcode}"
+        return None, None, None
+
+def run_coordinator(kcu_address, rbs, run=1, run_time=10, lock=None, host='localhost', daq_args={}, monitor=None):
+    '''
+    Start one DAQ process per readout board, each with its own IPbus client,
+    and control start and stop of the run either through the lock file or run_time.
+    monitor - None, or keyword arguments of start_monitor. Every DAQ process runs the sampler of its readout board.
+    '''
+    import multiprocessing as mp
+    status = mp.Queue()
+    start_event = mp.Event()
+    stop_event = mp.Event()
+    processes = []
+    for rb in rbs:
+        p = mp.Process(
+            target = stream_daq_process,
+            args = (kcu_address, rb, status, start_event, stop_event),
+            kwargs = {'host': host, 'daq_args': dict(daq_args, run=run), 'monitor': monitor},
+        )
+        p.start()
+        processes.append(p)
+
+    # wait for all workers to be connected
+    ready = []
+    files = {}
+    errors = {}
+    while len(ready) + len(errors) < len(rbs):
+        msg, rb, res = get_status(status, processes, rbs, ready, errors)
+        if msg == 'ready':
+            ready.append(rb)
+        elif msg == 'error':
+            print(f"DAQ process for rb {rb} failed: {res}")
+            errors[rb] = res
+    print(f"DAQ processes for rbs {ready} are ready")
+
+    if lock is not None:
+        iteration = 0
+        while get_kcu_flag(lock=lock).lower() in ["false", "stop"]:
+            if iteration == 0:
+                print("Waiting for the start command.")
+            iteration += 1
+            time.sleep(0.01)
+        start_event.set()
+        while get_kcu_flag(lock=lock).lower() not in ["false", "stop"]:
+            time.sleep(0.01)
+    else:
+        start_event.set()
+        time.sleep(run_time)
+    stop_event.set()
+
+    while len(files) + len(errors) < len(rbs):
+        msg, rb, res = get_status(status, processes, rbs, files, errors)
+        if msg == 'done':
+            files[rb] = res
+        elif msg == 'error':
+            print(f"DAQ process for rb {rb} failed: {res}")
+            errors[rb] = res
+    for p in processes:
+        p.join()
+
+    log_out = merge_logs(run, sorted(files))
+    print(f"Merged logs stored in {log_out}")
+    return files
+
 if __name__ == '__main__':
     argParser = argparse.ArgumentParser(description = "Argument parser")
     argParser.add_argument('--kcu', action='store', default='192.168.0.10', help="KCU address")
@@ -254,13 +433,50 @@ if __name__ == '__main__':
     argParser.add_argument('--n_events', action='store', default=1000, type=int, help="N events")
     argParser.add_argument('--lock', action='store', default=None, help="Lock file for the scope acquisition status (relative or absolute path)")
     argParser.add_argument('--run', action='store', default=1, type=int, help="Run number")
+    argParser.add_argument('--stream', action='store_true', help="Stream data to disk while taking data, keeping memory use flat")
+    argParser.add_argument('--rotate_size', action='store', default=None, type=float, help="Start a new output file after this size in MB (only with --stream)")
+    argParser.add_argument('--rotate_time', action='store', default=None, type=float, help="Start a new output file after this time in s (only with --stream)")
+    argParser.add_argument('--fsync', action='store', default=None, help="fsync policy: close, always, or an interval in s (only with --stream)")
+    argParser.add_argument('--processes', action='store_true', help="Run one DAQ process per RB, each with its own controlhub connection")
+    argParser.add_argument('--host', action='store', default='localhost', help="Controlhub host (only with --processes)")
+    argParser.add_argument('--monitor', action='store_true', help="Sample the environmental probes of the RBs in the gaps between DAQ reads")
+    argParser.add_argument('--monitor_probes', action='store', default=None, help="yaml file with the list of probes (only with --monitor)")
+    argParser.add_argument('--configuration', action='store', default='default', help="RB configuration (only with --monitor)")
     args = argParser.parse_args()
 
+    monitor = {'config': args.configuration, 'probes': args.monitor_probes} if args.monitor else None
+
+    fsync = args.fsync
+    if fsync is not None and fsync not in ['close', 'always']:
+        fsync = float(fsync)
+
     start_time = time.time()
 
-    kcu = get_kcu(args.kcu)
+    rbs = [int(x) for x in str(args.rb).split(',')]
+
+    if args.processes:
+        run_coordinator(
+            args.kcu,
+            rbs,
+            run = args.run,
+            run_time = args.run_time,
+            lock = args.lock,
+            host = args.host,
+            daq_args = {
+                'l1a_rate': args.l1a_rate,
+                'ext_l1a': args.ext_l1a,
+                'verbose': True,
+                'stream': args.stream,
+                'rotate_size': args.rotate_size*1E6 if args.rotate_size is not None else None,
+                'rotate_time': args.rotate_time,
+                'fsync': fsync,
+            },
+            monitor = monitor,
+        )
+        print(f"Run {args.run} has ended.")
+        exit()
 
-    rbs = [int(x) for x in args.rb.split(',')]
+    kcu = get_kcu(args.kcu)
 
     # scanning the RBs can cause problems with the trigger link, not exactly sure why.
     # therefore, it's safer to just give a list of RBs that are connected
@@ -281,6 +497,9 @@ if __name__ == '__main__':
     #print(f"Resetting global event counter of RB #{rb}")
     #kcu.write_node(f"READOUT_BOARD_{rb}.EVENT_CNT_RESET", 0x1)
 
+    # the samplers share the link with the DAQ threads of this process, see tamalero.Sampler
+    samplers = [start_monitor(kcu, rb, args.run, **monitor) for rb in rbs] if monitor is not None else []
+
     print(f"Preparing DAQ streams.\n ...")
 
     streams = []
@@ -297,6 +516,10 @@ if __name__ == '__main__':
                     'ext_l1a':args.ext_l1a,
                     'lock': args.lock,
                     'verbose': True,
+                    'stream': args.stream,
+                    'rotate_size': args.rotate_size*1E6 if args.rotate_size is not None else None,
+                    'rotate_time': args.rotate_time,
+                    'fsync': fsync,
                 },
             )
         )
@@ -308,6 +531,9 @@ if __name__ == '__main__':
        # stream_0._running or stream_1._running:
         time.sleep(1)
     print("Done with all streams")
+    for sampler in samplers:
+        if sampler is not None:
+            sampler.stop()
 
     print(f"Run {args.run} has ended.")
     ## NOTE this would be the place to also dump the ETROC configs
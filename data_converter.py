@@ -6,6 +6,7 @@ import pandas as pd
 import awkward as ak
 # from tamalero.FIFO import merge_words
 from tamalero.DataFrame import DataFrame
+from tamalero.RawReader import RawReader
 
 def merge_words(res): #TODO: Does this need to be it's own definition here, or can we use the one from tamalero.FIFO
     empty_frame_mask = np.array(res[0::2]) > (2**8)  # masking empty fifo entries
@@ -15,6 +16,37 @@ def merge_words(res): #TODO: Does this need to be it's own definition here, or c
     else:
         return []
 
+def unpack_chunk(df, words):
+    '''
+    Decode a chunk of merged words with DataFrame.read_many, in the layout of DataFrame.read:
+    one row per word, with NaN for the fields that are not defined for the type of the word.
+    '''
+    res = df.read_many(words)
+    data_type = res.pop('data_type')
+    defined = {d: np.zeros(len(data_type), dtype=bool) for d in res}
+    for i, id in enumerate(df.data_types):
+        is_type = data_type == i
+        if id == 'data' and 'types' in df.format:
+            # data words carry the fields of the type of their header, read assumes type 0 for unknown types
+            for t in np.unique(res['type'][is_type]):
+                for d in df.format['types'].get(int(t), df.format['types'][0]):
+                    defined[d] |= is_type & (res['type'] == t)
+        else:
+            for d in df.format['data'][id]:
+                defined[d] |= is_type
+    for d in ['raw', 'raw_full', 'meta']:
+        defined[d] |= data_type >= 0
+
+    table = {}
+    for d in res:
+        if d in ['raw', 'raw_full', 'meta']:
+            table[d] = [hex(x) if ok else np.nan for x, ok in zip(res[d].tolist(), defined[d].tolist())]
+        else:
+            table[d] = np.where(defined[d], res[d], np.nan)
+    table = pd.DataFrame(table)
+    table["data_type"] = np.array(df.data_types + [None], dtype=object)[data_type]  # -1 is None
+    return table
+
 def event_merger(window_df,merged_idx):
     # Removing events that have been merged already from current window
     window_df = window_df[~window_df.index.isin(merged_idx[merged_idx].index)]
@@ -58,21 +90,15 @@ if __name__ == '__main__':
     args = argParser.parse_args() 
 
     df = DataFrame('ETROC2')
-    with open(args.input, 'rb') as f:
-        print("Reading from {}".format(args.input))
-        bin_data = f.read()
-        raw_data = struct.unpack('<{}I'.format(int(len(bin_data)/4)), bin_data)
-
-    merged_data = merge_words(raw_data)
-    unpacked_data = [ df.read(x) for x in merged_data ]
+    print("Reading from {}".format(args.input))
+    reader = RawReader(args.input)
+    # chunks are decoded one at a time, only the decoded columns are kept
+    data_df = pd.concat([unpack_chunk(df, chunk) for chunk in reader.chunks()], ignore_index=True)
 
     import time
     start = time.process_time()
     #TODO: this is a bit convoluted, at some point it should be cleaned
     # gymnastic to get an awkward array with header,[datas],trailer per each row
-    tuple_df = pd.DataFrame.from_dict(unpacked_data)
-    data_df = pd.json_normalize(tuple_df[1][:])
-    data_df["data_type"] = tuple_df[0][:]
     event_df = data_df.groupby(data_df["elink"].diff().ne(0).cumsum(),as_index=False).agg(list)
 
     # pandas implementation:
@@ -304,7 +304,7 @@
 #             total_hits = np.sum(hits)
 #             print("Total number of hits:", total_hits)
 #         else:
-#             print("Bad run detected. Not creating a json file.")
+#             print("Bad run detected. Not creating an output file.")
 #             all_runs_good = False
 #             #if os.path.isfile(f"{here}/ETROC_output/output_run_{args.input}_rb{rb}.json"):
 #             #    os.remove(f"{here}/ETROC_output/output_run_{args.input}_rb{rb}.json")
@@ -423,12 +423,13 @@
 import struct
 import argparse
 import numpy as np
-import pandas as pd
 import awkward as ak
 import json
 import yaml
 from yaml import Dumper, Loader
 from tamalero.DataFrame import DataFrame
+from tamalero.RawReader import RawReader
+from tamalero.event_io import write_events, load_daq_log
 from emoji import emojize
 import os
 import glob
@@ -441,13 +442,301 @@ def merge_words(res):
     else:
         return []
 
+def previous_occurrence(values):
+    '''
+    For every entry, the index of the previous entry with the same value, or -1.
+    '''
+    order = np.argsort(values, kind='stable')
+    same = values[order][1:] == values[order][:-1]
+    prev = np.full(len(values), -1, dtype=np.int64)
+    prev[order[1:][same]] = order[:-1][same]
+    return prev
+
+def double_trigger(bcid, bcid_t):
+    '''
+    True for headers that come too close after the last accepted event (with BCID bcid_t)
+    '''
+    return (((abs(bcid - bcid_t) < 150) | (abs(bcid + 3564 - bcid_t) < 50)) & (bcid != bcid_t))
+
+class EventBuilder:
+    '''
+    Vectorized event builder for the merged words of a single readout board.
+    Words are processed chunk by chunk (see RawReader.chunks), the state that is needed
+    for the duplicate and double trigger checks is carried over between chunks.
+    '''
+    raw_window = 50    # number of previous words that are checked for duplicated words
+    uuid_window = 150  # number of previous events that are checked for duplicated L1A / BCID combinations
+    max_hits = 256
+
+    def __init__(self, df, skip_trigger_check=False, verbose=False):
+        self.df = df
+        self.skip_trigger_check = skip_trigger_check
+        self.verbose = verbose
+
+        self.code = {t: i for i, t in enumerate(df.data_types)}
+        types = df.format['types']
+        n_types = max(types.keys()) + 1
+        self.has_tot = np.zeros(n_types + 1, dtype=bool)
+        self.has_counter_a = np.zeros(n_types + 1, dtype=bool)
+        for t in types:
+            self.has_tot[t] = 'tot' in types[t]
+            self.has_counter_a[t] = 'counter_a' in types[t] and 'tot' not in types[t]
+        # unknown types are decoded like type 0, see DataFrame.read
+        self.has_tot[n_types] = self.has_tot[0]
+        self.has_counter_a[n_types] = self.has_counter_a[0]
+
+        self.n_events = 0
+        self.l1a = -1
+        self.bcid_t = 9999
+        self.last_missing = False
+        self.last_trailer = False
+        self.recent_raw = np.zeros(0, dtype=np.uint64)
+        self.recent_uuid = np.zeros(0, dtype=np.int64)
+
+        self.header_counter = 0
+        self.trailer_counter = 0
+        self.skip_counter = 0
+        self.missing_l1counter = []
+        self.elink_report = {}
+        self.chunks = []
+
+    def process(self, words):
+        '''
+        Build events from a chunk of merged words. The chunk should start with a header,
+        words before the first header can not be assigned to an event and are dropped.
+        '''
+        res = self.df.read_many(words)
+        data_type = res['data_type']
+        is_header = data_type == self.code['header']
+        is_trailer = data_type == self.code['trailer']
+        is_filler = data_type == self.code['filler']
+
+        # remove duplicated words. trailers often look the same, so they are not checked
+        check = ~(is_trailer | is_filler) & (data_type >= 0)
+        raw_check = np.concatenate([self.recent_raw, res['raw_full'][check]])
+        prev = previous_occurrence(raw_check)
+        dist = np.arange(len(raw_check)) - prev
+        duplicate = ((prev >= 0) & (dist <= self.raw_window))[len(self.recent_raw):]
+        self.recent_raw = raw_check[-self.raw_window:]
+        keep = data_type >= 0
+        keep[np.flatnonzero(check)[duplicate]] = False
+
+        idx = np.flatnonzero(keep)
+        res = {k: v[idx] for k, v in res.items()}
+        n = len(idx)
+        is_header = is_header[idx]
+        is_trailer = is_trailer[idx]
+        is_data = res['data_type'] == self.code['data']
+        pos = np.arange(n)
+
+        self.fill_elink_report(res['elink'], is_header, is_data, is_trailer)
+
+        # only the first trailer of a sequence of trailers is counted
+        first_trailer = is_trailer.copy()
+        if n > 0:
+            first_trailer[0] &= not self.last_trailer
+            first_trailer[1:] &= ~is_trailer[:-1]
+            self.last_trailer = bool(is_trailer[-1])
+        self.header_counter += int(is_header.sum())
+        self.trailer_counter += int(first_trailer.sum())
+
+        # consecutive headers with the same L1A counter (e.g. from different ETROCs) form one group
+        headers = np.flatnonzero(is_header)
+        if len(headers) == 0:
+            return ak.Array([])
+        l1 = res['l1counter'][headers]
+        group_start = np.flatnonzero(np.concatenate([[True], l1[1:] != l1[:-1]]))
+        n_groups = len(group_start)
+        first_header = headers[group_start]
+        g_l1 = l1[group_start]
+        g_bcid = res['bcid'][first_header]
+        g_nheaders = np.diff(np.append(group_start, len(headers)))
+
+        if self.last_missing:
+            self.missing_l1counter[-1].append(int(g_bcid[0]))
+            self.last_missing = False
+
+        # duplicated events: same L1A / BCID combination within the last uuid_window events
+        uuid = g_l1 | (g_bcid << 8)
+        uuid_check = np.concatenate([self.recent_uuid, uuid])
+        prev = previous_occurrence(uuid_check)
+        dist = np.arange(len(uuid_check)) - prev
+        duplicate = ((prev >= 0) & (dist < self.uuid_window))[len(self.recent_uuid):]
+        self.recent_uuid = uuid_check[-self.uuid_window:]
+
+        # double triggers are checked against the last accepted event. Compare to the previous group first,
+        # and only walk through the groups following a skipped one sequentially.
+        accepted = ~duplicate
+        if not self.skip_trigger_check:
+            bcid_prev = np.concatenate([[self.bcid_t], g_bcid[:-1]])
+            accepted &= ~double_trigger(g_bcid, bcid_prev)
+            last_accepted = np.maximum.accumulate(np.where(accepted, np.arange(n_groups), -1))
+            g = -1
+            for r in np.flatnonzero(~accepted):
+                if r < g:
+                    continue
+                last = max(last_accepted[r], g)
+                bcid_t = g_bcid[last] if last >= 0 else self.bcid_t
+                g = r + 1
+                while g < n_groups:
+                    accepted[g] = not duplicate[g] and not double_trigger(g_bcid[g], bcid_t)
+                    if accepted[g]:
+                        break
+                    g += 1
+        self.skip_counter += int(n_groups - accepted.sum())
+
+        # irregular increase of the L1A counter w.r.t. the last accepted event
+        last_accepted = np.maximum.accumulate(np.where(accepted, np.arange(n_groups), -1))
+        ref = np.concatenate([[-1], last_accepted[:-1]])
+        ref_l1 = np.where(ref >= 0, g_l1[np.maximum(ref, 0)], self.l1a)
+        step = g_l1 - ref_l1
+        missing = np.flatnonzero(~np.isin(abs(step), [1, 255]) & (ref_l1 >= 0))
+        n_before = self.n_events + np.concatenate([[0], np.cumsum(accepted)[:-1]])
+        for g in missing:
+            self.missing_l1counter.append([int(g_l1[g]), int(g_bcid[g]), int(n_before[g]), int(step[g])])
+            if g < n_groups - 1:
+                self.missing_l1counter[-1].append(int(g_bcid[g+1]))
+        if len(missing) > 0 and missing[-1] == n_groups - 1:
+            self.last_missing = True
+
+        if self.verbose:
+            for g in np.flatnonzero(~accepted):
+                print("Skipping event", g_l1[g], g_bcid[g])
+
+        accepted_groups = np.flatnonzero(accepted)
+        n_new = len(accepted_groups)
+        if n_new == 0:
+            return ak.Array([])
+
+        # assign every word to the group of the last header group before it
+        word_group = np.searchsorted(first_header, pos, side='right') - 1
+        in_event = word_group >= 0
+        in_event[in_event] = accepted[word_group[in_event]]
+        event_of_group = np.cumsum(accepted) - 1
+        word_event = np.where(in_event, event_of_group[np.maximum(word_group, 0)], -1)
+
+        event_start = first_header[accepted_groups]
+
+        # events with too many hits are cut after the first max_hits+1 hits, including their trailers
+        data = is_data & in_event
+        n_data = np.cumsum(data)
+        hit_number = np.where(in_event, n_data - n_data[event_start][word_event], 0)
+        data &= hit_number <= self.max_hits + 1
+        trailer = first_trailer & in_event & (hit_number <= self.max_hits)
+        n_overflow = int(np.sum(data & (hit_number == self.max_hits + 1)))
+        if n_overflow > 0:
+            print(f"{n_overflow} events have more than {self.max_hits} hits. Skipping the remaining hits of these events.")
+
+        # number of hits since the last header, used to assign chip IDs to hits
+        n_hits = np.cumsum(data)
+        last_header = np.maximum.accumulate(np.where(is_header, pos, -1))
+        hits_since_header = n_hits - n_hits[np.maximum(last_header, 0)]
+
+        word_type = np.minimum(res['type'], len(self.has_tot) - 1)
+        tot = data & self.has_tot[word_type]
+        counter_a = data & self.has_counter_a[word_type]
+        bcid_words = counter_a.copy()
+        bcid_words[event_start] = True
+        raw_words = (is_header & in_event) | data | trailer
+        raw = np.where(is_trailer, res['raw'], res['raw_full'])
+
+        def jagged(sel, values):
+            return ak.unflatten(values[sel], np.bincount(word_event[sel], minlength=n_new))
+
+        trailer_event = word_event[trailer]
+        chip_counts = hits_since_header[trailer]
+        chipid = np.repeat(res['chipid'][trailer], chip_counts)
+
+        events = ak.Array({
+            'event': self.n_events + np.arange(n_new),
+            'l1counter': g_l1[accepted_groups],
+            'nheaders': g_nheaders[accepted_groups],
+            'ntrailers': np.bincount(trailer_event, minlength=n_new),
+            'row': jagged(data, res['row_id']),
+            'col': jagged(data, res['col_id']),
+            'tot_code': jagged(tot, res['tot']),
+            'toa_code': jagged(tot, res['toa']),
+            'cal_code': jagged(tot, res['cal']),
+            'elink': jagged(data, res['elink']),
+            'raw': ak.unflatten(np.array([hex(x) for x in raw[raw_words].tolist()], dtype=str), np.bincount(word_event[raw_words], minlength=n_new)),
+            'crc': jagged(trailer, res['crc']),
+            'chipid': ak.unflatten(chipid, np.bincount(np.repeat(trailer_event, chip_counts), minlength=n_new)),
+            'bcid': jagged(bcid_words, res['bcid']),
+            'counter_a': jagged(counter_a, res['counter_a']),
+            'nhits': ak.singletons(np.bincount(word_event[data], minlength=n_new)),
+            'nhits_trail': np.bincount(trailer_event, weights=res['hits'][trailer], minlength=n_new).astype(np.int64),
+        })
+
+        self.l1a = int(g_l1[accepted_groups[-1]])
+        self.bcid_t = int(g_bcid[accepted_groups[-1]])
+        self.n_events += n_new
+        self.chunks.append(events)
+        return events
+
+    def fill_elink_report(self, elink, is_header, is_data, is_trailer):
+        for name, sel in [('nheader', is_header), ('nhits', is_data), ('ntrailer', is_trailer)]:
+            counts = np.bincount(elink[sel])
+            for e in np.flatnonzero(counts):
+                if e not in self.elink_report:
+                    self.elink_report[e] = {'nheader':0, 'nhits':0, 'ntrailer':0}
+                self.elink_report[e][name] += int(counts[e])
+
+    def events(self):
+        '''
+        All events that have been built so far, as one awkward array
+        '''
+        if len(self.chunks) == 0:
+            return ak.Array([])
+        if len(self.chunks) > 1:
+            self.chunks = [ak.concatenate(self.chunks)]
+        return self.chunks[0]
+
+def match_events(events, events_ref, max_distance=100):
+    '''
+    For every event in events_ref, the index of the first event in events with a BCID that is lower by one
+    and an event number that differs by less than max_distance, or -1 if there is none.
+    '''
+    key = ak.to_numpy(ak.firsts(events.bcid)) + 1
+    number = ak.to_numpy(events.event)
+    key_ref = ak.to_numpy(ak.firsts(events_ref.bcid))
+    number_ref = ak.to_numpy(events_ref.event)
+    scale = max(number.max(initial=0), number_ref.max(initial=0)) + 2*max_distance
+    combined = key*scale + number + max_distance
+    order = np.argsort(combined, kind='stable')
+    combined = combined[order]
+    pos = np.searchsorted(combined, key_ref*scale + number_ref + 1)
+    found = pos < len(combined)
+    found[found] = combined[pos[found]] < key_ref[found]*scale + number_ref[found] + 2*max_distance
+    return np.where(found, order[np.minimum(pos, len(order)-1)], -1)
+
+def append_matched(values, values_other, idx):
+    '''
+    Append the lists of values_other at idx to values, where idx is not -1
+    '''
+    matched = idx >= 0
+    if not np.any(matched):
+        return values
+    counts = np.zeros(len(idx), dtype=np.int64)
+    counts[matched] = ak.to_numpy(ak.num(values_other))[idx[matched]]
+    other = ak.unflatten(ak.flatten(values_other[idx[matched]]), counts)
+    return ak.concatenate([values, other], axis=1)
+
 def data_dumper(
         input_file,
         #output_file,
         verbose=False,
         skip_trigger_check=False,
         force=False,
+        output_format='parquet',
+        compression='zstd',
+        row_group_size=100000,
 ):
+    '''
+    Build events from the raw data of all readout boards of a run
+    output_format - parquet or json
+    compression - parquet compression codec
+    row_group_size - number of events per parquet row group
+    '''
     # NOTE find all files (i.e. layers) for the specified input file
     df = DataFrame('ETROC2')
 
@@ -457,218 +746,31 @@ def data_dumper(
 
     in_files = glob.glob(input_file.replace('rb0', 'rb*'))
     print(in_files)
-    out_files = [x.replace('.dat', '.json') for x in in_files]
+    out_files = [x.replace('.dat', f'.{output_format}') for x in in_files]
 
     for irb, f_in in enumerate(in_files):
         #f_in = f'{here}/ETROC_output/output_run_{args.input}_rb{rb}.dat'
-        with open(f_in, 'rb') as f:
-            print("Reading from {}".format(f_in))
-            bin_data = f.read()
-            raw_data = struct.unpack('<{}I'.format(int(len(bin_data)/4)), bin_data)
-
-        merged_data = merge_words(raw_data)
-        unpacked_data = map(df.read, merged_data)
-
-        event       = []
-        counter_h   = []  # double check the number of headers
-        counter_t   = []  # double check the number of trailers
-        l1counter   = []
-        row         = []
-        col         = []
-        tot_code    = []
-        toa_code    = []
-        cal_code    = []
-        elink       = []
-        raw         = []
-        nhits       = []
-        nhits_trail = []
-        chipid      = []
-        crc         = []
-        bcid        = []
-        counter_a   = []
-
-        header_counter = 0
-        trailer_counter = 0
-
-        headers = []
-        trailers = []
-        i = 0
-        l1a = -1
-        bcid_t = 9999
-        skip_event = False
-        skip_counter = 0
+        print("Reading from {}".format(f_in))
+        reader = RawReader(f_in)
+        builder = EventBuilder(df, skip_trigger_check=skip_trigger_check, verbose=verbose)
+        for chunk in reader.chunks():
+            builder.process(chunk)
+        events = builder.events()
+
+        header_counter = builder.header_counter
+        trailer_counter = builder.trailer_counter
+        missing_l1counter = builder.missing_l1counter
+        elink_report = builder.elink_report
         bad_run = False
-        last_missing = False
-        elink_report = {}
-
-        uuid = []
-        all_raw = []
-
-        t_tmp = None
-
-        for t, d in unpacked_data:
-            if d['elink'] not in elink_report:
-                elink_report[d['elink']] = {'nheader':0, 'nhits':0, 'ntrailer':0}
-            sus = False
-            if d['raw_full'] in all_raw[-50:] and not t in ['trailer', 'filler']:  # trailers often look the same
-                #print("Potential double counting", t, d)
-                #all_raw.append(d['raw_full'])
-                continue
-            if t not in ['trailer', 'filler']:
-                all_raw.append(d['raw_full'])
-
-            if t == 'header':
-                elink_report[d['elink']]['nheader'] += 1
-                hit_counter = 0
-                uuid_tmp = d['l1counter'] | d['bcid']<<8
-                headers.append(d['raw'])
-                header_counter += 1
-                #if (abs(d['bcid']-bcid_t)<50) and (d['bcid'] - bcid_t)>0 and not (d['bcid'] == bcid_t):
-                #    skip_event = True
-                #    print("Skipping event")
-                #    continue
-                if d['bcid'] != bcid_t and last_missing:
-                    missing_l1counter[-1].append(d['bcid'])
-                    last_missing = False
-
-                if d['l1counter'] == l1a:
-                    # this just skips additional headers for the same event
-                    counter_h[-1] += 1
-                    raw[-1].append(d['raw_full'])
-                    if skip_event:
-                        print("Skipping event (same l1a counter)", d['l1counter'], d['bcid'], bcid_t)
-                        continue
-                    pass
-                #elif d['l1counter'] < l1a and d['l1counter']!=0:
-                # # NOTE this part is experimental, and removes duplicate events
-                # # However, we should instead re-implement full consistency checks of header - data - trailer style
-                #    skip_event = True
-                #    print("Skipping event", d['l1counter'], d['bcid'], bcid_t)
-
-                else:
-                    if abs(l1a - d['l1counter']) not in [1,255] and l1a>=0:
-                        missing_l1counter.append([d['l1counter'], d['bcid'], i, d['l1counter'] - l1a])  # this checks if we miss any event according to the counter
-                        last_missing = True
-                    if uuid_tmp in uuid and abs(i - np.where(np.array(uuid) == uuid_tmp)[0][-1]) < 150:
-                        print("Skipping duplicate event")
-                        skip_counter += 1
-                        skip_event = True
-                        continue
-                    else:
-                        uuid.append(d['l1counter'] | d['bcid']<<8)
-                    #hit_counter = 0
-                    #if (abs(d['bcid']-bcid_t)<40) and (d['bcid'] - bcid_t)>0 and not (d['bcid'] == bcid_t):
-                    #if (abs(d['bcid']-bcid_t)<500) and (d['bcid'] - bcid_t)>0 and not (d['bcid'] == bcid_t):
-                    if (((abs(d['bcid']-bcid_t)<150) or (abs(d['bcid']+3564-bcid_t)<50)) and not (d['bcid'] == bcid_t) and not skip_trigger_check):
-                        skip_event = True
-                        print("Skipping event", d['l1counter'], d['bcid'], bcid_t)
-                        skip_counter += 1
-                        continue
-                    else:
-                        skip_event = False
-                    bcid_t = d['bcid']
-                    if (abs(l1a - d['l1counter'])>1) and abs(l1a - d['l1counter'])!=255 and verbose:
-                        print("SUS")
-                        sus = True
-                    l1a = d['l1counter']
-                    event.append(i)
-                    counter_h.append(1)
-                    counter_t.append(0)
-                    l1counter.append(d['l1counter'])
-                    row.append([])
-                    col.append([])
-                    tot_code.append([])
-                    toa_code.append([])
-                    cal_code.append([])
-                    elink.append([])
-                    raw.append([d['raw_full']])
-                    nhits.append(0)
-                    nhits_trail.append([])
-                    chipid.append([])
-                    crc.append([])
-                    bcid.append([d['bcid']])
-                    counter_a.append([])
-                    i += 1
-                    if verbose or sus:
-                        print("New event:", l1a, i, d['bcid'])
-
-            if t == 'data':
-                elink_report[d['elink']]['nhits'] += 1
-            if t == 'trailer':
-                elink_report[d['elink']]['ntrailer'] += 1
-
-            if t == 'data' and not skip_event:
-                hit_counter += 1
-                if 'tot' in d:
-                    tot_code[-1].append(d['tot'])
-                    toa_code[-1].append(d['toa'])
-                    cal_code[-1].append(d['cal'])
-                elif 'counter_a' in d:
-                    bcid[-1].append(d['bcid'])
-                    counter_a[-1].append(d['counter_a'])
-                elif 'counter_b' in d:
-                    pass
-                row[-1].append(d['row_id'])
-                col[-1].append(d['col_id'])
-                elink[-1].append(d['elink'])
-                raw[-1].append(d['raw_full'])
-                nhits[-1] += 1
-                if nhits[-1] > 256:
-                    print("This event already has more than 256 hits. Skipping event.")
-                    skip_event = True
-                    continue
-                    #bad_run = True
-                    #break
-
-            if t == 'trailer' and t_tmp != 'trailer':
-                trailers.append(d['raw_full'])
-                trailer_counter += 1
-                if not skip_event:
-                    try:
-                        counter_t[-1] += 1
-                        if hit_counter > 0:
-                            #print(hit_counter)
-                            #chipid[-1].append(hit_counter*d['chipid'])
-                            chipid[-1] += hit_counter*[d['chipid']]
-                            #print(l1counter[-1], bcid[-1], chipid[-1])
-                        #else:
-                        #    chipid[-1].append()
-                        nhits_trail[-1].append(d['hits'])
-                        raw[-1].append(d['raw'])
-                        crc[-1].append(d['crc'])
-                    except IndexError:
-                        print("Data stream started with a trailer, that is weird.")
-
-            t_tmp = t
-
-        if (not bad_run or force) and event:
-            print("Zipping")
-            events = ak.Array({
-                'event': event,
-                'l1counter': l1counter,
-                'nheaders': counter_h,
-                'ntrailers': counter_t,
-                'row': row,
-                'col': col,
-                'tot_code': tot_code,
-                'toa_code': toa_code,
-                'cal_code': cal_code,
-                'elink': elink,
-                'raw': raw,
-                'crc': crc,
-                'chipid': chipid,
-                'bcid': bcid,
-                'counter_a': counter_a,
-                'nhits': ak.singletons(nhits),
-                'nhits_trail': ak.sum(ak.Array(nhits_trail), axis=-1),
-            })
 
+        if (not bad_run or force) and len(events) > 0:
             total_events = len(events)
             # NOTE the check below is only valid for single ETROC
             #consistent_events = len(events[((events.nheaders==2)&(events.ntrailers==2)&(events.nhits==events.nhits_trail))])
             #print(total_events, consistent_events)
 
             print(f"Done with {len(events)} events. " + emojize(":check_mark_button:"))
+            print(f" - skipped {builder.skip_counter} duplicated or double-triggered events")
             #print(f" - skipped {skip_counter/events.nheaders[0]} events that were identified as double-triggered " + emojize(":check_mark_button:"))
             if header_counter == trailer_counter:
                 print(f" - found same number of headers and trailers!: {header_counter} " + emojize(":check_mark_button:"))
@@ -678,7 +780,7 @@ def data_dumper(
             print(f" - found {len(missing_l1counter)} missing events (irregular increase of L1counter).")
             if len(missing_l1counter)>0:
                 print("   L1counter, BCID, event number and step size of these events are:")
-                for ml1,mbcid,mev,mdelta,mbcidt in missing_l1counter:
+                for ml1,mbcid,mev,mdelta,mbcidt in (m + [-1] if len(m) < 5 else m for m in missing_l1counter):
                     if mbcidt - mbcid<7:
                         print("Expected issue because of missing L1A dead time:", ml1, mbcid, mev,mdelta,mbcidt)
                     else:
@@ -686,10 +788,20 @@ def data_dumper(
 
             print(f" - Total expected events is {total_events+len(missing_l1counter)}")
             print(f" - elink report:")
+            import pandas as pd
             print(pd.DataFrame(elink_report))
 
-            with open(out_files[irb], "w") as f:
-                json.dump(ak.to_json(events), f)
+            metadata = {
+                'input_file': f_in,
+                'daq_log': load_daq_log(f_in),
+                'nevents': len(events),
+                'nheaders': header_counter,
+                'ntrailers': trailer_counter,
+                'nskipped': builder.skip_counter,
+                'nmissing': len(missing_l1counter),
+                'skip_trigger_check': skip_trigger_check,
+            }
+            write_events(events, out_files[irb], metadata=metadata, compression=compression, row_group_size=row_group_size)
             #with open(f"ETROC_output/{args.input}_rb{rb}.json", "w") as f:
             #    json.dump(ak.to_json(events), f)
             events_all_rb.append(events)
@@ -707,10 +819,9 @@ def data_dumper(
             #    mask = [(2,4), (3,4), (4,6), (3,11), (6,12)]
             #if rb=='1':
             #    mask = [(4,0)]
-            for ev in events:
-                for row, col in zip(ev.row, ev.col):
-                    if (row, col) not in mask:
-                        hits[row][col] += 1
+            np.add.at(hits, (ak.to_numpy(ak.flatten(events.row)), ak.to_numpy(ak.flatten(events.col))), 1)
+            for row, col in mask:
+                hits[row][col] = 0
 
             fig, ax = plt.subplots(1,1,figsize=(7,7))
             cax = ax.matshow(hits)
@@ -730,96 +841,45 @@ def data_dumper(
             total_hits = np.sum(hits)
             print("Total number of hits:", total_hits)
         else:
-            print("Bad run detected. Not creating a json file.")
+            print("Bad run detected. Not creating an output file.")
             all_runs_good = False
             #if os.path.isfile(f"{here}/ETROC_output/output_run_{args.input}_rb{rb}.json"):
             #    os.remove(f"{here}/ETROC_output/output_run_{args.input}_rb{rb}.json")
 
     if len(events_all_rb)>1: #or True:
-        event_number = []
-        bcid = []
-        nhits = []
-        row = []
-        col = []
-        chipid = []
-
-        #sel = ak.flatten(events_all_rb[0].nhits>0)
-        #sel = ak.flatten(ak.ones_like(events_all_rb[0].nhits))
-        sel = ak.flatten(ak.ones_like(events_all_rb[0].nhits, dtype=bool))
-        events_with_hits = len(events_all_rb[0][sel])
-
-        for rb, events in enumerate(events_all_rb):
-            if rb == 0:
-                #sel = ak.flatten(events.nhits)>0
-                event_number = ak.to_list(events[sel].event)
-                l1counter = ak.to_list(events[sel].l1counter)
-                bcid = ak.to_list(events[sel].bcid)
-                nhits = ak.to_list(events[sel].nhits)
-                row = ak.to_list(events[sel].row)
-                col = ak.to_list(events[sel].col)
-                toa = ak.to_list(events[sel].toa_code)
-                tot = ak.to_list(events[sel].tot_code)
-                cal = ak.to_list(events[sel].cal_code)
-                elink = ak.to_list(events[sel].elink)
-                chipid = ak.to_list(events[sel].chipid)
-            else:
-                # loop through rb0 events, and find corresponding entries in the other layers
-                print(f"Merging events from RB {rb}")
-                from tqdm import tqdm
-                with tqdm(total=events_with_hits, bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}') as pbar:
-                    for i, ev in enumerate(event_number):
-                        # print(i, ev)
-                        for j, tmp_evt in enumerate(events_all_rb[rb][ak.flatten(events_all_rb[rb].bcid + 1 == events_all_rb[0].bcid[ev])]):
-                            # print(j,tmp_evt)
-                        #for j in events_all_rb[rb].event:
-                            if abs(tmp_evt.event - ev)<100:
-                            #if events_all_rb[rb].l1counter[j] == events_all_rb[0].l1counter[i] and events_all_rb[rb].bcid[j] == events_all_rb[0].bcid[i] and abs(j-i) < 100:
-                            #if events_all_rb[rb].bcid[j] == events_all_rb[0].bcid[ev] and abs(j-ev) < 100:
-                                nhits[i] += ak.to_list(tmp_evt.nhits)
-                                row[i] += ak.to_list(tmp_evt.row)
-                                col[i] += ak.to_list(tmp_evt.col)
-                                tot[i] += ak.to_list(tmp_evt.tot_code)
-                                toa[i] += ak.to_list(tmp_evt.toa_code)
-                                cal[i] += ak.to_list(tmp_evt.cal_code)
-                                elink[i] += ak.to_list(tmp_evt.elink)
-                                chipid[i] += ak.to_list(tmp_evt.chipid)
-                                #print("--------------------------")
-                                #print(f"Found matching event for event {i} in rb {rb} stream")
-                                break
-                        pbar.update()
-
-                #for j in events.event:
-                #    if events.l1counter[j] == events_all_rb[0].l1counter[j] and events.bcid[j] == events_all_rb[0].bcid[j]:
-                #        nhits[j].append(events.nhits)
-                #        row[j].append(events.row)
-                #        col[j].append(events.col)
-                #        chipid[j].append(events.chipid)
+        # NOTE find the corresponding entries of the rb0 events in the other layers
+        merged = events_all_rb[0]
+        fields = ['nhits', 'row', 'col', 'tot_code', 'toa_code', 'cal_code', 'elink', 'chipid']
+        columns = {f: merged[f] for f in fields}
+        for rb in range(1, len(events_all_rb)):
+            print(f"Merging events from RB {rb}")
+            idx = match_events(events_all_rb[rb], merged)
+            print(f" - found matching events for {np.sum(idx>=0)} out of {len(idx)} events")
+            for f in fields:
+                columns[f] = append_matched(columns[f], events_all_rb[rb][f], idx)
 
         print("Zipping again")
         events = ak.Array({
-            'event': event_number,
-            'l1counter': l1counter,
-            #'nheaders': counter_h,
-            #'ntrailers': counter_t,
-            'row': row,
-            'col': col,
-            'tot_code': tot,
-            'toa_code': toa,
-            'cal_code': cal,
-            'elink': elink,
-            #'raw': raw,
-            #'crc': crc,
-            'chipid': chipid,
-            'bcid': bcid,
-            #'counter_a': counter_a,
-            'nhits': nhits,
-            #'nhits_trail': ak.sum(ak.Array(nhits_trail), axis=-1),
+            'event': merged.event,
+            'l1counter': merged.l1counter,
+            'row': columns['row'],
+            'col': columns['col'],
+            'tot_code': columns['tot_code'],
+            'toa_code': columns['toa_code'],
+            'cal_code': columns['cal_code'],
+            'elink': columns['elink'],
+            'chipid': columns['chipid'],
+            'bcid': merged.bcid,
+            'nhits': columns['nhits'],
         })
-        with open(out_files[0].replace('rb0', 'merged'), "w") as f:
-            json.dump(ak.to_json(events), f)
+        metadata = {
+            'input_files': in_files,
+            'daq_logs': [load_daq_log(f_in) for f_in in in_files],
+            'nevents': len(events),
+        }
+        write_events(events, out_files[0].replace('rb0', 'merged'), metadata=metadata, compression=compression, row_group_size=row_group_size)
         # make a copy that is called rb0 for the merger
-        with open(out_files[0], "w") as f:
-            json.dump(ak.to_json(events), f)
+        write_events(events, out_files[0], metadata=metadata, compression=compression, row_group_size=row_group_size)
         print("Done.")
 
     if not bad_run and in_files and events_all_rb:
@@ -836,6 +896,9 @@ if __name__ == '__main__':
     argParser.add_argument('--dump_mask', action='store_true', help="Skip the double trigger check.")
     argParser.add_argument('--verbose', action='store_true', help="Print every event number.")
     argParser.add_argument('--force', action='store_true', help="Don't care about inconsistencies, force produce output.")
+    argParser.add_argument('--format', action='store', default='parquet', choices=['parquet', 'json'], help="Output format")
+    argParser.add_argument('--compression', action='store', default='zstd', help="Compression of the parquet output (zstd, snappy, gzip, lz4, none)")
+    argParser.add_argument('--row_group_size', action='store', default=100000, type=int, help="Number of events per parquet row group")
     args = argParser.parse_args()
 
     rbs = args.rbs.split(',')
@@ -846,4 +909,7 @@ if __name__ == '__main__':
         verbose=args.verbose,
         skip_trigger_check=args.skip_trigger_check,
         force=args.force,
+        output_format=args.format,
+        compression=None if args.compression == 'none' else args.compression,
+        row_group_size=args.row_group_size,
     )
\ No newline at end of file
@@ -8,10 +8,6 @@ from tamalero.ReadoutBoard import ReadoutBoard
 from tamalero.colors import red, green, yellow
 
 import numpy as np
-from scipy.optimize import curve_fit
-from matplotlib import pyplot as plt
-from tqdm import tqdm
-import pandas as pd
 import os
 import sys
 import json
@@ -8,11 +8,6 @@ from tamalero.ReadoutBoard import ReadoutBoard
 from tamalero.colors import red, green, yellow
 
 import numpy as np
-from scipy.optimize import curve_fit
-from matplotlib import pyplot as plt
-from tqdm import tqdm
-import pandas as pd
-import ROOT
 import os
 import sys
 import json
@@ -171,6 +166,7 @@ if __name__ == '__main__':
     offset_from_baseline = int(args.offset)
     etroc.wr_reg("disDataReadout", 1, broadcast=True)
     w = 1000
+    import ROOT
     scan_canvas = ROOT.TCanvas("Autocalibration", "Autocalibration")
     scan_canvas.SetCanvasSize(w, 2*w)
     baseline    = ROOT.TH2I("Autocalibration baseline", "Autocalibration baseline", 16, 0, 16, 16, -16, 0)
@@ -7,17 +7,8 @@ try:
     from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
     from yaml import Loader, Dumper
-import shutil
 
 if __name__ == '__main__':
-    which_root = shutil.which("root")
-    if which_root == "/cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/bin/root":
-        print("Found expected ROOT version")
-    else:
-        print("This script relies on pyROOT, but found unexpected root version.")
-        print(" > In case of issues, run:")
-        print(" > source /cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/ROOT-env.sh")
-
     from root_dumper import dump_to_root
     from data_dumper import data_dumper
 
@@ -56,7 +47,7 @@ if __name__ == '__main__':
                         continue
                 except FileNotFoundError:
                     print("Couldn't find log")
-                print(f" > Converting binary to json")
+                print(f" > Converting binary to parquet")
                 n_events, events = data_dumper(
                     f"{data_dir}/output_run_{run}_rb0.dat",
                     skip_trigger_check=True,
@@ -67,8 +58,8 @@ if __name__ == '__main__':
                 if continue_processing:
                     #subprocess.call(f"python3 data_dumper.py --input {run} --rbs 0 --skip_trigger_check", shell=True)
                     outfile = f'ETROC_merged_run_{run}.root'
-                    print(f" > Converting json to root")
-                    dump_to_root(f'{data_dir}/{outfile}', f'{data_dir}/output_run_{run}_rb0.json')
+                    print(f" > Converting events to root")
+                    dump_to_root(f'{data_dir}/{outfile}', events)
                 else:
                     print(" ! Data and number of L1As not in agreement, did not further process!")
                 if not skip_stageout:
@@ -1,97 +1,81 @@
 #!/usr/bin/env python3
-import json
-import ROOT as rt
-from array import array
+import awkward as ak
+import numpy as np
+import uproot
 import os
 import re
 import time
+from tamalero.event_io import iterate_events, formats
 
-def setVector(v_, l_):
-    v_.clear()
-    for i in l_:
-        v_.push_back(i)
+# layout of the pulse tree, same as the one that was filled through PyROOT before
+# (event, l1counter and bcid were Int_t leaves, i.e. signed 32 bit)
+branch_types = {
+    'event':       np.int32,
+    'l1counter':   np.int32,
+    'row':         'var * int32',
+    'col':         'var * int32',
+    'tot_code':    'var * int32',
+    'toa_code':    'var * int32',
+    'cal_code':    'var * int32',
+    'elink':       'var * int32',
+    'chipid':      'var * int32',
+    'bcid':        np.int32,  # bcid of the first header of the event
+    'nhits':       'var * int32',
+    'nhits_trail': 'var * int32',  # never filled, kept for compatibility
+}
 
-def dump_to_root(output, input_file):
-    # Create an empty root file so that the merger step is always happy and does not get stuck
-    filename = os.path.basename(input_file)
-    name, ext = os.path.splitext(filename)
-    if ext != '.json':
-        raise ValueError("Inputted file needs to be json from data dumper")
+def to_branches(events):
+    '''
+    Convert a batch of events from the event builder into the branches of the pulse tree
+    '''
+    branches = {}
+    for name, dtype in branch_types.items():
+        if name == 'nhits_trail':
+            branches[name] = ak.unflatten(np.zeros(0, dtype=np.int32), np.zeros(len(events), dtype=np.int64))
+        elif name == 'bcid':
+            branches[name] = ak.to_numpy(ak.firsts(events.bcid)).astype(dtype)
+        elif dtype == 'var * int32':
+            branches[name] = ak.values_astype(events[name], np.int32)
+        else:
+            branches[name] = ak.to_numpy(events[name]).astype(dtype)
+    return branches
 
-    f = rt.TFile(output, "RECREATE")
-    tree = rt.TTree("pulse", "pulse")
-    print(output)
+def dump_to_root(output, input_file, batch_size=100000):
+    '''
+    Write events into the pulse tree of a root file, in batches of batch_size events.
+    input_file - parquet or json file from data_dumper, or an awkward array of events
+    '''
+    if not isinstance(input_file, ak.Array):
+        filename = os.path.basename(input_file)
+        name, ext = os.path.splitext(filename)
+        if ext not in formats:
+            raise ValueError("Inputted file needs to be parquet or json from data dumper")
 
-    if os.path.isfile(input_file):
-        with open(input_file) as f_in:
+    # Create an empty root file so that the merger step is always happy and does not get stuck
+    with uproot.recreate(output) as f:
+        print(output)
+        if isinstance(input_file, ak.Array):
+            batches = (input_file[i:i+batch_size] for i in range(0, len(input_file), batch_size))
+        elif os.path.isfile(input_file):
             print("Now reading from {}".format(input_file))
-            jsonString = json.load(f_in)
-            jsonData = json.loads(jsonString)
-
-            event_       = array('I',[0])
-            l1counter_   = array('I',[0])
-            row_         = rt.std.vector[int]()
-            col_         = rt.std.vector[int]()
-            tot_code_    = rt.std.vector[int]()
-            toa_code_    = rt.std.vector[int]()
-            cal_code_    = rt.std.vector[int]()
-            elink_       = rt.std.vector[int]()
-            #raw_         = rt.std.vector[rt.std.string]()
-            #crc_         = rt.std.vector[int]()
-            chipid_      = rt.std.vector[int]()
-            #bcid_        = rt.std.vector[int]()
-            bcid_        = array("I",[0]) # rt.std.vector[int]()
-            #counter_a_   = rt.std.vector[int]()
-            nhits_       = rt.std.vector[int]()
-            nhits_trail_ = rt.std.vector[int]()
+            batches = iterate_events(input_file)
+        else:
+            print("-----File does not exist-----")
+            return
 
-            tree.Branch("event",       event_, "event/I")
-            tree.Branch("l1counter",   l1counter_, "l1counter/I")
-            tree.Branch("row",         row_)
-            tree.Branch("col",         col_)
-            tree.Branch("tot_code",    tot_code_)
-            tree.Branch("toa_code",    toa_code_)
-            tree.Branch("cal_code",    cal_code_)
-            tree.Branch("elink",       elink_)
-            #tree.Branch("raw",         raw_)
-            #tree.Branch("crc",         crc_)
-            tree.Branch("chipid",      chipid_)
-            tree.Branch("bcid",        bcid_, "bcid/I")
-            #tree.Branch("counter_a",   counter_a_)
-            # tree.Branch("nhits",       nhits_, "nhits/I")
-            tree.Branch("nhits",       nhits_)
-            tree.Branch("nhits_trail", nhits_trail_)
+        tree = f.mktree("pulse", branch_types, title="pulse")
+        n_events = 0
+        for events in batches:
+            for i in range(0, len(events), batch_size):
+                batch = events[i:i+batch_size]
+                tree.extend(to_branches(batch))
+                n_events += len(batch)
 
-            for i, event in enumerate(jsonData):
-                # print(event["bcid"])
-                event_[0] =             event["event"]
-                l1counter_[0] =         event["l1counter"]
-                setVector(row_,         event["row"])
-                setVector(col_,         event["col"])
-                setVector(tot_code_,    event["tot_code"])
-                setVector(toa_code_,    event["toa_code"])
-                setVector(cal_code_,    event["cal_code"])
-                setVector(elink_,       event["elink"])
-                # setVector(raw_,         event["raw"])
-                #setVector(crc_,         event["crc"])
-                setVector(chipid_,      event["chipid"])
-                # print(event["bcid"])
-                bcid_[0] =              int(event["bcid"][0])
-                # setVector(bcid_,        event["bcid"])
-                #setVector(counter_a_,   event["counter_a"])
-                setVector(nhits_,           event["nhits"])
-                # setVector(nhits_trail_, event["nhits_trail"])
-
-                tree.Fill()
-    
-        print(f"Found {i+1} events")
-        f.WriteObject(tree, "pulse")
+        print(f"Found {n_events} events")
         print(f"Output written to {output} ...")
-    else:
-        print("-----File does not exist-----")
 
 def get_run_number(path: str) -> int:
-    pattern = r'output_run_(\d+)_rb0\.json'
+    pattern = r'output_run_(\d+)_rb0\.(json|parquet)'
     match = re.search(pattern, path)
     if match:
         return int(match.group(1))
@@ -5,6 +5,7 @@ from tamalero.utils import get_kcu
 from tamalero.colors import green, red, yellow
 from tamalero.ReadoutBoard import ReadoutBoard
 from tamalero.FIFO import FIFO
+from tamalero.Calibration import calibrate_thresholds
 
 from tqdm import tqdm
 from pathlib import Path
@@ -149,61 +150,12 @@ def measure_BL_and_NW(list_of_pixels,
                       custom_note = '',
                       ):
 
-    baseline_storage = {}
-    failed_pixels = {}
+    # chips on different I2C masters are calibrated in parallel
+    result = calibrate_thresholds(configs, pixels=list_of_pixels, offset='auto', use=False, verbose=True)
+    baseline_storage = result.storage()
 
-    for chip_name, etroc in configs.items():
-    
-        # 2. Initialize storage for the chip and get a direct reference
-        baseline_storage[chip_name] = {
-            'row': [], 'col': [], 'baseline': [],
-            'noise_width': [], 'timestamp': []
-        }
-        failed_pixels[chip_name] = []
-
-        print(f"\nScanning {chip_name}...")
-
-        # 3. Loop through each pixel for the current chip
-        for pixel_row, pixel_col in tqdm(list_of_pixels, desc=f"{chip_name} pixels"):
-            
-            baseline, noise_width = 0, 0  # Default values for failure case
-            
-            try:
-                baseline, noise_width = etroc.auto_threshold_scan(
-                    row=pixel_row,
-                    col=pixel_col,
-                    broadcast=False,
-                    offset='auto',
-                    use=False,
-                    verbose=True
-                )
-            
-            except Exception as e:
-                print(red(f"  Pixel ({pixel_row},{pixel_col}): SCAN FAILED - {e}"))
-                failed_pixels[chip_name].append((pixel_row, pixel_col))
-
-            # 4. Append data for EVERY pixel (values are None on failure)
-            baseline_storage[chip_name]['row'].append(pixel_row)
-            baseline_storage[chip_name]['col'].append(pixel_col)
-            baseline_storage[chip_name]['baseline'].append(baseline)
-            baseline_storage[chip_name]['noise_width'].append(noise_width)
-            baseline_storage[chip_name]['timestamp'].append(datetime.now().isoformat(sep=' '))
-
-    # 5. Per-chip summary of failures (moved inside the loop)
-    if failed_pixels[chip_name]:
-        print(red(f"  Found {len(failed_pixels[chip_name])} pixels with scan failures on {chip_name}"))
-
-    # --- Final Summary ---
-    total_failed_pixels = sum(len(failed_list) for failed_list in failed_pixels.values())
     print(green("\nBaseline calibration completed"))
-
-    if total_failed_pixels > 0:
-        print(yellow(f"WARNING: Found {total_failed_pixels} total pixels with baseline scan failures:"))
-        for chip_name, failed_list in failed_pixels.items():
-            if failed_list:
-                print(f"  {chip_name}: {failed_list}")
-    else:
-        print(green("All pixels passed baseline scan"))
+    result.summary()
 
     print("Save Baseline and noise width plots")
 
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
-import uhal
+try:
+    import uhal
+    from uhal._core import exception as uhal_exception
+except ModuleNotFoundError:
+    # only the software stand-in works without uhal, see tamalero.KCU
+    uhal = None
+    from tamalero.SoftIPbus import exception as uhal_exception
 import os
 import time
 import struct
 import datetime
 from tamalero.Module import Module
+from tamalero.FIFO import blocks_per_dispatch, queue_block_reads
 from threading import Thread
 
 class Beam():
@@ -30,7 +37,9 @@ class Beam():
 
         if verbose: print("Preparing beam...")
 
-        uhal.disableLogging()
+        if uhal is not None:
+
+            uhal.disableLogging()
 
         self.l1a_rate = l1a_rate
         self.nmin = nmin
@@ -101,26 +110,25 @@ class Beam():
             if not self.dashboard: break
             continue
         self.files = {}
+        max_payload_size = self.kcu.get_max_payload_size()
         while self.SIM:
             data = []
             while self.kcu.read_node("SYSTEM.L1A_RATE_CNT") != 0 or self.kcu.read_node("READOUT_BOARD_0.RX_FIFO_OCCUPANCY") != 0:
                 try:
                     # Check FIFO occupancy
-                    occupancy = self.kcu.read_node("READOUT_BOARD_0.RX_FIFO_OCCUPANCY")
-                    num_blocks_to_read = occupancy.value() // block
+                    occupancy = self.kcu.read_node("READOUT_BOARD_0.RX_FIFO_OCCUPANCY").value()
 
-                    # Read data from FIFO
-                    if (num_blocks_to_read):
-                        reads = num_blocks_to_read * [self.kcu.hw.getNode("DAQ_RB0").readBlock(block)]  # reads is a list of num_blocks_to_read elements of type uhal._core.ValVector_uint32
+                    # Read data from FIFO, all blocks that fit into the IPbus packet budget go out with a single dispatch
+                    while occupancy > 0:
+                        num_blocks_to_read = blocks_per_dispatch(occupancy, block=block, max_payload_size=max_payload_size)
+                        last_block = occupancy % block if num_blocks_to_read == occupancy // block else 0
+                        reads, _ = queue_block_reads(self.kcu.hw, 0, num_blocks_to_read, block=block, last_block=last_block)
                         self.kcu.dispatch()
                         for read in reads:
                             data += read.value()
-                    elif (not num_blocks_to_read) and (occupancy.value() > 0):
-                        reads = self.kcu.hw.getNode("DAQ_RB0").readBlock(occupancy.value())   # reads is a single uhal._core.ValVector_uint32 element, not a list; not iterable
-                        self.kcu.dispatch()
-                        data += reads.value()
+                        occupancy -= num_blocks_to_read*block + last_block
 
-                except uhal._core.exception:
+                except uhal_exception:
                     print("uhal UDP error in daq")
 
             if data:
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+'''
+Threshold calibration of several ETROCs at once.
+ETROCs that sit on different I2C masters (lpGBT or SCA I2C channels) are calibrated in parallel,
+ETROCs that share an I2C master are calibrated one after the other.
+'''
+import os
+import time
+import threading
+import numpy as np
+from datetime import datetime
+from yaml import dump
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+from tamalero.colors import red, green, yellow
+
+# one lock per I2C master, shared by all calibrations in this process
+master_locks = {}
+master_locks_lock = threading.Lock()
+
+def get_master_lock(etroc):
+    '''
+    Lock of the I2C master (I2C_master object and channel) that an ETROC is connected to
+    '''
+    key = (id(etroc.I2C_master), etroc.i2c_channel)
+    with master_locks_lock:
+        if key not in master_locks:
+            master_locks[key] = threading.RLock()
+        return master_locks[key]
+
+all_pixels = [(row, col) for row in range(16) for col in range(16)]
+
+class CalibrationResult:
+
+    def __init__(self, names):
+        '''
+        Per-pixel results of the threshold calibration of several ETROCs.
+        Results are added from several threads while the calibration is running.
+        names - names of the ETROCs
+        '''
+        self.lock = threading.Lock()
+        self.names = list(names)
+        self.baseline = {name: np.zeros([16, 16]) for name in self.names}
+        self.noise_width = {name: np.zeros([16, 16]) for name in self.names}
+        self.done = {name: np.zeros([16, 16], dtype=bool) for name in self.names}
+        self.failed = {name: [] for name in self.names}
+        self.records = {name: [] for name in self.names}
+
+    def add(self, name, row, col, baseline, noise_width):
+        with self.lock:
+            self.baseline[name][row][col] = baseline
+            self.noise_width[name][row][col] = noise_width
+            self.done[name][row][col] = True
+            self.records[name].append((row, col, baseline, noise_width, datetime.now().isoformat(sep=' ')))
+
+    def add_failure(self, name, row, col):
+        '''
+        Failed pixels are stored with baseline and noise width 0
+        '''
+        with self.lock:
+            self.failed[name].append((row, col))
+            self.records[name].append((row, col, 0, 0, datetime.now().isoformat(sep=' ')))
+
+    def n_done(self, name=None):
+        names = self.names if name is None else [name]
+        return sum(int(self.done[n].sum()) + len(self.failed[n]) for n in names)
+
+    def thresholds(self, name, offset='auto'):
+        if offset == 'auto':
+            return self.baseline[name] + self.noise_width[name]
+        return self.baseline[name] + offset
+
+    def storage(self):
+        '''
+        Results as {name: {'row': [..], 'col': [..], 'baseline': [..], 'noise_width': [..], 'timestamp': [..]}},
+        in the order they were measured
+        '''
+        with self.lock:
+            return {
+                name: {key: [r[i] for r in self.records[name]] for i, key in enumerate(['row', 'col', 'baseline', 'noise_width', 'timestamp'])}
+                for name in self.names
+            }
+
+    def summary(self):
+        n_failed = sum(len(f) for f in self.failed.values())
+        if n_failed > 0:
+            print(yellow(f"WARNING: Found {n_failed} total pixels with baseline scan failures:"))
+            for name, failed in self.failed.items():
+                if failed:
+                    print(f"  {name}: {failed}")
+        else:
+            print(green("All pixels passed baseline scan"))
+
+
+class ThresholdCalibration:
+
+    def __init__(self, etrocs, pixels=None, offset='auto', use=True, out_dir=None, delay=0, group_size=None, verbose=False, callback=None):
+        '''
+        etrocs - dictionary {name: ETROC}, or a list of ETROCs (named by module id and chip number)
+        pixels - list of (row, col), all pixels by default
+        offset - 'auto' (noise width) or a fixed DAC offset above the baseline
+        use - apply the thresholds to the ETROCs
+        out_dir - store the thresholds in out_dir, same files as ETROC.run_threshold_scan
+        delay - time in s to wait after every pixel
+        group_size - calibrate this many pixels of an ETROC at once with ETROC.batched_threshold_scan,
+                     None for one pixel at a time with ETROC.auto_threshold_scan
+        callback - function(name, row, col, baseline, noise_width) that is called for every calibrated pixel
+        '''
+        if not isinstance(etrocs, dict):
+            etrocs = {f"module_{etroc.module_id}_etroc_{etroc.chip_no}": etroc for etroc in etrocs}
+        self.etrocs = etrocs
+        self.pixels = all_pixels if pixels is None else list(pixels)
+        self.offset = offset
+        self.use = use
+        self.out_dir = out_dir
+        self.delay = delay
+        self.group_size = group_size
+        self.verbose = verbose
+        self.callback = callback
+        self.result = CalibrationResult(self.etrocs.keys())
+
+    def get_groups(self):
+        '''
+        Group the ETROCs by I2C master, every group is calibrated by its own thread
+        '''
+        groups = {}
+        for name, etroc in self.etrocs.items():
+            lock = get_master_lock(etroc)
+            groups.setdefault(id(lock), (lock, []))[1].append(name)
+        return list(groups.values())
+
+    def calibrate_pixel(self, name, row, col):
+        etroc = self.etrocs[name]
+        try:
+            baseline, noise_width = etroc.auto_threshold_scan(
+                row=row,
+                col=col,
+                broadcast=False,
+                offset=self.offset,
+                use=self.use,
+                verbose=self.verbose,
+            )
+        except Exception as e:
+            print(red(f"  {name} pixel ({row},{col}): SCAN FAILED - {e}"))
+            self.result.add_failure(name, row, col)
+            return
+        self.result.add(name, row, col, baseline, noise_width)
+        if self.callback is not None:
+            self.callback(name, row, col, baseline, noise_width)
+
+    def calibrate_pixels(self, name, pixels):
+        etroc = self.etrocs[name]
+        try:
+            baseline, noise_width = etroc.batched_threshold_scan(
+                pixels=pixels,
+                offset=self.offset,
+                use=self.use,
+                group_size=self.group_size,
+                verbose=self.verbose,
+            )
+        except Exception as e:
+            print(red(f"  {name} pixels {pixels}: SCAN FAILED - {e}"))
+            for row, col in pixels:
+                self.result.add_failure(name, row, col)
+            return
+        for row, col in pixels:
+            self.result.add(name, row, col, baseline[row][col], noise_width[row][col])
+            if self.callback is not None:
+                self.callback(name, row, col, baseline[row][col], noise_width[row][col])
+
+    def calibrate_group(self, lock, names, pbar=None):
+        for name in names:
+            if self.group_size is not None:
+                for start in range(0, len(self.pixels), self.group_size):
+                    pixels = self.pixels[start:start+self.group_size]
+                    with lock:
+                        self.calibrate_pixels(name, pixels)
+                    if pbar is not None:
+                        pbar.update(len(pixels))
+                self.finish(name)
+                continue
+            for row, col in self.pixels:
+                # the lock is released between pixels, so that other users of the I2C master can get in
+                with lock:
+                    self.calibrate_pixel(name, row, col)
+                    if self.delay:
+                        time.sleep(self.delay)
+                if pbar is not None:
+                    pbar.update()
+            self.finish(name)
+
+    def finish(self, name):
+        etroc = self.etrocs[name]
+        etroc.baseline = self.result.baseline[name]
+        etroc.noise_width = self.result.noise_width[name]
+        if self.out_dir is not None:
+            thresholds = self.result.thresholds(name, offset=self.offset)
+            for label, values in [('thresholds', thresholds), ('baseline', etroc.baseline), ('noise_width', etroc.noise_width)]:
+                with open(os.path.join(self.out_dir, f'{label}_module_{etroc.module_id}_etroc_{etroc.chip_no}.yaml'), 'w') as f:
+                    dump(values.tolist(), f, Dumper=Dumper)
+
+    def run(self, progress=True):
+        '''
+        Run the calibration of all ETROCs, returns a CalibrationResult
+        '''
+        groups = self.get_groups()
+        print(f"Running threshold calibration of {len(self.etrocs)} ETROCs on {len(groups)} I2C masters")
+        pbar = None
+        if progress:
+            from tqdm import tqdm
+            pbar = tqdm(total=len(self.etrocs)*len(self.pixels), bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}')
+
+        start_time = time.time()
+        threads = [threading.Thread(target=self.calibrate_group, args=(lock, names, pbar)) for lock, names in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if pbar is not None:
+            pbar.close()
+        if self.verbose:
+            print(f"Threshold calibration took {time.time()-start_time:.1f} s")
+        return self.result
+
+def calibrate_thresholds(etrocs, **kwargs):
+    '''
+    Shortcut for ThresholdCalibration(etrocs, **kwargs).run()
+    '''
+    return ThresholdCalibration(etrocs, **kwargs).run()
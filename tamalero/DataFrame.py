@@ -1,20 +1,16 @@
 #!/usr/bin/env python3
 import os
+import numpy as np
 
-from yaml import load, dump
-
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+from tamalero.yaml_utils import load_yaml
 
 here = os.path.dirname(os.path.abspath(__file__))
 
 class DataFrame:
     def __init__(self, version='ETROC2'):
-        with open(os.path.expandvars(f'{here}/../configs/dataformat.yaml'), 'r') as f:
-            self.format = load(f, Loader=Loader)[version]
+        self.format = load_yaml(f'{here}/../configs/dataformat.yaml', cached=True)[version]
         self.type = 0
+        self.data_types = list(self.format['identifiers'].keys())
 
     def get_bytes(self, word, format):
         bytes = []
@@ -75,6 +71,124 @@ class DataFrame:
         #print (res)
         return data_type, res
 
+    def read_many(self, words):
+        '''
+        Vectorized version of read, for bulk decoding of merged (64 bit) words.
+        Returns a dictionary of numpy arrays with one entry per word.
+        data_type holds the index of the identified word type in self.data_types,
+        or -1 if the word could not be identified.
+        All other fields follow the naming of read. Fields that are not defined
+        for the type of a given word are set to 0, except for type, which holds
+        the header type that data words have been decoded with.
+        raw, raw_full and meta are returned as integers instead of hex strings.
+        '''
+        words = np.asarray(words, dtype=np.uint64)
+        n = len(words)
+        # the selections are disjoint, so the index of the matching type can be summed up
+        data_type = np.full(n, -1, dtype=np.int8)
+        unmatched = np.ones(n, dtype=bool)
+        selections = {}
+        for i, id in enumerate(self.data_types):
+            identifier = self.format['identifiers'][id]
+            match = unmatched & ((words & np.uint64(identifier['mask'])) == np.uint64(identifier['frame']))
+            data_type += match.view(np.int8) * np.int8(i + 1)
+            unmatched &= ~match
+            selections[id] = match
+
+        # every word gets a class, i.e. a data type together with the list of fields that are decoded.
+        # for data words this depends on the type of the most recent header
+        classes = []
+        class_selections = []
+        current_type = None
+        for id in self.data_types:
+            if id != 'data':
+                class_selections.append(selections[id])
+                classes.append((id, list(self.format['data'][id])))
+            elif 'types' in self.format:
+                if 'header' in selections and 'type' in self.format['data']['header']:
+                    is_header = selections['header']
+                    header_type = (words & np.uint64(self.format['data']['header']['type']['mask'])) >> np.uint64(self.format['data']['header']['type']['shift'])
+                    last_header = np.maximum.accumulate(np.where(is_header, np.arange(n), -1)) if n else np.zeros(0, dtype=np.int64)
+                    current_type = np.where(last_header >= 0, header_type[last_header], np.uint64(self.type))
+                    if is_header.any():
+                        self.type = int(header_type[is_header][-1])
+                else:
+                    current_type = np.full(n, self.type, dtype=np.uint64)
+                known = np.zeros(n, dtype=bool)
+                for t in self.format['types']:
+                    class_selections.append(selections['data'] & (current_type == np.uint64(t)))
+                    classes.append(('data', self.format['types'][t]))
+                    known |= class_selections[-1]
+                # assume a default for unknown types
+                class_selections.append(selections['data'] & ~known)
+                classes.append(('data', self.format['types'][0]))
+            else:
+                class_selections.append(selections['data'])
+                classes.append(('data', list(self.format['data']['data'])))
+
+        # group the classes by the (mask, shift) they use for each field, so that every
+        # distinct field definition is only computed once
+        fields = {}
+        for i, (id, datatypelist) in enumerate(classes):
+            for d in datatypelist:
+                key = (self.format['data'][id][d]['mask'], self.format['data'][id][d]['shift'])
+                if d not in fields:
+                    fields[d] = {}
+                if key not in fields[d]:
+                    fields[d][key] = []
+                fields[d][key].append(i)
+
+        # the words of a set of classes are selected with a mask of all ones (and zeros for the other words),
+        # which is much faster than a masked copy. Fields of several classes share the same selection.
+        used = []
+        for d in fields:
+            for used_by in fields[d].values():
+                if (len(used_by) < len(classes) or unmatched.any()) and tuple(used_by) not in used:
+                    used.append(tuple(used_by))
+        data_classes = tuple(i for i, (id, datatypelist) in enumerate(classes) if id == 'data')
+        if current_type is not None and data_classes not in used:
+            used.append(data_classes)
+        # all masks and output columns are rows of two large blocks, which is a lot faster than
+        # allocating (and page faulting) every array on its own
+        mask_block = np.empty((len(used), n), dtype=np.int64)
+        masks = {}
+        for j, used_by in enumerate(used):
+            selected = np.zeros(n, dtype=bool)
+            for i in used_by:
+                selected |= class_selections[i]
+            np.negative(selected.view(np.int8), out=mask_block[j])
+            masks[used_by] = mask_block[j].view(np.uint64)
+
+        block = np.empty((len(fields) + 2, n), dtype=np.uint64)
+        tmp = np.empty(n, dtype=np.uint64)
+        res = {'data_type': data_type}
+        for k, d in enumerate(fields):
+            for (mask, shift), used_by in fields[d].items():
+                # the classes of different definitions of a field don't overlap, so they can be or-ed
+                val = block[k] if d not in res else tmp
+                np.right_shift(words, np.uint64(shift), out=val)
+                np.bitwise_and(val, np.uint64(mask >> shift), out=val)
+                if len(used_by) < len(classes) or unmatched.any():
+                    np.bitwise_and(val, masks[tuple(used_by)], out=val)
+                if d in res:
+                    np.bitwise_or(block[k], val, out=block[k])
+                res[d] = block[k].view(np.int64)
+
+        if current_type is not None:
+            # data words are returned with the type of their header
+            np.bitwise_and(current_type, masks[data_classes], out=tmp)
+            if 'type' in res:
+                np.bitwise_or(res['type'], tmp.view(np.int64), out=res['type'])
+            else:
+                res['type'] = tmp.view(np.int64)
+
+        res['raw'] = np.bitwise_and(words, np.uint64(0xFFFFFFFFFF), out=block[-2])
+        res['raw_full'] = words
+        res['meta'] = np.right_shift(words, np.uint64(40), out=block[-1])
+        np.bitwise_and(res['meta'], np.uint64(0xFFFFFF), out=res['meta'])
+
+        return res
+
 if __name__ == '__main__':
 
     test_words = [
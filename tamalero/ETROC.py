@@ -3,7 +3,7 @@ For ETROC control
 """
 import time
 import numpy as np
-from tamalero.utils import load_yaml, ffs, bit_count
+from tamalero.utils import load_register_map, get_bursts
 from tamalero.colors import red, green, yellow
 from yaml import load, dump
 try:
@@ -15,8 +15,14 @@ from random import randrange
 
 here = os.path.dirname(os.path.abspath(__file__))
 
+# address offsets of all 256 pixels, bits 5-8 are the row and bits 9-12 the column
+pixel_offsets = np.array([row << 5 | col << 9 for row in range(16) for col in range(16)])
+
 class ETROC():
 
+    shadow = None  # shadow copy of the configuration registers, see enable_shadow
+    I2C_max_bytes = 14  # data bytes per I2C burst, the lpGBT and SCA masters send at most 16 bytes including the address
+
     def __init__(
             self,
             rb=None,
@@ -35,8 +41,16 @@ class ETROC():
             no_init = False,
             hard_reset = False,
             no_hard_reset_on_init = False,
-            path_to_address_table = '../address_table/ETROC2_example.yaml'
+            path_to_address_table = '../address_table/ETROC2_example.yaml',
+            shadow = False,
+            shadow_verify = 0,
     ):
+        '''
+        shadow - keep a shadow copy of the configuration registers, so that masked writes don't need a readback
+        shadow_verify - cross-check every n-th use of the shadow copy against the chip (0 to never check)
+        '''
+        if shadow:
+            self.enable_shadow(verify=shadow_verify)
         self.QINJ_delay = 504  # this is a fixed value for the default settings of ETROC2
         self.isfake = False
         self.I2C_master = rb.DAQ_LPGBT if master.lower() == 'lpgbt' else rb.SCA
@@ -59,7 +73,7 @@ class ETROC():
         self.chip_id = chip_id
         self.module_id = chip_id >> 2
         self.chip_no = chip_id & 0x3
-        self.regs = load_yaml(os.path.join(here, path_to_address_table))
+        self.regs, self.layout = load_register_map(os.path.join(here, path_to_address_table))
 
         self.DAC_min  = 600  # in mV
         self.DAC_max  = 1000  # in mV
@@ -129,7 +143,7 @@ class ETROC():
                 slave_addr=self.i2c_adr,
             )
 
-    def I2C_read(self, adr=0x0):
+    def I2C_read(self, adr=0x0, nbytes=1):
         if self.isfake:
             raise NotImplementedError("I2C read not implemented for software ETROC")
         else:
@@ -137,6 +151,7 @@ class ETROC():
                 reg=adr,
                 master=self.i2c_channel,
                 slave_addr=self.i2c_adr,
+                nbytes=nbytes,
                 timeout=0.1,
             )
 
@@ -170,7 +185,42 @@ class ETROC():
                     #print(f"I2C write has failed in ETROC {self.chip_id}, retrying")
                     if time.time() - start_time > 2:
                         print(f"I2C write has failed in ETROC {self.chip_id} and retries have timed out.")
+                        self.store_shadow(adr, None, write=True)
                         return 0
+        self.store_shadow(adr, val, write=True)
+
+    def wr_adrs(self, adr, vals):
+        '''
+        Write a list of values to consecutive addresses, starting at adr, in a single I2C burst
+        '''
+        if self.isfake:
+            for i, val in enumerate(vals):
+                self.write_adr(adr + i, val)
+            return
+        success = False
+        start_time = time.time()
+        while not success:
+            try:
+                self.I2C_write(adr, [int(val) for val in vals])
+                success = True
+            except:
+                if time.time() - start_time > 2:
+                    print(f"I2C write has failed in ETROC {self.chip_id} and retries have timed out.")
+                    for i in range(len(vals)):
+                        self.store_shadow(adr + i, None, write=True)
+                    return 0
+        for i, val in enumerate(vals):
+            self.store_shadow(adr + i, val, write=True)
+
+    def write_adrs(self, values):
+        '''
+        Write a dictionary {address: value}, consecutive addresses within the periphery or a pixel are sent as bursts
+        '''
+        for adr, vals in get_bursts(values, max_len=self.I2C_max_bytes, block=32):
+            if len(vals) == 1:
+                self.wr_adr(adr, vals[0])
+            else:
+                self.wr_adrs(adr, vals)
 
     def rd_adr(self, adr):
         if self.isfake:
@@ -180,13 +230,150 @@ class ETROC():
             start_time = time.time()
             while True:
                 try:
-                    return self.I2C_read(adr)
+                    val = self.I2C_read(adr)
+                    self.store_shadow(adr, val)
+                    return val
                 except:
                     #print(f"I2C read has failed in ETROC {self.chip_id}, retrying")
                     if time.time() - start_time > 2:
                         print(f"I2C read has failed in ETROC {self.chip_id} and retries have timed out")
                         return 0
 
+    def rd_adrs(self, adr, nbytes):
+        '''
+        Read nbytes consecutive addresses, starting at adr, in a single I2C transaction
+        '''
+        if self.isfake:
+            return [self.read_adr(adr + i) for i in range(nbytes)]
+        start_time = time.time()
+        while True:
+            try:
+                vals = self.I2C_read(adr, nbytes=nbytes)
+                break
+            except:
+                if time.time() - start_time > 2:
+                    print(f"I2C read has failed in ETROC {self.chip_id} and retries have timed out")
+                    return [0]*nbytes
+        if nbytes == 1:
+            vals = [vals]
+        for i, val in enumerate(vals):
+            self.store_shadow(adr + i, val)
+        return vals
+
+    def reg_from_bytes(self, reg, values):
+        '''
+        Value of register reg, given a dictionary {address: byte} of the bytes it is made of
+        '''
+        layout = self.layout[reg]
+        tmp = 0
+        for a, mask, shift, offset in zip(layout['address'], layout['mask'], layout['shift'], layout['offset']):
+            tmp |= ((values[a] & mask) >> shift) << offset
+        return tmp
+
+    # =====================================
+    # === SHADOW CONFIGURATION REGISTERS ===
+    # =====================================
+    def enable_shadow(self, verify=0):
+        '''
+        Keep a copy of the configuration registers of this chip. The copy is filled by reads
+        (or snapshot) and updated by every write, so that wr_reg can skip the readback of masked registers.
+        verify - cross-check every n-th use of the copy against the chip (0 to never check)
+        '''
+        self.shadow = np.zeros(2**16, dtype=np.uint8)
+        self.shadow_valid = np.zeros(2**16, dtype=bool)
+        self.shadow_verify = verify
+        self.shadow_hits = 0
+        self.shadow_mismatches = 0
+
+    def disable_shadow(self):
+        self.shadow = None
+
+    def invalidate_shadow(self):
+        '''
+        Forget the shadow copy, needs to be called whenever the chip could have lost its configuration
+        (reset, hard reset, power cycle)
+        '''
+        if self.shadow is not None:
+            self.shadow_valid[:] = False
+
+    def shadow_keys(self, adr, write=False):
+        '''
+        Shadow entries that belong to address adr, None for status registers.
+        Broadcast writes affect the same register of all pixels.
+        '''
+        if adr & (1 << 15):
+            if adr & (1 << 14):
+                return None  # pixel status
+            if write and adr & (1 << 13):
+                return (adr & 0x801f) | pixel_offsets
+            return adr & ~(1 << 13)
+        if adr >= 0x100:
+            return None  # periphery status
+        return adr
+
+    def store_shadow(self, adr, val, write=False):
+        '''
+        Update the shadow copy after a read or write of adr, val=None invalidates the entries
+        '''
+        if self.shadow is None:
+            return
+        keys = self.shadow_keys(adr, write=write)
+        if keys is None:
+            return
+        if val is None:
+            self.shadow_valid[keys] = False
+        else:
+            self.shadow[keys] = val
+            self.shadow_valid[keys] = True
+
+    def rd_adr_shadow(self, adr):
+        '''
+        Same as rd_adr, but taken from the shadow copy if possible
+        '''
+        keys = self.shadow_keys(adr) if self.shadow is not None else None
+        if keys is None or not self.shadow_valid[keys]:
+            return self.rd_adr(adr)
+        cached = int(self.shadow[keys])
+        self.shadow_hits += 1
+        if self.shadow_verify and self.shadow_hits % self.shadow_verify == 0:
+            read = self.rd_adr(adr)
+            if read != cached:
+                self.shadow_mismatches += 1
+                print(red(f"Shadow register mismatch in ETROC {self.chip_id} at address {hex(adr)}: expected {hex(cached)}, read {hex(read)}"))
+            return read
+        return cached
+
+    def snapshot(self, pixels=True):
+        '''
+        Fill the shadow copy with the configuration of the periphery and, if pixels=True, of all pixels
+        '''
+        if self.shadow is None:
+            self.enable_shadow()
+        adrs = sorted({a for reg in self.regs.values() if reg['stat'] == 0 and reg['pixel'] == 0 for a in reg['address']})
+        if pixels:
+            pixel_adrs = sorted({a for reg in self.regs.values() if reg['stat'] == 0 and reg['pixel'] == 1 for a in reg['address']})
+            adrs += ((np.array(pixel_adrs)[:, None] | (1 << 15)) | pixel_offsets).flatten().tolist()
+        for adr in adrs:
+            self.rd_adr(adr)
+
+    def verify_shadow(self, verbose=False):
+        '''
+        Compare all valid entries of the shadow copy with the chip, and update the copy.
+        Returns a list of (address, expected, read) for all mismatches.
+        '''
+        mismatches = []
+        if self.shadow is None:
+            return mismatches
+        for adr in np.flatnonzero(self.shadow_valid).tolist():
+            cached = int(self.shadow[adr])
+            read = self.rd_adr(adr)
+            if read != cached:
+                mismatches.append((adr, cached, read))
+                if verbose:
+                    print(red(f"Shadow register mismatch in ETROC {self.chip_id} at address {hex(adr)}: expected {hex(cached)}, read {hex(read)}"))
+        self.shadow_mismatches += len(mismatches)
+        return mismatches
+
     # read & write using register name & pix num
     def wr_reg(self, reg, val, row=0, col=0, broadcast=False):
         '''
@@ -196,12 +383,13 @@ class ETROC():
         col - arbitrary value for periphery, 0..15 for in pixel
         broadcast - True for broadcast to all pixels
         '''
-        masks    = self.regs[reg]['mask']
-        shifts   = list(map(ffs, masks))
-        n_bits   = [0] + list(map(bit_count, masks))
+        layout   = self.layout[reg]
+        masks    = layout['mask']
+        shifts   = layout['shift']
+        offsets  = layout['offset']
         adr      = self.get_adr(reg, row=row, col=col, broadcast=broadcast)
-        if val > 2**(sum(n_bits))-1:
-            raise RuntimeError(f"Value {val} is larger than the number of bits of register {reg} allow ({sum(n_bits)})")
+        if val > 2**layout['n_bits_total']-1:
+            raise RuntimeError(f"Value {val} is larger than the number of bits of register {reg} allow ({layout['n_bits_total']})")
         if self.isfake:
             #print(f"writing {adr=}, {value=}")
             adr = self.get_adr(reg, row=row, col=col, broadcast=False)
@@ -210,13 +398,103 @@ class ETROC():
                     for col in range(16):
                         self.wr_reg(reg, val, row=row, col=col, broadcast=False)
 
-        n_bits_total = 0
         for i, a in enumerate(adr):
-            read = self.rd_adr(a)
-            value = (((val >> (n_bits[i] + n_bits_total)) << shifts[i]) & masks[i]) | (read & ~masks[i])
-            n_bits_total += n_bits[i]
+            if masks[i] == 0xff:
+                read = 0  # the whole byte is overwritten, no readback needed
+            else:
+                read = self.rd_adr_shadow(a)
+            value = (((val >> offsets[i]) << shifts[i]) & masks[i]) | (read & ~masks[i])
             self.wr_adr(a, value)
 
+    def wr_regs(self, values, broadcast=False):
+        '''
+        Write several registers at once. Registers that share a byte are merged,
+        and consecutive addresses are sent as bursts (see write_adrs).
+        values - dictionary {register name: value} of periphery registers,
+                 or of in-pixel registers together with broadcast=True
+        broadcast - True for broadcast to all pixels
+        '''
+        if self.isfake:
+            for reg, val in values.items():
+                self.wr_reg(reg, val, broadcast=broadcast)
+            return
+        writes = {}
+        for reg, val in values.items():
+            layout = self.layout[reg]
+            if val > 2**layout['n_bits_total']-1:
+                raise RuntimeError(f"Value {val} is larger than the number of bits of register {reg} allow ({layout['n_bits_total']})")
+            for i, a in enumerate(self.get_adr(reg, broadcast=broadcast)):
+                mask = layout['mask'][i]
+                if a in writes:
+                    read = writes[a]  # byte shared with a register that was set before
+                elif mask == 0xff:
+                    read = 0  # the whole byte is overwritten, no readback needed
+                else:
+                    read = self.rd_adr_shadow(a)
+                writes[a] = (((val >> layout['offset'][i]) << layout['shift'][i]) & mask) | (read & ~mask)
+        self.write_adrs(writes)
+
+    def set_pixel_map(self, reg, values=None, pixels=None):
+        '''
+        Write a 16x16 map of values of in-pixel register(s) with as few I2C transactions as possible.
+        Registers that share a byte are merged into single writes, the most common value of every byte
+        is broadcast and only the pixels that differ from it are written individually.
+        reg - Register name, or a dictionary {register name: values} to set several registers at once
+        values - 16x16 array (indexed [row][col]), or a single value for all pixels
+        pixels - only write these pixels, list of (row, col). Other pixels are left untouched.
+        '''
+        maps = reg if isinstance(reg, dict) else {reg: values}
+        if pixels is None:
+            selected = np.ones(256, dtype=bool)
+        else:
+            selected = np.zeros(256, dtype=bool)
+            for row, col in pixels:
+                selected[row*16 + col] = True
+
+        # collect the bits of all registers per pixel byte
+        bytes_ = {}
+        for name, vals in maps.items():
+            if self.regs[name]['pixel'] != 1 or self.regs[name]['stat'] != 0:
+                raise RuntimeError(f"Register {name} is not an in-pixel configuration register")
+            vals = np.broadcast_to(np.asarray(vals, dtype=np.int64), (16, 16)).flatten()
+            layout = self.layout[name]
+            if vals.min() < 0 or vals.max() > 2**layout['n_bits_total']-1:
+                raise RuntimeError(f"Values of register {name} are out of range for its {layout['n_bits_total']} bits")
+            for a, mask, shift, offset in zip(layout['address'], layout['mask'], layout['shift'], layout['offset']):
+                mask_total, value = bytes_.get(a, (0, np.zeros(256, dtype=np.int64)))
+                value = value | (((vals >> offset) << shift) & mask)
+                bytes_[a] = (mask_total | mask, value)
+
+        broadcasts = {}
+        writes = {}
+        for a, (mask, value) in bytes_.items():
+            adrs = (1 << 15) | a | pixel_offsets
+            if self.shadow is not None and not self.isfake:
+                known = self.shadow_valid[adrs].copy()
+                current = self.shadow[adrs].astype(np.int64)
+            else:
+                known = np.zeros(256, dtype=bool)
+                current = np.zeros(256, dtype=np.int64)
+            if mask != 0xff:
+                # bits of other registers in this byte have to be kept
+                for i in np.flatnonzero(~known & selected):
+                    current[i] = self.rd_adr(int(adrs[i]))
+                known[selected] = True
+            target = value | (current & ~mask)
+
+            changed = (~known | (target != current)) & selected
+            values_, counts = np.unique(target, return_counts=True)
+            common = values_[np.argmax(counts)]
+            if not self.isfake and selected.all() and 1 + np.count_nonzero(target != common) < np.count_nonzero(changed):
+                broadcasts[(1 << 15) | (1 << 13) | a] = int(common)
+                changed = target != common
+            for i in np.flatnonzero(changed):
+                writes[int(adrs[i])] = int(target[i])
+
+        # bytes of the same pixel at consecutive addresses are written in one burst
+        self.write_adrs(broadcasts)
+        self.write_adrs(writes)
+
 
     def rd_reg(self, reg, row=0, col=0, verbose=False):
         '''
@@ -225,22 +503,21 @@ class ETROC():
         row - arbitrary value for periphery, 0..15 for in pixel
         col - arbitrary value for periphery, 0..15 for in pixel
         '''
-        masks    = self.regs[reg]['mask']
-        shifts   = list(map(ffs, masks))
-        n_bits   = [0] + list(map(bit_count, masks))
+        layout   = self.layout[reg]
+        masks    = layout['mask']
+        shifts   = layout['shift']
+        offsets  = layout['offset']
         if verbose:
             print("Found masks", masks)
             print("Found shifts", shifts)
-            print("Found n_bits", n_bits)
+            print("Found n_bits", layout['n_bits'])
 
         adr = self.get_adr(reg, row=row, col=col)
         tmp = 0
-        n_bits_total = 0
         for i, a in enumerate(adr):
             if verbose: print(i, a, masks[i], shifts[i])
             read = (self.rd_adr(a) & masks[i]) >> shifts[i]
-            tmp |= (read << (n_bits[i]+n_bits_total))
-            n_bits_total += n_bits[i]
+            tmp |= (read << offsets[i])
         return tmp
 
     def print_reg_doc(self, reg=None):
@@ -391,6 +668,7 @@ class ETROC():
                     self.wr_reg("asyResetGlobalReadout", 0)
                     time.sleep(0.1)
                     self.wr_reg("asyResetGlobalReadout", 1)
+        self.invalidate_shadow()
         if not self.isfake:
             self.rb.rerun_bitslip()  # NOTE this is necessary to get the links to lock again
 
@@ -519,33 +797,37 @@ class ETROC():
             # get the current number of invalid fast commands received
             self.invalid_FC_counter = self.get_invalidFCCount()
 
-            # give some number to the ETROC
-            self.wr_reg("EFuse_Prog", (self.chip_id)<<2)  # gives the correct chip ID
-
-            # configuration as per discussion with ETROC2 developers
-            self.wr_reg("onChipL1AConf", 0)  # this should be default anyway
-            self.wr_reg("PLL_ENABLEPLL", 1)
-            self.wr_reg("chargeInjectionDelay", 0xa)
-            self.wr_reg("L1Adelay", 0x01f5, broadcast=True)  # default for LHC / Qinj
-            self.wr_reg("disDataReadout", 1, broadcast=True)
-            self.wr_reg("QInjEn", 0, broadcast=True)
-
-            ## opening TOA / TOT / Cal windows
-            self.wr_reg("upperTOA", 0x3ff, broadcast=True)  # this also fixes the half-chip readout with internal test data
-            self.wr_reg("lowerTOA", 0x3ff, broadcast=True)
-            self.wr_reg("upperTOT", 0x1ff, broadcast=True)
-            self.wr_reg("lowerTOT", 0x1ff, broadcast=True)
-            self.wr_reg("upperCal", 0x3ff, broadcast=True)
-            self.wr_reg("lowerCal", 0x3ff, broadcast=True)
-
-            ## Configuring the trigger stream
-            self.wr_reg("disTrigPath", 1, broadcast=True)
-            self.wr_reg("upperTOATrig", 0x3ff, broadcast=True)
-            self.wr_reg("lowerTOATrig", 0x3ff, broadcast=True)
-            self.wr_reg("upperTOTTrig", 0x1ff, broadcast=True)
-            self.wr_reg("lowerTOTTrig", 0x1ff, broadcast=True)
-            self.wr_reg("upperCalTrig", 0x3ff, broadcast=True)
-            self.wr_reg("lowerCalTrig", 0x3ff, broadcast=True)
+            self.wr_regs({
+                "EFuse_Prog": (self.chip_id)<<2,  # give some number to the ETROC, gives the correct chip ID
+                # configuration as per discussion with ETROC2 developers
+                "onChipL1AConf": 0,  # this should be default anyway
+                "PLL_ENABLEPLL": 1,
+                "chargeInjectionDelay": 0xa,
+            })
+
+            # in-pixel registers are broadcast, and sent as bursts
+            self.wr_regs({
+                "L1Adelay": 0x01f5,  # default for LHC / Qinj
+                "disDataReadout": 1,
+                "QInjEn": 0,
+
+                ## opening TOA / TOT / Cal windows
+                "upperTOA": 0x3ff,  # this also fixes the half-chip readout with internal test data
+                "lowerTOA": 0x3ff,
+                "upperTOT": 0x1ff,
+                "lowerTOT": 0x1ff,
+                "upperCal": 0x3ff,
+                "lowerCal": 0x3ff,
+
+                ## Configuring the trigger stream
+                "disTrigPath": 1,
+                "upperTOATrig": 0x3ff,
+                "lowerTOATrig": 0x3ff,
+                "upperTOTTrig": 0x1ff,
+                "lowerTOTTrig": 0x1ff,
+                "upperCalTrig": 0x3ff,
+                "lowerCalTrig": 0x3ff,
+            }, broadcast=True)
 
             self.reset()  # soft reset of the global readout, 2nd reset needed for some ETROCs
             self.reset_fast_command()
@@ -616,19 +898,17 @@ class ETROC():
                 self.enable_data_readout(broadcast=True)
                 self.wr_reg("workMode", 0, broadcast=True)
                 self.set_L1Adelay(delay=L1Adelay, broadcast=True)
-                if thresholds == None :
+                if thresholds is None:
                     self.run_threshold_scan(offset=offset, out_dir=out_dir)
                 else:
-                    for row in range(16):
-                        for col in range(16):
-                            self.wr_reg('DAC', int(thresholds[row][col]), row=row, col=col) # want to get some noise
+                    self.set_pixel_map('DAC', np.array(thresholds, dtype=int)) # want to get some noise
             else:
                 self.disable_data_readout(broadcast=True)
                 self.wr_reg("workMode", 0, broadcast=True)
                 self.set_L1Adelay(delay=L1Adelay, broadcast=True)
                 for row, col in subset:
                     self.enable_data_readout(row=row, col=col, broadcast=False)
-                    if thresholds == None:
+                    if thresholds is None:
                         self.auto_threshold_scan(row=row, col=col, broadcast=False, offset=offset)
                     else:
                         self.wr_reg('DAC', int(thresholds[row][col]), row=row, col=col)
@@ -675,19 +955,26 @@ class ETROC():
         else:
             return self.get_QInj(row=row, col=col)
 
-    def run_threshold_scan(self, offset='auto', use=True, out_dir=None):
+    def run_threshold_scan(self, offset='auto', use=True, out_dir=None, batched=False, group_size=16):
+        '''
+        Threshold calibration of all pixels.
+        batched - use batched_threshold_scan, calibrating group_size pixels at a time
+        '''
         from tqdm import tqdm
         baseline = np.empty([16, 16])
         noise_width = np.empty([16, 16])
         print("Running threshold scan")
-        with tqdm(total=256, bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}') as pbar:
-            for pixel in range(256):
-                row = pixel & 0xF
-                col = (pixel & 0xF0) >> 4
-                #print(pixel, row, col)
-                baseline[row][col], noise_width[row][col] = self.auto_threshold_scan(row=row, col=col, broadcast=False, offset=offset, use=use)
-                #print(pixel)
-                pbar.update()
+        if batched:
+            baseline, noise_width = self.batched_threshold_scan(offset=offset, use=use, group_size=group_size, progress=True)
+        else:
+            with tqdm(total=256, bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}') as pbar:
+                for pixel in range(256):
+                    row = pixel & 0xF
+                    col = (pixel & 0xF0) >> 4
+                    #print(pixel, row, col)
+                    baseline[row][col], noise_width[row][col] = self.auto_threshold_scan(row=row, col=col, broadcast=False, offset=offset, use=use)
+                    #print(pixel)
+                    pbar.update()
         self.baseline = baseline
         self.noise_width = noise_width
 
@@ -814,6 +1101,90 @@ class ETROC():
 
         return baseline, noise_width
 
+    def batched_threshold_scan(self, pixels=None, offset='auto', use=True, group_size=16, scan_time=0.005, time_out=3, retries=2, progress=False, verbose=False):
+        '''
+        Same calibration as auto_threshold_scan, but group_size pixels at a time:
+        the THCal registers of all pixels in a group are set up and their scans are started,
+        ScanDone is only polled after scan_time, and the results of the group are read in one sweep.
+        Pixels that time out are calibrated again, up to retries times.
+        pixels - list of (row, col), all pixels by default
+        Returns baseline and noise width as 16x16 arrays.
+        '''
+        if pixels is None:
+            pixels = [(pixel & 0xF, (pixel & 0xF0) >> 4) for pixel in range(256)]  # same order as run_threshold_scan
+        baseline = np.zeros([16, 16])
+        noise_width = np.zeros([16, 16])
+
+        # registers that are written several times are only read once
+        own_shadow = self.shadow is None and not self.isfake
+        if own_shadow:
+            self.enable_shadow()
+
+        # NW and BL are read together
+        res_adrs = self.regs['NW']['address'] + self.regs['BL']['address']
+        res_start = min(res_adrs)
+        res_nbytes = max(res_adrs) - res_start + 1
+
+        pbar = None
+        if progress:
+            from tqdm import tqdm
+            pbar = tqdm(total=len(pixels), bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}')
+
+        try:
+            todo = list(pixels)
+            for attempt in range(retries + 1):
+                timed_out = []
+                for start in range(0, len(todo), group_size):
+                    group = todo[start:start+group_size]
+                    self.set_pixel_map({'enable_TDC': 0, 'CLKEn_THCal': 1, 'Bypass_THCal': 0, 'BufEn_THCal': 1}, pixels=group)
+                    self.set_pixel_map('RSTn_THCal', 0, pixels=group)
+                    self.set_pixel_map('RSTn_THCal', 1, pixels=group)
+                    self.set_pixel_map('ScanStart_THCal', 1, pixels=group)
+
+                    # the scans of the group run in parallel, don't poll before they can be done
+                    time.sleep(scan_time)
+                    start_time = time.time()
+                    pending = group
+                    while True:
+                        pending = [(row, col) for row, col in pending if not self.rd_reg('ScanDone', row=row, col=col)]
+                        if not pending or time.time() - start_time > time_out:
+                            break
+                        time.sleep(0.001)
+                    timed_out += pending
+                    if verbose and pending:
+                        print(f"Auto threshold scan timed out for pixels {pending}")
+
+                    self.set_pixel_map('ScanStart_THCal', 0, pixels=group)
+                    self.set_pixel_map({'CLKEn_THCal': 0, 'BufEn_THCal': 0}, pixels=group)
+
+                    dac = np.zeros([16, 16], dtype=int)
+                    for row, col in group:
+                        adr = (1 << 15) | (1 << 14) | (col << 9) | (row << 5) | res_start
+                        res = dict(zip(range(res_start, res_start + res_nbytes), self.rd_adrs(adr, res_nbytes)))
+                        baseline[row][col] = self.reg_from_bytes('BL', res)
+                        noise_width[row][col] = self.reg_from_bytes('NW', res)
+                        th = baseline[row][col] + (noise_width[row][col] if offset == 'auto' else offset)
+                        dac[row][col] = min(th, 1023)
+                    if use:
+                        self.set_pixel_map({'Bypass_THCal': 1, 'DAC': dac}, pixels=group)
+                    else:
+                        self.set_pixel_map('Bypass_THCal', 1, pixels=group)
+                    if pbar is not None:
+                        pbar.update(len(group) if attempt == 0 else 0)
+
+                if not timed_out:
+                    break
+                todo = timed_out
+                if attempt < retries:
+                    print(f"Retrying threshold calibration of {len(todo)} pixels in ETROC {self.chip_id}")
+        finally:
+            if own_shadow:
+                self.disable_shadow()
+            if pbar is not None:
+                pbar.close()
+
+        return baseline, noise_width
+
     def setup_accumulator(self, row=0, col=0):
         self.wr_reg("CLKEn_THCal", 1, row=row, col=col, broadcast=False)
         self.wr_reg("BufEn_THCal", 1, row=row, col=col, broadcast=False)
@@ -5,7 +5,7 @@
 import numpy as np
 import os
 
-from tamalero.utils import load_yaml, ffs, bit_count
+from tamalero.utils import load_yaml, load_register_map
 from tamalero.ETROC import ETROC
 from crcETROC import mod2div
 
@@ -26,10 +26,10 @@ class ETROC2_Emulator(ETROC):
         self.rb             = None
 
         # load ETROC2 dataformat
-        self.format = load_yaml(os.path.expandvars('$TAMALERO_BASE/configs/dataformat.yaml'))['ETROC2']
+        self.format = load_yaml(os.path.join(here, '../configs/dataformat.yaml'), cached=True)['ETROC2']
 
         # load register map
-        self.regs = load_yaml(os.path.join(here, '../address_table/ETROC2_example.yaml'))
+        self.regs, self.layout = load_register_map(os.path.join(here, '../address_table/ETROC2_example.yaml'))
 
         # storing data for running L1As
         self.data = {
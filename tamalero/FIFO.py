@@ -5,7 +5,10 @@ import numpy as np
 from tamalero.utils import chunk
 from yaml import load, dump
 from tamalero.DataFrame import DataFrame
-from uhal._core import exception as uhal_exception
+try:
+    from uhal._core import exception as uhal_exception
+except ModuleNotFoundError:
+    from tamalero.SoftIPbus import exception as uhal_exception
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -37,6 +40,31 @@ def merge_words(res):
     else:
         return []
 
+def blocks_per_dispatch(occupancy, block=128, max_payload_size=1472, max_packets=16):
+    '''
+    Number of full blocks of a FIFO with the given occupancy (in 32 bit words)
+    that should be queued for a single dispatch.
+    uhal splits a dispatch into packets of at most max_payload_size bytes,
+    and we limit the number of packets per dispatch to max_packets.
+    '''
+    words_per_packet = max_payload_size // 4 - 1  # one word for the packet header
+    blocks_per_packet = max(1, words_per_packet // (block + 1))  # one transaction header per block
+    return min(occupancy // block, blocks_per_packet * max_packets)
+
+def queue_block_reads(hw, rb, n_blocks, block=128, last_block=0):
+    '''
+    Queue n_blocks reads of block words (and an optional partial last block)
+    from the DAQ FIFO of readout board rb, followed by a read of the FIFO occupancy.
+    Nothing is dispatched, so that everything goes out with a single dispatch.
+    Returns the list of block reads and the occupancy read.
+    '''
+    node = hw.getNode(f"DAQ_RB{rb}")
+    reads = [node.readBlock(block) for i in range(n_blocks)]
+    if last_block > 0:
+        reads.append(node.readBlock(last_block))
+    occupancy = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY").read()
+    return reads, occupancy
+
 class FIFO:
     def __init__(self, rb, block=255):
         self.rb = rb
@@ -209,17 +237,31 @@ class FIFO:
         #            data += read.value()
 
     def read(self, dispatch=False, verbose=False):
+        '''
+        Read the current content of the FIFO.
+        Block reads are pipelined, i.e. as many blocks as fit into the IPbus
+        packet budget are sent with a single dispatch.
+        The dispatch argument is only kept for backwards compatibility, reads are always dispatched.
+        '''
         data = []
         block_size = 128
+        max_payload_size = self.rb.kcu.get_max_payload_size()
         try:
             occupancy = self.get_occupancy()
-            
+
             while occupancy > 0:
-                chunk_size = min(occupancy, block_size)
+                n_blocks = blocks_per_dispatch(occupancy, block=block_size, max_payload_size=max_payload_size)
+                # the remaining partial block goes out with the last dispatch
+                last_block = occupancy % block_size if n_blocks == occupancy // block_size else 0
+                if verbose:
+                    print(f"Reading {n_blocks} blocks and {last_block} words in one dispatch, {occupancy=}")
                 try:
-                    chunk_data = self.read_block(chunk_size, dispatch=dispatch).value()
-                    data.extend(chunk_data)
-                    occupancy -= chunk_size
+                    with self.rb.kcu.arbiter.daq():
+                        reads, _ = queue_block_reads(self.rb.kcu.hw, self.rb.rb, n_blocks, block=block_size, last_block=last_block)
+                        self.rb.kcu.dispatch()
+                    for read in reads:
+                        data.extend(read.value())
+                    occupancy -= n_blocks*block_size + last_block
 
                 except uhal_exception:
                     print(f'UDP error while reading chunk. Returning {len(data)} words read so far.')
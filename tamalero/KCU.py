@@ -1,13 +1,170 @@
 """
 Control board class (KCU105). Depends on uhal.
+The software stand-in in tamalero.SoftIPbus is only used on request, i.e. for soft:// ipb_paths,
+or for ipbusudp-2.0 ipb_paths if uhal is missing and TAMALERO_SOFT_IPBUS is set.
 """
 try:
     import uhal
 except ModuleNotFoundError:
     print("Running without uhal (ipbus not installed with correct python bindings)")
+    uhal = None
+# same as the uhal ones if uhal is installed
+from tamalero.SoftIPbus import NodePermission, BlockReadWriteMode, NonValidatedMemory
+import os
 from tamalero.colors import red, green
+from contextlib import contextmanager
+import threading
 import time
 
+def use_soft_ipbus(ipb_path):
+    '''
+    True if ipb_path is served by the software stand-in in tamalero.SoftIPbus:
+    soft:// addresses, and ipbusudp-2.0 addresses if uhal is missing and TAMALERO_SOFT_IPBUS is set
+    '''
+    if ipb_path.startswith("soft"):
+        return True
+    return uhal is None and ipb_path.startswith("ipbusudp-2.0") and bool(os.environ.get("TAMALERO_SOFT_IPBUS"))
+
+class Batch:
+    '''
+    IPbus transactions that are queued and sent together, see KCU.batch.
+    Reads return ValWords that are valid once the batch has been dispatched.
+    '''
+
+    def __init__(self, kcu, max_packets=16, parent=None):
+        '''
+        max_packets - maximum number of IPbus packets per dispatch, larger batches are split
+        parent - enclosing batch, nested batches share its queue
+        '''
+        self.kcu = kcu
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.max_packets = max_packets
+        self.max_words = kcu.get_max_payload_size() // 4 - 1  # one word for the packet header
+        self.n_reads = 0
+        self.reset()
+
+    def reset(self):
+        self.n_packets = 0
+        self.n_request = 0
+        self.n_reply = 0
+
+    def queue(self, n_request, n_reply):
+        '''
+        Account for a transaction with n_request words in the request and n_reply words in the reply,
+        and dispatch what is queued so far if the transaction would not fit into max_packets packets anymore
+        '''
+        root = self.root
+        if root.n_request + n_request > root.max_words or root.n_reply + n_reply > root.max_words:
+            # start a new packet
+            root.n_packets += 1 + max(root.n_request, root.n_reply) // root.max_words
+            root.n_request, root.n_reply = 0, 0
+        if root.n_packets >= root.max_packets:
+            # the transaction goes out with the next dispatch
+            root.dispatch()
+        root.n_request += n_request
+        root.n_reply += n_reply
+
+    def write(self, id, value):
+        reg = self.kcu.hw.getNode(id)
+        if reg.getPermission() == NodePermission.WRITE:
+            return self.action_reg(reg)
+        masked = reg.getMask() != 0xffffffff  # masked writes are read-modify-write transactions
+        self.queue(4 if masked else 3, 2 if masked else 1)
+        return reg.write(value)
+
+    def read(self, id):
+        reg = self.kcu.hw.getNode(id)
+        self.queue(2, 2)
+        self.n_reads += 1
+        return reg.read()
+
+    def read_block(self, id, size):
+        n_transactions = -(-size // 255)  # at most 255 words per transaction
+        self.queue(2*n_transactions, size + n_transactions)
+        self.n_reads += 1
+        return self.kcu.hw.getNode(id).readBlock(size)
+
+    def action_reg(self, reg):
+        self.queue(3, 1)
+        return self.kcu.hw.getClient().write(reg.getAddress(), reg.getMask())
+
+    def action(self, id):
+        return self.action_reg(self.kcu.hw.getNode(id))
+
+    def dispatch(self):
+        self.kcu.dispatch()
+        self.root.reset()
+
+
+class LinkArbiter:
+    '''
+    Shares the IPbus link of a KCU between the DAQ readout and background slow control (e.g. monitoring).
+    The DAQ has priority: background users only get the link in the gaps between DAQ reads,
+    i.e. when no DAQ read is waiting and the DAQ FIFO is not backlogged.
+    Background users should keep every access short (one probe), so that the DAQ is delayed
+    by at most one access.
+    The arbiter only sees the DAQ reads of its own process, so the DAQ and the background users
+    have to run in the same process (see start_monitor in daq.py).
+    '''
+
+    def __init__(self, lock, max_wait=10):
+        '''
+        lock - lock of the link, KCU.lock
+        max_wait - background users get the link after max_wait seconds even if the DAQ is busy,
+                   so that monitoring is never starved completely
+        '''
+        self.lock = lock
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.n_daq = 0
+        self.backlog = set()
+
+    @contextmanager
+    def daq(self):
+        '''
+        Hold the link for a DAQ read. Pending DAQ reads block new background accesses.
+        '''
+        with self.cond:
+            self.n_daq += 1
+        try:
+            with self.lock:
+                yield
+        finally:
+            with self.cond:
+                self.n_daq -= 1
+                self.cond.notify_all()
+
+    def set_backlog(self, backlog, key=0):
+        '''
+        DAQ readers report whether the FIFO holds more data than a single dispatch can read.
+        Background accesses are held back until the backlog of all readers has been cleared.
+        key - identifies the reader, e.g. the readout board number
+        '''
+        with self.cond:
+            if backlog:
+                self.backlog.add(key)
+            else:
+                self.backlog.discard(key)
+                self.cond.notify_all()
+
+    def busy(self):
+        return self.n_daq > 0 or len(self.backlog) > 0
+
+    @contextmanager
+    def background(self, max_wait=None):
+        '''
+        Wait for a gap in the DAQ reads and hold the link for the duration of the block.
+        Returns immediately if no DAQ is running.
+        max_wait - overrides LinkArbiter.max_wait
+        '''
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self.cond:
+            self.cond.wait_for(lambda: not self.busy(), timeout=max_wait)
+        with self.lock:
+            yield
+
+
 class KCU:
 
     def __init__(self,
@@ -16,15 +173,26 @@ class KCU:
                  adr_table="../module_test_fw/address_tables/etl_test_fw.xml",
                  dummy=False):
 
-        uhal.disableLogging()
-        self.auto_dispatch = True  # default -> True
+        if uhal is not None:
+            uhal.disableLogging()
+        self.lock = threading.RLock()
+        self.arbiter = LinkArbiter(self.lock)
+        self.current_batch = None
 
         self.dummy = dummy
+        self.ipb_path = ipb_path
 
         self.max_retries = 20
         if not self.dummy:
+            if uhal is None and not use_soft_ipbus(ipb_path):
+                raise ModuleNotFoundError(f"uhal is needed to connect to {ipb_path}. Use a soft:// address, "
+                                          "or set TAMALERO_SOFT_IPBUS=1 to reach ipbusudp-2.0 addresses with the UDP client in tamalero.SoftIPbus")
             try:
-                self.hw = uhal.getDevice("my_device", ipb_path, "file://" + adr_table)
+                if use_soft_ipbus(ipb_path):
+                    from tamalero import SoftIPbus
+                    self.hw = SoftIPbus.getDevice("my_device", ipb_path, "file://" + adr_table)
+                else:
+                    self.hw = uhal.getDevice("my_device", ipb_path, "file://" + adr_table)
             except:
                 raise Exception("uhal can't get device at"+adr_table)
             self.firmware_version = self.get_firmware_version(string=False, verbose=False)
@@ -32,28 +200,75 @@ class KCU:
             self.hw = None
         self.readout_boards = []
 
-    def toggle_dispatch(self):
-        self.auto_dispatch = False
+    def get_max_payload_size(self):
+        '''
+        Maximum IPbus packet payload in bytes.
+        Taken from the max_payload_size option of the IPbus URI if it is set,
+        otherwise the standard ethernet MTU minus IP and UDP headers is assumed.
+        '''
+        from urllib.parse import urlparse, parse_qs
+        try:
+            return int(parse_qs(urlparse(self.ipb_path).query)['max_payload_size'][0])
+        except (KeyError, ValueError, TypeError):
+            return 1472
 
-    def dispatch(self):
-        i = 0
-        while i<self.max_retries:
+    @contextmanager
+    def batch(self, max_packets=16):
+        '''
+        Queue writes, reads and actions, and send them with a single dispatch at the end of the block:
+
+            with kcu.batch() as b:
+                b.write("READOUT_BOARD_0.SC.TX_REGISTER_ADDR", adr)
+                b.action("READOUT_BOARD_0.SC.TX_START_READ")
+                res = b.read("READOUT_BOARD_0.SC.RX_DATA_FROM_GBTX")
+            print(res.value())
+
+        write_node, read_node and action are queued as well while a batch is open.
+        Batches are split into several dispatches of at most max_packets IPbus packets.
+        Nested batches share the queue of the enclosing batch, and only dispatch at the end
+        if they contain reads (so that their results are valid), otherwise the outermost batch dispatches.
+        The KCU is locked for other threads while a batch is open.
+        '''
+        with self.lock:
+            outer = self.current_batch
+            batch = Batch(self, max_packets=max_packets, parent=outer)
+            self.current_batch = batch
             try:
-                self.hw.dispatch()
-                self.auto_dispatch = True
-                break
-            except:
-                if i > (self.max_retries-2):
-                    raise
-                i+=1
+                yield batch
+            except BaseException:
+                self.current_batch = outer
+                if outer is None:
+                    # don't leave queued transactions behind for the next dispatch
+                    try:
+                        batch.dispatch()
+                    except Exception:
+                        pass
+                raise
+            self.current_batch = outer
+            if outer is None or batch.n_reads > 0:
+                batch.dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            i = 0
+            while i<self.max_retries:
+                try:
+                    self.hw.dispatch()
+                    break
+                except:
+                    if i > (self.max_retries-2):
+                        raise
+                    i+=1
 
     def write_node(self, id, value):
-        reg = self.hw.getNode(id)
-        if (reg.getPermission() == uhal.NodePermission.WRITE):
-            self.action_reg(reg)
-        else:
-            reg.write(value)
-            if self.auto_dispatch:
+        with self.lock:
+            if self.current_batch is not None:
+                return self.current_batch.write(id, value)
+            reg = self.hw.getNode(id)
+            if (reg.getPermission() == NodePermission.WRITE):
+                self.action_reg(reg)
+            else:
+                reg.write(value)
                 self.dispatch()
 
     def rd_lpgbt_adr(self, rb=0):
@@ -71,20 +286,24 @@ class KCU:
         return None
 
     def read_node(self, id):
-        try:
-            reg = self.hw.getNode(id)
-        except:
-            raise Exception(f"Failed finding node {id} in read_node")
-        ret = reg.read()
-        if self.auto_dispatch:
+        with self.lock:
+            try:
+                reg = self.hw.getNode(id)
+            except:
+                raise Exception(f"Failed finding node {id} in read_node")
+            if self.current_batch is not None:
+                return self.current_batch.read(id)
+            ret = reg.read()
             self.dispatch()
-        return ret
+            return ret
 
     def action_reg(self, reg):
-        addr = reg.getAddress()
-        mask = reg.getMask()
-        self.hw.getClient().write(addr, mask)
-        if self.auto_dispatch:
+        with self.lock:
+            if self.current_batch is not None:
+                return self.current_batch.action_reg(reg)
+            addr = reg.getAddress()
+            mask = reg.getMask()
+            self.hw.getClient().write(addr, mask)
             self.dispatch()
 
     def action(self, id):
@@ -96,7 +315,7 @@ class KCU:
         for id in self.hw.getNodes():
             reg = self.hw.getNode(id)
             # if (reg.getModule() == ""):
-            if (reg.getMode() != uhal.BlockReadWriteMode.HIERARCHICAL):
+            if (reg.getMode() != BlockReadWriteMode.HIERARCHICAL):
                 print(self.format_reg(reg.getAddress(), reg.getPath()[4:], -1,
                                 self.format_permission(reg.getPermission())))
 
@@ -193,7 +412,7 @@ class KCU:
         self.dispatch()
         try:
             val_int = val.value()
-        except uhal.NonValidatedMemory:
+        except NonValidatedMemory:
             print(red(f"Error: Could not read value for register {id} (NonValidatedMemory)"))
             return
         if use_color:
@@ -213,11 +432,11 @@ class KCU:
         return s
 
     def format_permission(self, perm):
-        if perm == uhal.NodePermission.READ:
+        if perm == NodePermission.READ:
             return "r"
-        if perm == uhal.NodePermission.READWRITE:
+        if perm == NodePermission.READWRITE:
             return "rw"
-        if perm == uhal.NodePermission.WRITE:
+        if perm == NodePermission.WRITE:
             return "w"
 
     def check_clock_frequencies(self, verbose=False):
@@ -5,10 +5,12 @@ import pickle
 import copy
 import random
 import json
+import numpy as np
 from functools import wraps
 import tamalero.colors as colors
 from tamalero.colors import red, green
-from tamalero.utils import read_mapping, chunk, load_yaml, get_config, majority_vote
+from tamalero.utils import read_mapping, chunk, get_bursts, load_yaml, get_config, majority_vote
+import time
 from time import sleep
 from datetime import datetime
 try:
@@ -35,8 +37,13 @@ def gpio_byname(gpio_func):
 
     return wrapper
 
+# register addresses of the I2C masters, keyed by address table, lpGBT version and master
+i2cm_tables = {}
+
 class LPGBT(RegParser):
 
+    I2CM_MAX_BYTES = 16  # size of the data buffer of the I2C masters, including the register address
+
     def __init__(self, rb=0, trigger=False, flavor='small', master=None, kcu=None, do_adc_calibration=False, config='default', debug=False, ver=None, verbose=False, poke=False, rbver=None):
         '''
         Initialize lpGBT for a certain readout board number (rb).
@@ -47,6 +54,7 @@ class LPGBT(RegParser):
         self.rb = rb
         self.trigger = trigger
         self.calibrated = False
+        self.adc_initialized = False
         self.gain = 1.85
         self.offset = 512
         self.verbose = verbose
@@ -84,6 +92,8 @@ class LPGBT(RegParser):
         if not hasattr(self, 'kcu'):
             raise Exception("Connect to KCU first.")
 
+        self.adc_initialized = False
+
         if self.trigger:
             self.ver = self.master.ver
             self.serial_num = self.master.serial_num
@@ -165,8 +175,9 @@ class LPGBT(RegParser):
         #self.base_config = load_yaml(os.path.expandvars('./configs/lpgbt_config.yaml'))['base'][f'v{self.ver}']
         #self.ec_config = load_yaml(os.path.expandvars('./configs/lpgbt_config.yaml'))['ec'][f'v{self.ver}']
 
-        self.base_config = load_yaml(os.path.expandvars('./configs/lpgbt_smu_config.yaml'))['base'][f'v{self.ver}']
-        self.ec_config = load_yaml(os.path.expandvars('./configs/lpgbt_smu_config.yaml'))['ec'][f'v{self.ver}']
+        smu_config = load_yaml(os.path.expandvars('./configs/lpgbt_smu_config.yaml'), cached=True)
+        self.base_config = smu_config['base'][f'v{self.ver}']
+        self.ec_config = smu_config['ec'][f'v{self.ver}']
         
         self.kcu.write_node("READOUT_BOARD_%d.SC.FRAME_FORMAT" % self.rb, self.ver)
         self.parse_xml(ver=self.ver)
@@ -325,6 +336,7 @@ class LPGBT(RegParser):
             self.kcu.write_node(id, 0x000)
 
     def reset(self):
+        self.adc_initialized = False
         self.wr_reg("LPGBT.RW.RESET.RSTPLLDIGITAL", 1)
         self.wr_reg("LPGBT.RW.RESET.RSTFUSES",      1)
         self.wr_reg("LPGBT.RW.RESET.RSTRXLOGIC",    1)
@@ -412,46 +424,161 @@ class LPGBT(RegParser):
             return self.master.I2C_write(adr, data)
             #raise NotImplementedError("rd_adr does only read from the master lpGBT, and you're trying to write to a servant")
         else:
-            self.kcu.toggle_dispatch()
-            #self.kcu.write_node("READOUT_BOARD_%d.SC.TX_GBTX_ADDR" % self.rb, 115)
-            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_REGISTER_ADDR" % self.rb, adr)
-            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_DATA_TO_GBTX" % self.rb, data)
-            self.kcu.action("READOUT_BOARD_%d.SC.TX_WR" % self.rb)
-            self.kcu.action("READOUT_BOARD_%d.SC.TX_START_WRITE" % self.rb)
-            self.kcu.dispatch()
+            with self.kcu.batch() as b:
+                #b.write("READOUT_BOARD_%d.SC.TX_GBTX_ADDR" % self.rb, 115)
+                b.write("READOUT_BOARD_%d.SC.TX_REGISTER_ADDR" % self.rb, adr)
+                b.write("READOUT_BOARD_%d.SC.TX_DATA_TO_GBTX" % self.rb, data)
+                b.action("READOUT_BOARD_%d.SC.TX_WR" % self.rb)
+                b.action("READOUT_BOARD_%d.SC.TX_START_WRITE" % self.rb)
 
     def rd_adr(self, adr):
         if self.trigger:
             return self.master.I2C_read(adr)
             #raise NotImplementedError("rd_adr does only read from the master lpGBT, and you're trying to read from a servant")
         else:
-            self.kcu.toggle_dispatch()
-            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_REGISTER_ADDR" % self.rb, adr)
-            self.kcu.dispatch()
-            self.kcu.action("READOUT_BOARD_%d.SC.TX_START_READ" % self.rb)
-            valid = self.kcu.read_node("READOUT_BOARD_%d.SC.RX_DATA_VALID" % self.rb).valid()
-            if valid:
+            with self.kcu.lock:  # no other read can be started in between
+                with self.kcu.batch() as b:
+                    b.write("READOUT_BOARD_%d.SC.TX_REGISTER_ADDR" % self.rb, adr)
+                    b.action("READOUT_BOARD_%d.SC.TX_START_READ" % self.rb)
+                with self.kcu.batch() as b:
+                    valid = b.read("READOUT_BOARD_%d.SC.RX_DATA_VALID" % self.rb)
+                    data = b.read("READOUT_BOARD_%d.SC.RX_DATA_FROM_GBTX" % self.rb)
+            if valid.valid():
                 # this only means that the KCU successfully read data
                 # not necessarily does it mean there's communication with the lpGBT
-                return self.kcu.read_node("READOUT_BOARD_%d.SC.RX_DATA_FROM_GBTX" % self.rb)
+                return data
 
             print("LpGBT read failed!")
             return None
 
-    def wr_reg(self, id, data):
-        node = self.get_node(id)
+    def wr_adrs(self, values):
+        '''
+        Write several registers.
+        values - dictionary {address: value} or list of (address, value), written in this order
+        The IC writes are queued and sent with a single dispatch,
+        the trigger lpGBT is written with I2C bursts of consecutive addresses.
+        '''
+        values = list(values.items()) if isinstance(values, dict) else list(values)
+        if not values:
+            return
         if self.trigger:
-            self.write_reg(self.master.I2C_write, self.master.I2C_read, node, data)  # inherited from RegParser
+            # only addresses that follow each other in values are merged, so the write order is kept
+            for start, vals in get_bursts(values, max_len=self.I2CM_MAX_BYTES-2, ordered=True):
+                self.master.I2C_write(start, vals if len(vals) > 1 else vals[0])
         else:
-            self.write_reg(self.wr_adr, self.rd_adr, node, data)  # inherited from RegParser
+            with self.kcu.batch():
+                for adr, val in values:
+                    self.wr_adr(adr, val)
 
-    def rd_reg(self, id):
-        node = self.get_node(id)
+    def rd_adrs(self, adrs):
+        '''
+        Read a list of registers, returns a list of values (None if a read failed).
+        IC reads are pipelined: the reply of one read is picked up in the same dispatch that starts the next read,
+        so n reads take n+1 dispatches instead of 2n.
+        The trigger lpGBT is read with I2C bursts of consecutive addresses.
+        '''
+        adrs = list(adrs)
+        if not adrs:
+            return []
         if self.trigger:
-            data = self.read_reg(self.master.I2C_read, node)  # inherited from RegParser
-        else:
-            data = self.read_reg(self.rd_adr, node)
-        return data
+            res = {}
+            for start, vals in get_bursts({adr: None for adr in adrs}, max_len=self.I2CM_MAX_BYTES):
+                data = self.master.I2C_read(start, nbytes=len(vals))
+                if len(vals) == 1:
+                    data = [data]
+                for i, val in enumerate(data):
+                    res[start+i] = val
+            return [res[adr] for adr in adrs]
+
+        replies = []
+        with self.kcu.lock:  # no other read can be started in between
+            for i in range(len(adrs)+1):
+                with self.kcu.batch() as b:
+                    if i > 0:
+                        replies.append((
+                            b.read("READOUT_BOARD_%d.SC.RX_DATA_VALID" % self.rb),
+                            b.read("READOUT_BOARD_%d.SC.RX_DATA_FROM_GBTX" % self.rb),
+                        ))
+                    if i < len(adrs):
+                        b.write("READOUT_BOARD_%d.SC.TX_REGISTER_ADDR" % self.rb, adrs[i])
+                        b.action("READOUT_BOARD_%d.SC.TX_START_READ" % self.rb)
+
+        res = []
+        for valid, data in replies:
+            if valid.valid():
+                res.append(data.value())
+            else:
+                print("LpGBT read failed!")
+                res.append(None)
+        return res
+
+    def wr_regs(self, values):
+        '''
+        Write several registers.
+        values - dictionary {register name: value}, written in this order
+        Registers that share an address are merged into a single write, and the read back that is needed
+        for masked registers is done with one pipelined read for all addresses.
+        '''
+        nodes = []
+        for id, data in values.items():
+            node = self.get_node(id)
+            if 'w' not in node.permission:
+                continue
+            nodes.append((node, data))
+
+        # only read addresses where some bits are not overwritten anyway
+        covered = {}
+        for node, data in nodes:
+            covered[node.real_address] = covered.get(node.real_address, 0) | (node.mask if node.mask != 0 else 0xff)
+        to_read = []
+        for node, data in nodes:
+            adr = node.real_address
+            if node.mask != 0 and 'r' in node.permission and covered[adr] & 0xff != 0xff and adr not in to_read:
+                to_read.append(adr)
+        current = dict(zip(to_read, self.rd_adrs(to_read)))
+
+        writes = {}
+        for node, data in nodes:
+            adr = node.real_address
+            if node.mask != 0:
+                value = (data << node.lsb_pos) & node.mask
+                if 'r' in node.permission and adr in current:
+                    value |= writes.get(adr, current[adr]) & ~node.mask
+                elif adr in writes:
+                    value |= writes[adr] & ~node.mask
+            else:
+                value = data
+            writes[adr] = value
+        self.wr_adrs(writes)
+
+    def rd_regs(self, ids):
+        '''
+        Read a list of registers with a single pipelined read, returns a list of values
+        '''
+        nodes = [self.get_node(id) for id in ids]
+        adrs = []
+        for node in nodes:
+            if 'r' in node.permission and node.real_address not in adrs:
+                adrs.append(node.real_address)
+        current = dict(zip(adrs, self.rd_adrs(adrs)))
+
+        res = []
+        for node in nodes:
+            if 'r' not in node.permission:
+                print('No read permission!')
+                res.append('No read permission!')
+                continue
+            value = current[node.real_address]
+            if node.mask != 0 and value is not None:
+                value = (value & node.mask) >> node.lsb_pos
+            res.append(value)
+        return res
+
+    def wr_reg(self, id, data):
+        self.wr_regs({id: data})
+
+    def rd_reg(self, id):
+        return self.rd_regs([id])[0]
 
     def rd_flush(self):
         i = 0
@@ -558,6 +685,15 @@ class LPGBT(RegParser):
             id = "READOUT_BOARD_%d.LPGBT.UPLINK_0.ALIGN_%d" % (self.rb, link)
         self.kcu.write_node(id, val)
 
+    def set_uplink_alignments(self, alignments):
+        '''
+        Set the uplink alignment of several links with a single dispatch.
+        alignments - dictionary {link: shift}
+        '''
+        with self.kcu.batch():
+            for link, val in alignments.items():
+                self.set_uplink_alignment(link, val, quiet=True)
+
     def get_uplink_alignment(self, link):
         if self.trigger:
             return self.kcu.read_node("READOUT_BOARD_%d.LPGBT.UPLINK_1.ALIGN_%d"%(self.rb, link)).value()
@@ -784,18 +920,18 @@ class LPGBT(RegParser):
     #         self.wr_reg("LPGBT.RWF.EPORTRX.EPRX_CHN_CONTROL.EPRX%dTERM" % i, 1)
 
     def init_adc(self):
-        self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)  # enable ADC
-        self.wr_reg("LPGBT.RW.ADC.TEMPSENSRESET", 0x1)  # resets temp sensor
-        self.wr_reg("LPGBT.RW.ADC.VDDMONENA", 0x1)  # enable dividers
-        self.wr_reg("LPGBT.RW.ADC.VDDTXMONENA", 0x1)  # enable dividers
-        self.wr_reg("LPGBT.RW.ADC.VDDRXMONENA", 0x1)  # enable dividers
-        if self.ver == 0:
-            self.wr_reg("LPGBT.RW.ADC.VDDPSTMONENA", 0x1,)  # enable dividers
-        else:
-            self.wr_reg("LPGBT.RW.ADC.VDDMONENA", 0x1,)  # enable dividers
-        self.wr_reg("LPGBT.RW.ADC.VDDANMONENA", 0x1)  # enable dividers
-        self.wr_reg("LPGBT.RWF.CALIBRATION.VREFENABLE", 0x1)  # vref enable
-        self.wr_reg("LPGBT.RWF.CALIBRATION.VREFTUNE", 0x63)
+        self.wr_regs({
+            "LPGBT.RW.ADC.ADCENABLE": 0x1,  # enable ADC
+            "LPGBT.RW.ADC.TEMPSENSRESET": 0x1,  # resets temp sensor
+            "LPGBT.RW.ADC.VDDMONENA": 0x1,  # enable dividers
+            "LPGBT.RW.ADC.VDDTXMONENA": 0x1,  # enable dividers
+            "LPGBT.RW.ADC.VDDRXMONENA": 0x1,  # enable dividers
+            "LPGBT.RW.ADC.VDDPSTMONENA" if self.ver == 0 else "LPGBT.RW.ADC.VDDMONENA": 0x1,  # enable dividers
+            "LPGBT.RW.ADC.VDDANMONENA": 0x1,  # enable dividers
+            "LPGBT.RWF.CALIBRATION.VREFENABLE": 0x1,  # vref enable
+            "LPGBT.RWF.CALIBRATION.VREFTUNE": 0x63,
+        })
+        self.adc_initialized = True
 
     #def read_adcs(self):
     #    self.init_adc()
@@ -823,38 +959,63 @@ class LPGBT(RegParser):
     #        read = self.read_adc(i)
     #        print("\tch %X: 0x%03X = %f, reading = %f (%s)" % (i, read, read/1024., conv*read/1024., name))
 
-    def read_adcs(self, check=False, strict_limits=False): #read and print all adc values
-        self.init_adc()
+    def sweep_adcs(self, channels=None, n_avg=1, init=False):
+        '''
+        Convert every pin of the configured ADC channels once, and apply the calibration in software.
+        channels - list of channel names in the ADC mapping, all channels by default
+        n_avg - number of conversions that are averaged per pin
+        init - run init_adc also if it has been run before
+        Returns a dictionary of numpy arrays with one entry per channel:
+        name, pin, raw, calibrated, voltage_direct, voltage (single ended channels) and current (differential channels)
+        '''
+        if init or not self.adc_initialized:
+            self.init_adc()
+        if not self.calibrated:
+            self.calibrate_adc()
+
+        adc_dict = self.adc_mapping
+        if channels is None:
+            channels = list(adc_dict.keys())
+
+        differential = np.array([adc_dict[ch].get('differential', False) for ch in channels], dtype=bool)
+        pin_pos = np.array([adc_dict[ch]['pin_pos'] if diff else adc_dict[ch]['pin'] for ch, diff in zip(channels, differential)], dtype=int)
+        pin_neg = np.array([adc_dict[ch]['pin_neg'] if diff else 0 for ch, diff in zip(channels, differential)], dtype=int)
+        conv = np.array([adc_dict[ch]['conv'] for ch in channels], dtype=float)
+
+        # every pin is only converted once, also if it is used by several channels
+        pins = sorted(set(pin_pos) | set(pin_neg[differential]))
+        raw = np.zeros(16, dtype=int if n_avg == 1 else float)
+        raw[pins] = self.read_adc_raws(pins, n_avg=n_avg)
+
+        value_raw = raw[pin_pos] - np.where(differential, raw[pin_neg], 0)
+        value = self.apply_adc_calibration(raw[pin_pos]) - np.where(differential, self.apply_adc_calibration(raw[pin_neg]), 0)
+        voltage_direct = value / (2**10 - 1)
+
+        return {
+            'name': np.array(channels),
+            'pin': np.array([f"{p}-{n}" if diff else str(p) for p, n, diff in zip(pin_pos, pin_neg, differential)]),
+            'raw': value_raw,
+            'calibrated': value,
+            'voltage_direct': voltage_direct,
+            'voltage': np.where(differential, np.nan, voltage_direct * conv),
+            'current': np.where(differential, voltage_direct * conv, np.nan),
+        }
+
+    def read_adcs(self, check=False, strict_limits=False, channels=None, n_avg=1): #read and print all adc values
         adc_dict = self.adc_mapping
         table = []
         will_fail = False
 
-        for adc_reg in adc_dict.keys():
-            ## ----- added here
-            if adc_dict[adc_reg].get('differential', False):
-                pin_pos = adc_dict[adc_reg]['pin_pos']
-                pin_neg = adc_dict[adc_reg]['pin_neg']
-                comment = adc_dict[adc_reg]['comment']
-                value = self.read_adc(pin_pos) - self.read_adc(pin_neg)
-                value_raw = self.read_adc(pin_pos, calibrate=False) - self.read_adc(pin_neg, calibrate=False)
-
-                pin_info = f"{pin_pos}-{pin_neg}"
-
-                input_voltage_direct = value / (2**10 - 1)
-                input_voltage = None
-                current_value = input_voltage_direct * adc_dict[adc_reg]['conv']
-            else:
-            ## ----- added done
-                pin = adc_dict[adc_reg]['pin']
-                comment = adc_dict[adc_reg]['comment']
-                value = self.read_adc(pin)
-                value_raw = self.read_adc(pin, calibrate=False)
-                #value_calibrated = value * self.cal_gain / 1.85 + (512 - self.cal_offset)  # FIXME this was applying twice
-                input_voltage_direct = value / (2**10 - 1)
-                input_voltage = input_voltage_direct * adc_dict[adc_reg]['conv']
-
-                pin_info = str(pin)
-                current_value = None
+        res = self.sweep_adcs(channels=channels, n_avg=n_avg)
+        for i in range(len(res['name'])):
+            adc_reg = str(res['name'][i])
+            comment = adc_dict[adc_reg]['comment']
+            pin_info = str(res['pin'][i])
+            value_raw = res['raw'][i].item()
+            value = res['calibrated'][i].item()
+            input_voltage_direct = res['voltage_direct'][i].item()
+            input_voltage = None if np.isnan(res['voltage'][i]) else res['voltage'][i].item()
+            current_value = None if np.isnan(res['current'][i]) else res['current'][i].item()
 
             if check:
                 try:
@@ -945,53 +1106,70 @@ class LPGBT(RegParser):
 
 
     def read_adc_raw (self, channel):
+        return int(self.read_adc_raws([channel])[0])
 
-        self.kcu.toggle_dispatch()
-        self.wr_reg("LPGBT.RW.ADC.ADCINPSELECT", channel)
-        self.wr_reg("LPGBT.RW.ADC.ADCINNSELECT", 0xf)
-
-        self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x1)
-        self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
-        self.kcu.dispatch()
-
-        done = 0
-        while (done==0):
-            #print ("Waiting")
-            done = self.rd_reg("LPGBT.RO.ADC.ADCDONE")
-
-        val = self.rd_reg("LPGBT.RO.ADC.ADCVALUEL")
-        val |= self.rd_reg("LPGBT.RO.ADC.ADCVALUEH") << 8
-
-        self.kcu.toggle_dispatch()
-        self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x0)
-        self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
-        self.kcu.dispatch()
+    def read_adc_raws(self, channels, n_avg=1):
+        '''
+        Convert a list of ADC channels (against VREF/2), n_avg times each.
+        ADCConfig is only read once, every conversion is one write and one fused read of status and value.
+        Returns a numpy array with the raw values, averaged over the n_avg conversions
+        '''
+        sel_p = self.get_node("LPGBT.RW.ADC.ADCINPSELECT")
+        sel_n = self.get_node("LPGBT.RW.ADC.ADCINNSELECT")
+        convert = self.get_node("LPGBT.RW.ADC.ADCCONVERT")
+        enable = self.get_node("LPGBT.RW.ADC.ADCENABLE")
+        done = self.get_node("LPGBT.RO.ADC.ADCDONE")
+        val_l = self.get_node("LPGBT.RO.ADC.ADCVALUEL")
+        val_h = self.get_node("LPGBT.RO.ADC.ADCVALUEH")
+
+        status_adrs = []
+        for node in [done, val_l, val_h]:
+            if node.real_address not in status_adrs:
+                status_adrs.append(node.real_address)
+
+        config = self.rd_adrs([convert.real_address])[0] | enable.mask
+        idle = config & ~convert.mask
+        start = config | convert.mask
+
+        values = np.zeros([len(channels), n_avg])
+        for i, channel in enumerate(channels):
+            select = ((channel << sel_p.lsb_pos) & sel_p.mask) | ((0xf << sel_n.lsb_pos) & sel_n.mask)
+            for j in range(n_avg):
+                # ADCCONVERT has to go back to 0 before the next conversion can be started
+                self.wr_adrs([(convert.real_address, idle), (sel_p.real_address, select), (convert.real_address, start)])
+                while True:
+                    status = dict(zip(status_adrs, self.rd_adrs(status_adrs)))
+                    if status[done.real_address] & done.mask:
+                        break
+                low = (status[val_l.real_address] & val_l.mask) >> val_l.lsb_pos
+                high = (status[val_h.real_address] & val_h.mask) >> val_h.lsb_pos
+                values[i][j] = low | high << 8
+
+        self.wr_adrs([(convert.real_address, idle)])
+
+        return values.mean(axis=1)
 
-        return val
-    
     def read_adc_raw_diff (self, channel):
 
-        self.kcu.toggle_dispatch()
-        self.wr_reg("LPGBT.RW.ADC.ADCINPSELECT", channel)
-        self.wr_reg("LPGBT.RW.ADC.ADCINNSELECT", channel+1)
-        # self.wr_reg("LPGBT.RW.ADC.ADCGAINSELECT", 0x0)
+        with self.kcu.batch():
+            self.wr_reg("LPGBT.RW.ADC.ADCINPSELECT", channel)
+            self.wr_reg("LPGBT.RW.ADC.ADCINNSELECT", channel+1)
+            # self.wr_reg("LPGBT.RW.ADC.ADCGAINSELECT", 0x0)
 
-        self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x1)
-        self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
-        self.kcu.dispatch()
+            self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x1)
+            self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
 
         done = 0
         while (done==0):
             #print ("Waiting")
             done = self.rd_reg("LPGBT.RO.ADC.ADCDONE")
 
-        val = self.rd_reg("LPGBT.RO.ADC.ADCVALUEL")
-        val |= self.rd_reg("LPGBT.RO.ADC.ADCVALUEH") << 8
+        val_l, val_h = self.rd_regs(["LPGBT.RO.ADC.ADCVALUEL", "LPGBT.RO.ADC.ADCVALUEH"])
+        val = val_l | val_h << 8
 
-        self.kcu.toggle_dispatch()
-        self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x0)
-        self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
-        self.kcu.dispatch()
+        with self.kcu.batch():
+            self.wr_reg("LPGBT.RW.ADC.ADCCONVERT", 0x0)
+            self.wr_reg("LPGBT.RW.ADC.ADCENABLE", 0x1)
 
         return val
 
@@ -1330,6 +1508,26 @@ class LPGBT(RegParser):
             pickle.dump(log_dict, open(log_dir + "pattern_checks.p", "wb"))
         return log_dict
 
+    def read_pattern_checker_errors(self, mode='UPCNT', n_links=24):
+        '''
+        Error counts of the pattern checkers of the first n_links channels of both uplinks, read with a single dispatch.
+        Channels that are not enabled in the pattern checker have an error count of 0xFFFFFFFF.
+        Returns {'Link 0': [errors of channel 0, ...], 'Link 1': [...]}
+        '''
+        res = {}
+        with self.kcu.batch():
+            for link in (0, 1):
+                enabled = self.kcu.read_node("READOUT_BOARD_%d.LPGBT.PATTERN_CHECKER.CHECK_%s_EN_%d" % (self.rb, mode, link))
+                errors = []
+                for i in range(n_links):
+                    self.kcu.write_node("READOUT_BOARD_%d.LPGBT.PATTERN_CHECKER.SEL" % (self.rb), link*28+i)
+                    errors.append(self.kcu.read_node("READOUT_BOARD_%d.LPGBT.PATTERN_CHECKER.%s_ERRORS" % (self.rb, mode)))
+                res["Link %d" % link] = (enabled, errors)
+        return {
+            link: [errs.value() if (enabled.value() >> i) & 0x1 else 0xFFFFFFFF for i, errs in enumerate(errors)]
+            for link, (enabled, errors) in res.items()
+        }
+
     def set_uplink_group_data_source(self, type, pattern=0x55555555):
         setting = 0
         if (type == "normal"):
@@ -1376,85 +1574,105 @@ class LPGBT(RegParser):
     def I2C_write_single(self, reg=0x0, val=0, master=2, slave_addr=0x70, freq=2):
         pass
 
+    def get_i2cm_adrs(self, master):
+        '''
+        Addresses of the registers of I2C master <master>, computed once per address table.
+        Returns a dictionary with the addresses of data0, cmd, address, status, read15 and all data registers.
+        The offsets between masters are already included.
+        '''
+        key = (self.address_table, self.ver, master)
+        if key not in i2cm_tables:
+            i2cm0cmd = self.get_node('LPGBT.RW.I2C.I2CM0CMD').real_address
+            i2cm1cmd = self.get_node('LPGBT.RW.I2C.I2CM1CMD').real_address
+            if self.ver == 0:
+                i2cm0status = self.LPGBT_CONST.I2CM0STATUS
+                i2cm1status = self.LPGBT_CONST.I2CM1STATUS
+                i2cm0read15 = self.LPGBT_CONST.I2CM0READ15
+            else:
+                i2cm0status = self.get_node('LPGBT.RO.I2CREAD.I2CM0STATUS').real_address
+                i2cm1status = self.get_node('LPGBT.RO.I2CREAD.I2CM1STATUS').real_address
+                i2cm0read15 = self.get_node("LPGBT.RO.I2CREAD.I2CM0READ.I2CM0READ15").real_address
+
+            offset_wr = master*(i2cm1cmd - i2cm0cmd)  # using the offset trick to switch between masters easily
+            offset_rd = master*(i2cm1status - i2cm0status)
+            i2cm_tables[key] = {
+                'data0': self.get_node('LPGBT.RW.I2C.I2CM0DATA0').real_address + offset_wr,
+                'data': [self.get_node('LPGBT.RW.I2C.I2CM0DATA%d'%i).real_address + offset_wr for i in range(4)],
+                'cmd': i2cm0cmd + offset_wr,
+                'address': self.get_node('LPGBT.RW.I2C.I2CM0ADDRESS').real_address + offset_wr,
+                'status': i2cm0status + offset_rd,
+                'read15': i2cm0read15,
+                'offset_rd': offset_rd,
+            }
+        return i2cm_tables[key]
+
     # def I2C_write(self, reg=0x0, val=10, master=2, slave_addr=0x70, adr_nbytes=2, freq=2, verbose=False, ignore_response=False):
     def I2C_write(self, reg=0x0, val=10, master=0, slave_addr=0x72, adr_nbytes=2, freq=2, verbose=False, ignore_response=False):
         '''
         reg: target register
-        val: has to be a single byte, or a list of single bytes.
+        val: has to be a single byte, or a list of single bytes that are written to consecutive registers.
+             Lists are sent as bursts of up to 16 bytes (including the register address bytes).
         master: lpGBT master (2 by default)
         this function is following https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#example-2-multi-byte-write
         '''
 
-        self.kcu.toggle_dispatch()
+        i2cm = self.get_i2cm_adrs(master)
+        i2cm0data0 = i2cm['data0']
+        i2cm0cmd = i2cm['cmd']
+        i2cm0address = i2cm['address']
+        i2cm0status = i2cm['status']
 
-        i2cm = master
-
-        i2cm1cmd = self.get_node('LPGBT.RW.I2C.I2CM1CMD').real_address
-        i2cm0cmd = self.get_node('LPGBT.RW.I2C.I2CM0CMD').real_address
-
-        # god fucking damnit
-        if self.ver == 0:
-            i2cm1status = self.LPGBT_CONST.I2CM1STATUS
-            i2cm0status = self.LPGBT_CONST.I2CM0STATUS
-        else:
-            i2cm1status = self.get_node('LPGBT.RO.I2CREAD.I2CM1STATUS').real_address
-            i2cm0status = self.get_node('LPGBT.RO.I2CREAD.I2CM0STATUS').real_address
-
-        i2cm0data0 = self.get_node('LPGBT.RW.I2C.I2CM0DATA0').real_address
-        i2cm0cmd = self.get_node('LPGBT.RW.I2C.I2CM0CMD').real_address
-        i2cm0address = self.get_node('LPGBT.RW.I2C.I2CM0ADDRESS').real_address
-
-        OFFSET_WR = i2cm*(i2cm1cmd - i2cm0cmd) #using the offset trick to switch between masters easily
-        OFFSET_RD = i2cm*(i2cm1status - i2cm0status)
-
-        adr_bytes = [ ((reg >> (8*i)) & 0xff) for i in range(adr_nbytes) ]
-
-        if type(val == int):
+        if isinstance(val, (list, tuple)):
+            data_bytes = list(val)
+        elif hasattr(val, '__index__'):
             data_bytes = [val]
-        elif type(val == list):
-            data_bytes = val
         else:
             raise RuntimeError("Data must be an int or list of ints")
 
-        nbytes = len(adr_bytes+data_bytes)
+        max_data = self.I2CM_MAX_BYTES - adr_nbytes
+        for start in range(0, len(data_bytes), max_data):
+            adr_bytes = [ (((reg + start) >> (8*i)) & 0xff) for i in range(adr_nbytes) ]
+            burst = adr_bytes + data_bytes[start:start+max_data]
+            nbytes = len(burst)
 
-        self.wr_adr(
-            i2cm0data0+OFFSET_WR,
-            nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of,
-        )
-        self.wr_adr(
-            i2cm0cmd+OFFSET_WR,
-            self.LPGBT_CONST.I2CM_WRITE_CRA,
-        )
-
-        for i, data_byte in enumerate(adr_bytes+data_bytes):
-            page    = int(i/4)
-            offset  = int(i%4)
-
-            self.wr_adr(
-                i2cm0data0 + OFFSET_WR + offset,
-                data_byte
-            )
-
-            if i%4==3 or i==(nbytes-1):
+            with self.kcu.batch():
                 self.wr_adr(
-                    i2cm0cmd+OFFSET_WR,
-                    self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0+page,
+                    i2cm0data0,
+                    nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of,
+                )
+                self.wr_adr(
+                    i2cm0cmd,
+                    self.LPGBT_CONST.I2CM_WRITE_CRA,
                 )
 
-        self.wr_adr(i2cm0address+OFFSET_WR, slave_addr)# write the address of the follower
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_WRITE_MULTI)# execute write (c)
-
-        self.kcu.dispatch()
-
-        if not ignore_response:
-            status = self.rd_adr(i2cm0status+OFFSET_RD)
-            retries = 0
-            while (status != self.LPGBT_CONST.I2CM_SR_SUCC_bm):
-                status = self.rd_adr(i2cm0status+OFFSET_RD).value()
-                retries += 1
-                if retries > 50:
-                    raise TimeoutError(f"I2C write failed after 50 retries, status={status}")
+                for i, data_byte in enumerate(burst):
+                    page    = int(i/4)
+                    offset  = int(i%4)
+
+                    self.wr_adr(
+                        i2cm0data0 + offset,
+                        data_byte
+                    )
+
+                    if i%4==3 or i==(nbytes-1):
+                        self.wr_adr(
+                            i2cm0cmd,
+                            self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0+page,
+                        )
+
+                self.wr_adr(i2cm0address, slave_addr)# write the address of the follower
+                self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_WRITE_MULTI)# execute write (c)
+
+            # the I2C master has to finish a burst before the next one is loaded,
+            # so only the response to the last burst can be ignored
+            if not ignore_response or start + max_data < len(data_bytes):
+                status = self.rd_adr(i2cm0status)
+                retries = 0
+                while (status != self.LPGBT_CONST.I2CM_SR_SUCC_bm):
+                    status = self.rd_adr(i2cm0status).value()
+                    retries += 1
+                    if retries > 50:
+                        raise TimeoutError(f"I2C write failed after 50 retries, status={status}")
 
     # def I2C_read(self, reg=0x0, master=2, slave_addr=0x71, nbytes=1, adr_nbytes=2, freq=2, verbose=False, timeout=0.1):
     def I2C_read(self, reg=0x0, master=0, slave_addr=0x72, nbytes=1, adr_nbytes=2, freq=2, verbose=False, timeout=0.1):
@@ -1464,73 +1682,55 @@ class LPGBT(RegParser):
         #print("### LPGBT.I2C_read ###")
         #print(f"reg: {reg}, \tmaster: {master}, \tslave_addr: {slave_addr}, \tnbytes: {nbytes}, \tadr_nbytes: {adr_nbytes}, \tfreq: {freq}, \tver: {self.ver}")
 
-        i2cm      = master
-
-        i2cm1cmd = self.get_node('LPGBT.RW.I2C.I2CM1CMD').real_address
-        i2cm0cmd = self.get_node('LPGBT.RW.I2C.I2CM0CMD').real_address
-
-        # debugging
-        #print(f"i2cm1cmd: {i2cm1cmd}, \ti2cm0cmd: {i2cm0cmd}")
-
-        if self.ver == 0:
-            i2cm1status = self.LPGBT_CONST.I2CM1STATUS
-            i2cm0status = self.LPGBT_CONST.I2CM0STATUS
-        else:
-            i2cm1status = self.get_node('LPGBT.RO.I2CREAD.I2CM1STATUS').real_address
-            i2cm0status = self.get_node('LPGBT.RO.I2CREAD.I2CM0STATUS').real_address
-
-        i2cm0data0 = self.get_node('LPGBT.RW.I2C.I2CM0DATA0').real_address
-        i2cm0cmd = self.get_node('LPGBT.RW.I2C.I2CM0CMD').real_address
-        i2cm0address = self.get_node('LPGBT.RW.I2C.I2CM0ADDRESS').real_address
-
-        OFFSET_WR = i2cm*(i2cm1cmd - i2cm0cmd) #using the offset trick to switch between masters easily
-        OFFSET_RD = i2cm*(i2cm1status - i2cm0status)
+        i2cm = self.get_i2cm_adrs(master)
+        i2cm0data0 = i2cm['data0']
+        i2cm0cmd = i2cm['cmd']
+        i2cm0address = i2cm['address']
+        i2cm0status = i2cm['status']
+        OFFSET_RD = i2cm['offset_rd']
 
         # debugging
-        #print(f"i2cm1status: {i2cm1status}, \ti2cm0status: {i2cm0status}, \ti2cm0data0: {i2cm0data0}, \ti2cm0cmd: {i2cm0cmd}, \ti2cm0address: {i2cm0address}, \tOFFSET_WR: {OFFSET_WR}, \tOFFSET_RD: {OFFSET_RD}")
+        #print(f"i2cm0status: {i2cm0status}, \ti2cm0data0: {i2cm0data0}, \ti2cm0cmd: {i2cm0cmd}, \ti2cm0address: {i2cm0address}, \tOFFSET_RD: {OFFSET_RD}")
 
         ################################################################################
         # Write the register address
         ################################################################################
 
-        self.kcu.toggle_dispatch()
-
-        # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-cr-0x0
-        self.wr_adr(i2cm0data0+OFFSET_WR, adr_nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | (freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of))
-        # debugging
-        #print(f"Address: {i2cm0data0+OFFSET_WR}, \tValue: {adr_nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | (freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of)}")
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_WRITE_CRA) #write to config register
-        # debugging
-        #print(f"Address: {i2cm0cmd+OFFSET_WR}, \tValue: {self.LPGBT_CONST.I2CM_WRITE_CRA}")
-
-        # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-w-multi-4byte0-0x8
-        for i in range (adr_nbytes):
-            self.wr_adr(self.get_node("LPGBT.RW.I2C.I2CM0DATA%d"%i).real_address + OFFSET_WR, (reg >> (8*i)) & 0xff )
+        with self.kcu.batch():
+            # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-cr-0x0
+            self.wr_adr(i2cm0data0, adr_nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | (freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of))
             # debugging
-            #print(f"Address: {self.get_node('LPGBT.RW.I2C.I2CM0DATA%d'%i).real_address + OFFSET_WR}, \tValue: {(reg >> (8*i)) & 0xff}, \ti: {i}")
-        # self.wr_adr(self.LPGBT_CONST.I2CM0DATA1 + OFFSET_WR , regh)
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0) # prepare a multi-write
-        # debugging
-        #print(f"Address: {i2cm0cmd+OFFSET_WR}, \tValue: {self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0}")
-
-        # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-multi-0xc
-        self.wr_adr(i2cm0address+OFFSET_WR, slave_addr)
-        # debugging
-        #print(f"Address: {i2cm0address+OFFSET_WR}, \tValue: {slave_addr}")
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_WRITE_MULTI)# execute multi-write
-        # debugging
-        #print(f"Address: {i2cm0cmd+OFFSET_WR}, \tValue: {self.LPGBT_CONST.I2CM_WRITE_MULTI}")
+            #print(f"Address: {i2cm0data0}, \tValue: {adr_nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | (freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of)}")
+            self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_WRITE_CRA) #write to config register
+            # debugging
+            #print(f"Address: {i2cm0cmd}, \tValue: {self.LPGBT_CONST.I2CM_WRITE_CRA}")
+
+            # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-w-multi-4byte0-0x8
+            for i in range (adr_nbytes):
+                self.wr_adr(i2cm['data'][i], (reg >> (8*i)) & 0xff )
+                # debugging
+                #print(f"Address: {i2cm['data'][i]}, \tValue: {(reg >> (8*i)) & 0xff}, \ti: {i}")
+            # self.wr_adr(self.LPGBT_CONST.I2CM0DATA1 + OFFSET_WR , regh)
+            self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0) # prepare a multi-write
+            # debugging
+            #print(f"Address: {i2cm0cmd}, \tValue: {self.LPGBT_CONST.I2CM_W_MULTI_4BYTE0}")
 
-        self.kcu.dispatch()
+            # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-multi-0xc
+            self.wr_adr(i2cm0address, slave_addr)
+            # debugging
+            #print(f"Address: {i2cm0address}, \tValue: {slave_addr}")
+            self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_WRITE_MULTI)# execute multi-write
+            # debugging
+            #print(f"Address: {i2cm0cmd}, \tValue: {self.LPGBT_CONST.I2CM_WRITE_MULTI}")
 
-        status = self.rd_adr(i2cm0status+OFFSET_RD)
+        status = self.rd_adr(i2cm0status)
 
         # debugging
-        #print(f"status: {status}, LPGBT_CONST.I2CM_SR_SUCC_bm: {self.LPGBT_CONST.I2CM_SR_SUCC_bm}, Address: {i2cm0status+OFFSET_RD}")
+        #print(f"status: {status}, LPGBT_CONST.I2CM_SR_SUCC_bm: {self.LPGBT_CONST.I2CM_SR_SUCC_bm}, Address: {i2cm0status}")
 
         retries = 0
         while (status != self.LPGBT_CONST.I2CM_SR_SUCC_bm):
-            status = self.rd_adr(i2cm0status+OFFSET_RD).value()
+            status = self.rd_adr(i2cm0status).value()
             # debugging
             #print(f"Updating status: {status}, retries: {retries}")
             retries += 1
@@ -1541,19 +1741,16 @@ class LPGBT(RegParser):
         # Write the data
         ################################################################################
 
-        self.kcu.toggle_dispatch()
-
-        # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-cr-0x0
-        self.wr_adr(i2cm0data0+OFFSET_WR, nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of)
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_WRITE_CRA) #write to config register
+        with self.kcu.batch():
+            # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-write-cr-0x0
+            self.wr_adr(i2cm0data0, nbytes<<self.LPGBT_CONST.I2CM_CR_NBYTES_of | freq<<self.LPGBT_CONST.I2CM_CR_FREQ_of)
+            self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_WRITE_CRA) #write to config register
 
-        # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-read-multi-0xd
-        self.wr_adr(i2cm0address+OFFSET_WR, slave_addr) #write the address of follower first
-        self.wr_adr(i2cm0cmd+OFFSET_WR, self.LPGBT_CONST.I2CM_READ_MULTI)# execute read
+            # https://lpgbt.web.cern.ch/lpgbt/v0/i2cMasters.html#i2c-read-multi-0xd
+            self.wr_adr(i2cm0address, slave_addr) #write the address of follower first
+            self.wr_adr(i2cm0cmd, self.LPGBT_CONST.I2CM_READ_MULTI)# execute read
 
-        self.kcu.dispatch()
-
-        status = self.rd_adr(i2cm0status+OFFSET_RD)
+        status = self.rd_adr(i2cm0status)
         # print(status)
 
         # debugging
@@ -1561,26 +1758,18 @@ class LPGBT(RegParser):
 
         retries = 0
         while (status != self.LPGBT_CONST.I2CM_SR_SUCC_bm):
-            status = self.rd_adr(i2cm0status+OFFSET_RD).value()
+            status = self.rd_adr(i2cm0status).value()
             retries += 1
             if retries > 50:
                 raise TimeoutError(f"I2C transaction failed after 50 retries because of an issue in reading back the data, status={status}")
 
-        read_values = []
-
-        if self.ver == 0:
-            i2cm0read15 = self.LPGBT_CONST.I2CM0READ15
-        else:
-            i2cm0read15 = self.get_node("LPGBT.RO.I2CREAD.I2CM0READ.I2CM0READ15").real_address
+        i2cm0read15 = i2cm['read15']
 
         # debugging
         #print(f"i2cm0read15: {i2cm0read15}")
 
-        for i in range(0, nbytes):
-            tmp_adr = abs(i-i2cm0read15)+OFFSET_RD
-            # debugging
-            #print(f"tmp_adr: {tmp_adr}, \ttmp_adr_val: {self.rd_adr(tmp_adr).value()}")
-            read_values.append(self.rd_adr(tmp_adr).value())
+        # all data bytes are read with one pipelined read
+        read_values = self.rd_adrs([abs(i-i2cm0read15)+OFFSET_RD for i in range(0, nbytes)])
 
         #read_value = self.rd_adr(self.LPGBT_CONST.I2CM0READ15+OFFSET_RD) # get the read value. this is just the first byte
         if nbytes==1:
@@ -1591,19 +1780,23 @@ class LPGBT(RegParser):
     def program_slave_from_file (self, filename, master=2, slave_addr=0x70):
         if self.verbose:
             print(" > Programming Trigger lpGBT from file.")
+        values = {}
         f = open(filename, "r")
         for line in f:
             adr, data = line.split(" ")
             adr = int(adr)
             wr = int(data.replace("0x",""), 16)
             if (wr != 0):
-                if self.verbose:
-                    print("Writing address: %d, value: 0x%02x" % (adr, wr))
-                self.I2C_write(reg=adr, val=wr, master=master, slave_addr=slave_addr, ignore_response=True)
-                #rd = self.I2C_read(reg=adr, master=master, slave_addr=slave_addr)
-                #if (wr!=rd):
-                #    print("LPGBT readback error 0x%02X != 0x%02X at adr %d" % (wr, rd, adr))
-        self.kcu.dispatch()
+                values[adr] = wr
+        # consecutive registers are written in bursts
+        for adr, data in get_bursts(values):
+            if self.verbose:
+                print("Writing address: %d, values: %s" % (adr, " ".join("0x%02x" % wr for wr in data)))
+            # wait for the status of every burst, the next burst would overwrite the I2C master registers
+            self.I2C_write(reg=adr, val=data, master=master, slave_addr=slave_addr, ignore_response=False)
+            #rd = self.I2C_read(reg=adr, master=master, slave_addr=slave_addr)
+            #if (wr!=rd):
+            #    print("LPGBT readback error 0x%02X != 0x%02X at adr %d" % (wr, rd, adr))
 
     def read_temp_i2c(self):
         res = self.I2C_read(reg=0x0, master=1, slave_addr=0x48, nbytes=2)
@@ -1655,87 +1848,141 @@ class LPGBT(RegParser):
 
         return board_id
 
-    def eyescan(self, end_of_count_sel=7):
+    def eom_counts(self, points, end_of_count_sel=7, timeout=0.1):
+        '''
+        Measure the eye opening monitor counter at a list of (phase, voltage offset) points.
+        Every point costs one write (stop the last measurement, set phase and offset, start)
+        and one fused read of the EOM status and counter.
+        Returns a list of counter values
+        '''
+        sel = self.get_node("LPGBT.RW.EOM.EOMENDOFCOUNTSEL")
+        start = self.get_node("LPGBT.RW.EOM.EOMSTART")
+        enable = self.get_node("LPGBT.RW.EOM.EOMENABLE")
+        phase = self.get_node("LPGBT.RW.EOM.EOMPHASESEL")
+        vof = self.get_node("LPGBT.RW.EOM.EOMVOFSEL")
+        end = self.get_node("LPGBT.RO.EOM.EOMEND")
+        high = self.get_node("LPGBT.RO.EOM.EOMCOUNTERVALUEH")
+        low = self.get_node("LPGBT.RO.EOM.EOMCOUNTERVALUEL")
+
+        # keep all other bits of the configuration registers as they are
+        config, phase_cfg, vof_cfg = self.rd_adrs([start.real_address, phase.real_address, vof.real_address])
+        idle = (config & ~(sel.mask | start.mask)) | ((end_of_count_sel << sel.lsb_pos) & sel.mask) | enable.mask
+        phase_cfg &= ~phase.mask
+        vof_cfg &= ~vof.mask
+        status_adrs = [end.real_address, high.real_address, low.real_address]
+
+        counts = []
+        for x, y in points:
+            self.wr_adrs([
+                (start.real_address, idle),
+                (phase.real_address, phase_cfg | ((x << phase.lsb_pos) & phase.mask)),
+                (vof.real_address, vof_cfg | ((y << vof.lsb_pos) & vof.mask)),
+                (start.real_address, idle | start.mask),
+            ])
+            start_time = time.time()
+            while True:
+                status, value_h, value_l = self.rd_adrs(status_adrs)
+                if status & end.mask:
+                    break
+                if time.time() - start_time > timeout:
+                    raise TimeoutError(f"EOM measurement at phase {x}, voltage offset {y} did not finish")
+            counts.append(((value_h & high.mask) >> high.lsb_pos) << 8 | ((value_l & low.mask) >> low.lsb_pos))
+
+        # deassert eomstart bit
+        self.wr_adrs([(start.real_address, idle)])
+        return counts
 
-        self.wr_reg("LPGBT.RW.EOM.EOMENDOFCOUNTSEL", end_of_count_sel)
-        self.wr_reg("LPGBT.RW.EOM.EOMENABLE", 1)
+    def eyescan(self, end_of_count_sel=7, step=1, threshold=0.05, plot=True, out_dir="eye_scan_results"):
+        '''
+        Scan the eye opening monitor over all sampling phases (x) and comparator voltage offsets (y).
+        step - spacing of the coarse grid. For step > 1, only the coarse grid is measured at first,
+               and only the cells of the grid whose corners differ by more than threshold (fraction of the full range)
+               are measured point by point. The other points are filled with the mean of the corners.
+        The raw counter matrix is written to out_dir before anything is plotted.
+        Returns the counter matrix (voltage offset, phase)
+        '''
+        self.wr_regs({
+            "LPGBT.RW.EOM.EOMENDOFCOUNTSEL": end_of_count_sel,
+            "LPGBT.RW.EOM.EOMENABLE": 1,
+        })
 
         # Equalizer settings
-        self.wr_reg("LPGBT.RWF.EQUALIZER.EQCAP", 0x1)
-        self.wr_reg("LPGBT.RWF.EQUALIZER.EQRES0", 0x1)
-        self.wr_reg("LPGBT.RWF.EQUALIZER.EQRES1", 0x1)
-        self.wr_reg("LPGBT.RWF.EQUALIZER.EQRES2", 0x1)
-        self.wr_reg("LPGBT.RWF.EQUALIZER.EQRES3", 0x1)
-
-        datavalregh    = "LPGBT.RO.EOM.EOMCOUNTERVALUEH"
-        datavalregl    = "LPGBT.RO.EOM.EOMCOUNTERVALUEL"
-        eomphaseselreg = "LPGBT.RW.EOM.EOMPHASESEL"
-        eomstartreg    = "LPGBT.RW.EOM.EOMSTART"
-        eomstatereg    = "LPGBT.RO.EOM.EOMSMSTATE"
-        eombusyreg     = "LPGBT.RO.EOM.EOMBUSY"
-        eomendreg      = "LPGBT.RO.EOM.EOMEND"
-        eomvofsel      = "LPGBT.RW.EOM.EOMVOFSEL"
-
-        cntvalmax = 0
-        cntvalmin = 2**20
+        self.wr_regs({
+            "LPGBT.RWF.EQUALIZER.EQCAP": 0x1,
+            "LPGBT.RWF.EQUALIZER.EQRES0": 0x1,
+            "LPGBT.RWF.EQUALIZER.EQRES1": 0x1,
+            "LPGBT.RWF.EQUALIZER.EQRES2": 0x1,
+            "LPGBT.RWF.EQUALIZER.EQRES3": 0x1,
+        })
 
         ymin=0
         ymax=30
         xmin=0
         xmax=64
 
-        eyeimage = [[0 for x in range(xmin, xmax)] for y in range(ymin, ymax)]
-
-        print("\nRunning eye scan...")
-        for y_axis in range(ymin, ymax):
-
-            # update yaxis
-            self.wr_reg(eomvofsel, y_axis)
-
-            for x_axis in range(xmin, xmax):
+        counts = np.zeros([ymax-ymin, xmax-xmin])
+        measured = np.zeros([ymax-ymin, xmax-xmin], dtype=bool)
 
-                x_axis_wr = x_axis
+        def measure(points):
+            points = [(x, y) for x, y in points if not measured[y-ymin][x-xmin]]
+            for (x, y), count in zip(points, self.eom_counts(points, end_of_count_sel=end_of_count_sel)):
+                counts[y-ymin][x-xmin] = count
+                measured[y-ymin][x-xmin] = True
 
-                # update xaxis
-                self.wr_reg(eomphaseselreg, x_axis_wr)
-
-                # start measurement
-                self.wr_reg(eomstartreg, 0x1)
-
-                countervalue = (self.rd_reg(datavalregh)) << 8 | self.rd_reg(datavalregl)
-                if (countervalue > cntvalmax):
-                    cntvalmax = countervalue
-                if (countervalue < cntvalmin):
-                    cntvalmin = countervalue
-                eyeimage[y_axis][x_axis] = countervalue
-
-                # deassert eomstart bit
-                self.wr_reg(eomstartreg, 0x0)
+        print("\nRunning eye scan...")
+        xs = sorted(set(list(range(xmin, xmax, step)) + [xmax-1]))
+        ys = sorted(set(list(range(ymin, ymax, step)) + [ymax-1]))
+        measure([(x, y) for y in ys for x in xs])
+
+        if step > 1:
+            # refine the cells of the coarse grid that are not flat
+            coarse = counts[np.ix_(np.array(ys)-ymin, np.array(xs)-xmin)]
+            full_range = coarse.max() - coarse.min()
+            for j in range(len(ys)-1):
+                for i in range(len(xs)-1):
+                    corners = coarse[j:j+2, i:i+2]
+                    cell = [(x, y) for y in range(ys[j], ys[j+1]+1) for x in range(xs[i], xs[i+1]+1)]
+                    if corners.max() - corners.min() > threshold * full_range:
+                        measure(cell)
+                    else:
+                        for x, y in cell:
+                            if not measured[y-ymin][x-xmin]:
+                                counts[y-ymin][x-xmin] = corners.mean()
+            print(f"Measured {measured.sum()} of {measured.size} points")
 
+        cntvalmax = counts.max()
+        cntvalmin = counts.min()
         print("Counter value max=%d\n" % cntvalmax)
 
-        # normalize for plotting and save to file
-        normalize = lambda val : int(100*(cntvalmax - val)/(cntvalmax-cntvalmin))
-        eye_scan_data = [[normalize(x) for x in y] for y in eyeimage]
-
-        if not os.path.isdir("eye_scan_results"):
-            os.mkdir("eye_scan_results")
+        # store the raw counters first
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
 
         serialnums = "lpgbt%s_kcu%s" %(self.get_chip_serial(), self.kcu.get_serial())
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = "%s_%s" %(serialnums, timestamp)
 
-        with open("eye_scan_results/%s.json" %filename, "w") as outfile:
-            json.dump(eye_scan_data, outfile)
-        print("Data saved to eye_scan_results/%s.json\n" %filename)
+        with open(f"{out_dir}/{filename}.json", "w") as outfile:
+            json.dump({
+                'counts': counts.tolist(),
+                'measured': measured.tolist(),
+                'end_of_count_sel': end_of_count_sel,
+                'phase': [xmin, xmax],
+                'voltage_offset': [ymin, ymax],
+                'step': step,
+            }, outfile)
+        print(f"Data saved to {out_dir}/{filename}.json\n")
+
+        if not plot:
+            return counts
 
+        # normalize for plotting
+        eye_scan_data = 100*(cntvalmax - counts)/max(cntvalmax-cntvalmin, 1)
 
         import matplotlib.pyplot as plt
         import mplhep as hep
         plt.style.use(hep.style.CMS)
         (fig, axs) = plt.subplots(1, 1, figsize=(10, 8))
-        print ("fig type = " + str(type(fig)))
-        print ("axs type = " + str(type(axs)))
         axs.set_title("LpGBT 2.56 Gbps RX Eye Opening Monitor")
         plot = axs.imshow(eye_scan_data, alpha=0.9, vmin=0, vmax=100, cmap='jet',interpolation="nearest", aspect="auto",extent=[-384.52/2,384.52/2,-0.6,0.6,])
         plt.xlabel('ps')
@@ -1743,8 +1990,8 @@ class LPGBT(RegParser):
         fig.colorbar(plot, ax=axs)
 
         #plt.show()
-        fig.savefig(f'eye_scan_results/{filename}.png')
-        print("Eye diagram saved to eye_scan_results/%s.json\n" %filename)
+        fig.savefig(f'{out_dir}/{filename}.png')
+        print(f"Eye diagram saved to {out_dir}/{filename}.png\n")
 
         # print results to bash
         try:
@@ -1757,7 +2004,7 @@ class LPGBT(RegParser):
 
             for y_axis in range(ymin, ymax):
                 for x_axis in range(xmin, xmax):
-                    printval = int(eyeimage[y_axis][x_axis]/1000)
+                    printval = int(counts[y_axis][x_axis]/1000)
                     sys.stdout.write("%s%01d%s" % (bg(color_scale[printval]), printval, attr('reset')))
                     sys.stdout.flush()
                 sys.stdout.write("\n")
@@ -1765,6 +2012,7 @@ class LPGBT(RegParser):
             print("Need to pip install colored to print out results.")
             print("Eye scan results were still saved and can be plotted.")
 
+        return counts
 
     def get_chip_userid(self):
         return self.rd_reg("LPGBT.RWF.CHIPID.USERID3") << 24 |\
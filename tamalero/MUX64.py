@@ -4,8 +4,6 @@ import time, datetime
 import json
 from tamalero.utils import read_mapping, get_config
 from functools import wraps
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 try:
     from tabulate import tabulate
     has_tabulate = True
@@ -183,35 +181,26 @@ class MUX64:
 
     def monitor_channels(self, channels = ['mod0_a5', 'mod1_a5', 'mod2_a5'], lat = 1.0, time_max = 60.0, plot = True):
         # time is given in seconds
+        # sampling runs through tamalero.Sampler, i.e. in the gaps between DAQ reads of this process
+        from tamalero.Sampler import Sampler, Probe
         self.set_channel_mapping()
         channel_dict = self.channel_mapping
-        mntr = {}
         print(channels)
-        for channel in channels:
-            mntr[channel] = []
-        mntr['time'] = []
-        start_time = time.time()
-        now_time = time.time()
-        while ((now_time - start_time) < time_max):
-            #if (t%(60*5)==0):
-            #    print(f'Monitoring: {t}/{tmax} secs')
-            try:
-                for channel in channels:
-                    pin = channel_dict[channel]['pin']
-                    value = self.read_adc(pin, calibrate=True)
-                    value_raw = self.read_adc(pin, calibrate=False)
-                    voltage = self.read_channel(pin)
-                    voltage_direct = self.read_channel(pin, direct=True)
-                    mntr[channel].append(voltage)
-                mntr['time'].append(datetime.datetime.now().isoformat())
-                time.sleep(lat)
-            except:
-                print("NonValidatedMemory exception: sleeping 0.1 secs...")
-                time.sleep(0.1)
-            now_time = time.time()
+        master = self.LPGBT if self.LPGBT else self.SCA
+        probe = Probe('mux64', lambda: {channel: self.read_channel(channel_dict[channel]['pin']) for channel in channels}, period=lat)
+        sampler = Sampler([probe], kcu=getattr(master, 'kcu', None), buffer_size=(int(time_max/lat)+1)*len(channels))
+        sampler.start()
+        time.sleep(time_max)
+        sampler.stop()
+
+        # all channels are read by the same probe, so they share the time stamps
+        mntr = {channel: sampler.get(f'mux64.{channel}')[1].tolist() for channel in channels}
+        mntr['time'] = [datetime.datetime.fromtimestamp(t).isoformat() for t in sampler.get(f'mux64.{channels[0]}')[0]]
         with open("mux64_mntr_%.2fmin.json".format(time_max/60.0), "w") as f:
             json.dump(mntr, f)
         if plot:
+            import matplotlib.pyplot as plt
+            import matplotlib.dates as mdates
             fig, ax = plt.subplots(figsize=(10, 4))
             plt.title("MUX64 channel monitoring")
             plt.xlabel("Time")
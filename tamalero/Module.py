@@ -7,7 +7,7 @@ from tamalero.Monitoring import Lock
 from time import sleep
 
 class Module:
-    def __init__(self, rb, i=1, strict=False, enable_power_board=False, moduleid=0, poke=False, hard_reset=False, ext_vref=False, verbose=False):
+    def __init__(self, rb, i=1, strict=False, enable_power_board=False, moduleid=0, poke=False, hard_reset=False, ext_vref=False, verbose=False, shadow=False):
         # don't like that this also needs a RB
         # think about a better solution
         self.config = rb.configuration['modules'][i]
@@ -58,6 +58,7 @@ class Module:
                             no_init = poke,
                             hard_reset = hard_reset,
                             no_hard_reset_on_init = (j != 0),
+                            shadow = shadow,
                         ))
                     all_good &= self.ETROCs[-1].get_elink_status(summary=True)
                 except RuntimeError:
@@ -114,11 +115,18 @@ class Module:
         return self.rb.SCA.read_gpio(self.config['power_board'])
 
     def enable_power_board(self):
+        self.invalidate_shadow()
         return self.rb.SCA.set_gpio(self.config['power_board'], 1)
 
     def disable_power_board(self):
+        self.invalidate_shadow()
         return self.rb.SCA.set_gpio(self.config['power_board'], 0)
 
+    def invalidate_shadow(self):
+        # a power cycle loses the configuration of all ETROCs
+        for etroc in getattr(self, 'ETROCs', []):
+            etroc.invalidate_shadow()
+
     def get_power_good(self):
         if self.rb.config.count('modulev0') and self.rb.ver<3:
             return self.rb.SCA.read_gpio(self.config['pgood'])
@@ -0,0 +1,103 @@
+"""
+Memory-mapped reader for the raw .dat files written by the DAQ.
+The files hold pairs of little-endian 32 bit FIFO words, which are merged
+into 64 bit words (40 bit ETROC2 word + meta data) without copying.
+"""
+import os
+import numpy as np
+from tamalero.DataFrame import DataFrame
+
+class RawReader:
+
+    def __init__(self, f_in, version='ETROC2', empty_threshold=2**8):
+        '''
+        f_in - raw output file. Files rotated by StreamWriter (f_in.1, f_in.2, ...) are picked up automatically
+        empty_threshold - merged words with a lower 32 bit word below or equal to this value are treated as empty FIFO entries
+        '''
+        self.files = [f_in]
+        i = 1
+        while os.path.isfile(f"{f_in}.{i}"):
+            self.files.append(f"{f_in}.{i}")
+            i += 1
+        self.empty_threshold = empty_threshold
+
+        data_format = DataFrame(version).format
+        self.header_mask = np.uint64(data_format['identifiers']['header']['mask'])
+        self.header_frame = np.uint64(data_format['identifiers']['header']['frame'])
+        l1counter = data_format['data']['header'].get('l1counter', {'mask': 0, 'shift': 0})
+        self.l1counter_mask = np.uint64(l1counter['mask'])
+
+    def raw(self, i=0):
+        '''
+        32 bit words of the i-th file as a read-only memory map
+        '''
+        return np.memmap(self.files[i], dtype='<u4', mode='r')
+
+    def words(self, i=0):
+        '''
+        Merged 64 bit words of the i-th file, as a zero-copy view of the memory map.
+        An orphan 32 bit word at the end of the file is dropped, empty entries are not removed.
+        '''
+        n_words = os.path.getsize(self.files[i]) // 8
+        if n_words == 0:
+            return np.zeros(0, dtype='<u8')
+        return np.memmap(self.files[i], dtype='<u8', mode='r', shape=(n_words,))
+
+    def clean(self, words):
+        '''
+        Remove empty FIFO entries, same as merge_words
+        '''
+        return words[(words & np.uint64(0xFFFFFFFF)) > self.empty_threshold]
+
+    def merged(self):
+        '''
+        All merged words of all files in memory, with empty entries removed.
+        Only use this for small files, otherwise iterate over chunks.
+        '''
+        return np.concatenate([self.clean(self.words(i)) for i in range(len(self.files))])
+
+    def boundary(self, words):
+        '''
+        Index of the start of the last event in words, or 0 if there is none.
+        Consecutive headers with the same L1A counter (e.g. from different ETROCs) belong to the same event.
+        '''
+        headers = np.flatnonzero((words & self.header_mask) == self.header_frame)
+        if len(headers) == 0:
+            return 0
+        l1counter = words[headers] & self.l1counter_mask
+        new_event = headers[1:][l1counter[1:] != l1counter[:-1]]
+        if len(new_event) > 0:
+            return new_event[-1]
+        return headers[-1]
+
+    def chunks(self, chunk_size=2**20):
+        '''
+        Iterate over the cleaned, merged words of all files in chunks of about chunk_size words.
+        Chunks end at event boundaries, so that every event is contained in exactly one chunk.
+        Only one chunk is held in memory at a time.
+        '''
+        carry = np.zeros(0, dtype='<u8')
+        for i in range(len(self.files)):
+            words = self.words(i)
+            pos = 0
+            while pos < len(words):
+                stop = min(pos + chunk_size, len(words))
+                block = words[pos:stop]
+                if len(carry) > 0:
+                    block = np.concatenate([carry, block])
+                pos = stop
+                if pos < len(words) or i < len(self.files) - 1:
+                    cut = self.boundary(block)
+                    if cut == 0 and len(block) < 4*chunk_size:
+                        # no event boundary yet, keep on reading
+                        carry = np.array(block)
+                        continue
+                    if cut == 0:
+                        cut = len(block)
+                    carry = np.array(block[cut:])
+                    block = block[:cut]
+                else:
+                    carry = np.zeros(0, dtype='<u8')
+                yield self.clean(block)
+        if len(carry) > 0:
+            yield self.clean(carry)
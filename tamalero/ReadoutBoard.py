@@ -1,14 +1,13 @@
 import os
+import numpy as np
 from tamalero.LPGBT import LPGBT
 from tamalero.SCA import SCA
 # from tamalero.MUX64 import MUX64
-from tamalero.utils import get_temp, chunk, get_temp_direct, get_config, load_yaml
+from tamalero.utils import get_temp, chunk, get_temp_direct, get_config, load_yaml, load_alignment_from_file
 from tamalero.VTRX import VTRX
 from tamalero.utils import read_mapping
 from tamalero.colors import red, green
 import time, datetime, json
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 from tamalero.Module import Module
 
 try:
@@ -17,6 +16,14 @@ except ModuleNotFoundError:
     print ("Package `tabulate` not found.")
 
 from time import sleep
+from yaml import dump
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+here = os.path.dirname(os.path.abspath(__file__))
+alignment_cache_dir = os.path.join(here, '..', '.cache', 'alignment')
 
 flavors = {
     'small': 3,
@@ -188,73 +195,144 @@ class ReadoutBoard:
         if self.configured:
             self.ready_led()
         
-    def find_uplink_alignment(self, scan_time=0.01, default=0, data_mode=False, etroc='ETROC1'):  # default scan time of 0.01 is enough
+    def get_alignment_cache_file(self):
+        '''
+        File for the cached uplink alignment of this board.
+        The alignment depends on the board (serial number of the DAQ lpGBT) and the KCU firmware (SHA).
+        Returns None if the board can't be identified.
+        '''
+        try:
+            serial = getattr(self.DAQ_LPGBT, 'chip_serial', None) or self.DAQ_LPGBT.get_chip_serial()
+            fw_sha = self.kcu.get_firmware_sha()
+        except Exception:
+            return None
+        if not serial:
+            return None
+        return os.path.join(alignment_cache_dir, f'rb_{self.rb}_lpgbt_{serial}_fw_{fw_sha}.yaml')
+
+    def probe_uplinks(self, channels, data_mode=False, etroc='ETROC1', scan_time=0.01):
+        '''
+        Check the currently set uplink alignment of several channels.
+        channels - {'Link 0': [channels], 'Link 1': [channels]}
+        data_mode=False: the lpGBTs send a counter, all UPCNT pattern checkers are read in one batch.
+                         The score is 1 if there were no errors, 0 otherwise.
+        data_mode=True: every channel is checked with check_data_integrity, the score is the number of good words.
+                        This still takes one FIFO dump per channel, i.e. 24 per lpGBT and alignment.
+        Returns {link: {channel: score}}
+        '''
+        scores = {link: {} for link in channels}
+        if data_mode:
+            from tamalero.DataFrame import DataFrame
+            df = DataFrame(etroc)  # shared by all channels
+            for link in channels:
+                for channel in channels[link]:
+                    scores[link][channel] = self.check_data_integrity(channel=channel, etroc=etroc, trigger=(link=='Link 1'), df=df)
+        else:
+            self.DAQ_LPGBT.set_uplink_group_data_source("normal")  # actually needed??
+            self.DAQ_LPGBT.set_downlink_data_src('upcnt')
+            self.DAQ_LPGBT.reset_pattern_checkers()
+            sleep(scan_time)
+            errors = self.DAQ_LPGBT.read_pattern_checker_errors(mode='UPCNT')
+            for link in channels:
+                for channel in channels[link]:
+                    scores[link][channel] = int(errors[link][channel] == 0)
+        return scores
+
+    def find_uplink_alignment(self, scan_time=0.01, default=0, data_mode=False, etroc='ETROC1', use_cache=True):  # default scan time of 0.01 is enough
+        '''
+        Scan the alignment (shift) and inversion of the uplink channels of the DAQ (Link 0) and trigger (Link 1) lpGBT.
+        Every shift / inversion is applied to all channels at once, and every channel is resolved independently
+        (see probe_uplinks). Channels are no longer scanned once a good alignment is found, except in data mode,
+        where the alignment with the most good words is used.
+        use_cache - start from the alignment that was stored for this board and firmware (get_alignment_cache_file).
+                    Only channels that fail the verification of the stored alignment are scanned again.
+                    In data mode, channels without a good alignment in the cache are not scanned again,
+                    use use_cache=False to run a full scan (e.g. after connecting new modules).
+        '''
         # TODO: check the FEC mode and set the number of links appropriately
         n_links = 24  #  NOTE: there are 28 e-links if the board is in FEC5 mode, but we are operating in FEC12 where there are only 24
         print ("Scanning for uplink alignment")
         print ("In data mode:", data_mode)
         alignment = {}
         inversion = {} # also scan for inversion
+        score = {}
         # make alignment dict
         for link in ['Link 0', 'Link 1']:
             alignment[link] = {i:default for i in range(n_links)}
             inversion[link] = {i:0x02 for i in range(n_links)}
+            score[link] = {i:0 for i in range(n_links)}
 
-        # TODO: the scan should check the pattern checkers first, and skip the scan for any where the pattern check is already ok
+        lpgbts = {'Link 0': self.DAQ_LPGBT}
+        if self.trigger:
+            lpgbts['Link 1'] = self.TRIG_LPGBT
+        to_scan = {link: list(range(n_links)) for link in lpgbts}
+
+        f_cache = self.get_alignment_cache_file() if use_cache else None
+        if f_cache is not None and os.path.isfile(f_cache):
+            cache = load_alignment_from_file(f_cache)
+            for link, lpgbt in lpgbts.items():
+                cached = cache['daq' if link == 'Link 0' else 'trigger']
+                for channel in range(n_links):
+                    alignment[link][channel] = cached['alignment'][channel]
+                    inversion[link][channel] = cached['inversion'][channel]
+                lpgbt.set_uplink_alignments(alignment[link])
+                for channel in range(n_links):
+                    lpgbt.set_uplink_invert(channel, inversion[link][channel])
+            scores = self.probe_uplinks(to_scan, data_mode=data_mode, etroc=etroc, scan_time=scan_time)
+            for link in lpgbts:
+                cached = cache['daq' if link == 'Link 0' else 'trigger']
+                to_scan[link] = []
+                for channel in range(n_links):
+                    good = scores[link][channel] > (1 if data_mode else 0)
+                    if good:
+                        score[link][channel] = scores[link][channel]
+                    elif channel in cached.get('found', []) or not data_mode:
+                        to_scan[link].append(channel)
+            print ("Loaded uplink alignment from %s, %s channels need to be scanned again"%(f_cache, sum(len(c) for c in to_scan.values())))
 
         # now, scan
-        if data_mode:
-            for channel in range(n_links):
-                res_daq = 0
-                res_trig = 0
-                for inv in [False, True]:
-                    for shift in range(8):
-                        self.DAQ_LPGBT.set_uplink_alignment(channel, shift, quiet=True)
-                        self.DAQ_LPGBT.set_uplink_invert(channel, inv)
-                        tmp = self.check_data_integrity(channel=channel, etroc=etroc, trigger=False)
-                        if tmp>res_daq and tmp>1:  # NOTE: sometimes we find a random good word
-                            print ("Found improved uplink alignment for Link 0, channel %s: %s, inverted: %s"%(channel, shift, inv))
-                            alignment['Link 0'][channel] = shift
-                            inversion['Link 0'][channel] = inv
-                            res_daq = tmp
-                        if self.trigger:
-                            self.TRIG_LPGBT.set_uplink_alignment(channel, shift, quiet=True)
-                            self.TRIG_LPGBT.set_uplink_invert(channel, inv)
-                            tmp = self.check_data_integrity(channel=channel, etroc=etroc, trigger=True)
-                            if tmp>res_trig and tmp>1:  # NOTE: sometimes we find a random good word
-                                print ("Found improved uplink alignment for Link 1, channel %s: %s, inverted: %s"%(channel, shift, inv))
-                                alignment['Link 1'][channel] = shift
-                                inversion['Link 1'][channel] = inv
-                                res_trig = tmp
-        else:
-            for inv in [False, True]:
-                for shift in range(8):
-                    for channel in range(n_links):
-                        self.DAQ_LPGBT.set_uplink_alignment(channel, shift, quiet=True)
-                        self.DAQ_LPGBT.set_uplink_invert(channel, inv)
-                        if self.trigger:
-                            self.TRIG_LPGBT.set_uplink_alignment(channel, shift, quiet=True)
-                            self.TRIG_LPGBT.set_uplink_invert(channel, inv)
-                    self.DAQ_LPGBT.set_uplink_group_data_source("normal")  # actually needed??
-                    self.DAQ_LPGBT.set_downlink_data_src('upcnt')
-                    self.DAQ_LPGBT.reset_pattern_checkers()
-                    sleep(scan_time)
-                    res = self.DAQ_LPGBT.read_pattern_checkers(log_dir=None, quiet=True)
-                    for link in ['Link 0', 'Link 1']:
-                        for channel in range(n_links):
-                            if res[link]['UPCNT'][channel]['error'][0] == 0:
-                                print ("Found uplink alignment for %s, channel %s: %s, inverted: %s"%(link, channel, shift, inv))
-                                alignment[link][channel] = shift
-                                inversion[link][channel] = inv
+        for inv in [False, True]:
+            for shift in range(8):
+                if not any(to_scan.values()):
+                    break
+                for link, lpgbt in lpgbts.items():
+                    lpgbt.set_uplink_alignments({channel: shift for channel in to_scan[link]})
+                    if shift == 0:
+                        for channel in to_scan[link]:
+                            lpgbt.set_uplink_invert(channel, inv)
+                scores = self.probe_uplinks(to_scan, data_mode=data_mode, etroc=etroc, scan_time=scan_time)
+                for link in lpgbts:
+                    for channel in list(to_scan[link]):
+                        tmp = scores[link][channel]
+                        if data_mode and tmp > score[link][channel] and tmp > 1:  # NOTE: sometimes we find a random good word
+                            print ("Found improved uplink alignment for %s, channel %s: %s, inverted: %s"%(link, channel, shift, inv))
+                        elif not data_mode and tmp > 0:
+                            print ("Found uplink alignment for %s, channel %s: %s, inverted: %s"%(link, channel, shift, inv))
+                            to_scan[link].remove(channel)
+                        else:
+                            continue
+                        alignment[link][channel] = shift
+                        inversion[link][channel] = inv
+                        score[link][channel] = tmp
 
         # Reset alignment to default values for the channels where no good alignment has been found
         print ("Now setting uplink alignment to optimal values (default values if no good alignment was found)")
-        for channel in range(n_links):
-            self.DAQ_LPGBT.set_uplink_alignment(channel, alignment['Link 0'][channel], quiet=True)
-            self.DAQ_LPGBT.set_uplink_invert(channel, inversion['Link 0'][channel])
-            if self.trigger:
-                self.TRIG_LPGBT.set_uplink_alignment(channel, alignment['Link 1'][channel], quiet=True)
-                self.TRIG_LPGBT.set_uplink_invert(channel, inversion['Link 1'][channel])
+        for link, lpgbt in lpgbts.items():
+            lpgbt.set_uplink_alignments(alignment[link])
+            for channel in range(n_links):
+                lpgbt.set_uplink_invert(channel, inversion[link][channel])
+
+        if f_cache is not None:
+            cache = {}
+            for link, name in [('Link 0', 'daq'), ('Link 1', 'trigger')]:
+                cache[name] = {
+                    'alignment': alignment[link],
+                    'inversion': {channel: int(inv) for channel, inv in inversion[link].items()},
+                    'found': [channel for channel in range(n_links) if score[link][channel] > 0],
+                }
+            os.makedirs(alignment_cache_dir, exist_ok=True)
+            with open(f_cache, 'w') as f:
+                dump(cache, f, Dumper=Dumper)
 
         return alignment
 
@@ -306,14 +384,16 @@ class ReadoutBoard:
             if err:
                 self.kcu.print_reg(self.kcu.hw.getNode(node), use_color=True, invert=True)
 
-    def check_data_integrity(self, channel=0, etroc='ETROC1', trigger=False):
+    def check_data_integrity(self, channel=0, etroc='ETROC1', trigger=False, df=None):
         '''
         Not sure where this function should live.
         It's not necessarily a part of the RB.
+        df - DataFrame of the etroc version, can be passed to reuse it for many channels
         '''
         from tamalero.FIFO import FIFO
-        from tamalero.DataFrame import DataFrame
-        df = DataFrame(etroc)
+        if df is None:
+            from tamalero.DataFrame import DataFrame
+            df = DataFrame(etroc)
         lpgbt = 1 if trigger else 0
         fifo = FIFO(self, links=[{'elink': channel, 'lpgbt': lpgbt}], ETROC=etroc,)
         fifo.set_trigger(
@@ -328,16 +408,13 @@ class ReadoutBoard:
             data += fifo.giant_dump(3000, align=False, format=False)  # + ['35', '55'] + fifo.giant_dump(3000)
             fifo.reset(l1a=True)
 
-        good_counter = 0
-        for word in data:
-            word_type, _ = df.read(word, quiet=True)
-            if word_type == None:
-                return 0
-            elif word_type in ['header', 'filler']:
-                # ETROC2 data and filler definitions are so weak, it's easy to accidentially find them.
-                good_counter += 1
-
-        return good_counter
+        # all words are identified at once
+        word_types = df.read_many(data)['data_type']
+        if (word_types < 0).any():
+            return 0
+        # ETROC2 data and filler definitions are so weak, it's easy to accidentially find them.
+        good_types = [df.data_types.index(t) for t in ['header', 'filler'] if t in df.data_types]
+        return int(np.isin(word_types, good_types).sum())
 
 
     def get_FEC_error_count(self, quiet=False):
@@ -1,5 +1,14 @@
 import xml.etree.ElementTree as xml
 import os
+import ast
+import pickle
+import hashlib
+
+cache_version = 1  # increase when Node or the layout of the compiled tables changes
+
+# compiled address tables, shared by all RegParsers of the process.
+# keyed by the sha256 of the xml file and the top node name
+compiled_tables = {}
 
 
 class Node:
@@ -44,6 +53,10 @@ class RegParser(object):
 
     # Functions related to parsing registers.xml
     def parse_xml(self, ver=0, address_table='default', top_node_name="LPGBT", verbose=False):
+        '''
+        Load the address table. The parsed table is cached in memory and on disk (next to the xml file),
+        keyed by the hash of the xml file, so that every table is only parsed once.
+        '''
         self.top_node_name = top_node_name
         if address_table == 'default':
             if ver == 0:
@@ -52,12 +65,63 @@ class RegParser(object):
                 self.address_table = os.path.expandvars('$TAMALERO_BASE/address_table/lpgbt_v1.xml')
         else:
             self.address_table = address_table
+
+        with open(self.address_table, 'rb') as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        key = (sha, top_node_name)
+        if key not in compiled_tables:
+            table = self.load_cache(sha)
+            if table is None:
+                table = self.compile_xml(verbose=verbose)
+                self.store_cache(sha, table)
+            compiled_tables[key] = table
+
+        table = compiled_tables[key]
+        self.nodes = table['nodes']
+        self.address_index = table['address_index']
+        self.prefix_index = table['prefix_index']
+        self.containing_cache = {}
+
+    def compile_xml(self, verbose=False):
+        '''
+        Parse the xml file, and index the nodes by name, address and name prefix
+        '''
         if verbose:
             print('Parsing', self.address_table, '...')
-        self.tree = xml.parse(self.address_table)
-        root = self.tree.getroot()[0]
-        self.vars = {}
-        self.make_tree(root, '', 0x0, self.nodes, None, self.vars, False)
+        nodes = {}
+        root = xml.parse(self.address_table).getroot()[0]
+        self.make_tree(root, '', 0x0, nodes, None, {}, False)
+
+        address_index = {}
+        prefix_index = {}
+        for name, node in nodes.items():
+            address_index.setdefault(node.real_address, node)  # first node with this address, like a linear search
+            parts = name.split('.')
+            for i in range(1, len(parts)+1):
+                prefix_index.setdefault('.'.join(parts[:i]), []).append(node)
+        return {'nodes': nodes, 'address_index': address_index, 'prefix_index': prefix_index}
+
+    def get_cache_file(self, sha):
+        base = os.path.splitext(os.path.basename(self.address_table))[0]
+        return os.path.join(os.path.dirname(self.address_table), '.cache', f'{base}_{self.top_node_name}_{sha[:16]}_v{cache_version}.pkl')
+
+    def load_cache(self, sha):
+        try:
+            with open(self.get_cache_file(sha), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def store_cache(self, sha, table):
+        # the cache is optional, e.g. if the address table directory is read-only
+        f_cache = self.get_cache_file(sha)
+        try:
+            os.makedirs(os.path.dirname(f_cache), exist_ok=True)
+            with open(f_cache + '.tmp', 'wb') as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f_cache + '.tmp', f_cache)
+        except (OSError, pickle.PicklingError, RecursionError):
+            pass
 
     def make_tree(self, node, base_name, base_address, nodes, parent_node, vars, is_generated):
         if ((is_generated is None or is_generated is False) and
@@ -83,7 +147,7 @@ class RegParser(object):
         new_node.name = name
         address = base_address
         if node.get('address') is not None:
-            address = base_address + self.parse_int(eval(node.get('address')))
+            address = base_address + self.parse_expression(node.get('address'))
         new_node.address = address
         new_node.real_address = address
         new_node.permission = node.get('permission')
@@ -98,7 +162,7 @@ class RegParser(object):
             new_node.parent = parent_node
             new_node.level = parent_node.level+1
         for child in node:
-            self.make_tree(child, name, address, self.nodes, new_node, vars, False)
+            self.make_tree(child, name, address, nodes, new_node, vars, False)
 
     def dump(self, nMax=99999):
         for i, nodename in enumerate(list(self.nodes.keys())[:nMax]):
@@ -118,32 +182,29 @@ class RegParser(object):
         return thisnode
 
     def get_node_from_address(self, nodeAddress):
-        for key in self.nodes:
-            if self.nodes[key].real_address == nodeAddress:
-                return self.nodes[key]
+        return self.address_index.get(nodeAddress)
 
-    def get_nodes_containing(self, nodeString):
+    def get_nodes_with_prefix(self, prefix):
+        '''
+        All nodes below (and including) the node prefix, e.g. LPGBT.RW.I2C
+        '''
+        return list(self.prefix_index.get(prefix, []))
 
-        nodelist = []
+    def get_nodes_containing(self, nodeString):
 
-        for key in self.nodes:
-            node = self.nodes[key]
-            if (nodeString in node.name):
-                nodelist.append(node)
+        if nodeString not in self.containing_cache:
+            self.containing_cache[nodeString] = [node for node in self.nodes.values() if nodeString in node.name]
+        nodelist = self.containing_cache[nodeString]
 
         if len(nodelist):
-            return nodelist
+            return list(nodelist)
         else:
             return None
 
     def get_regs_containing(self, nodeString):
 
-        nodelist = []
-
-        for key in self.nodes:
-            node = self.nodes[key]
-            if (nodeString in node.name and node.permission is not None and 'r' in node.permission):
-                nodelist.append(node)
+        nodelist = self.get_nodes_containing(nodeString) or []
+        nodelist = [node for node in nodelist if node.permission is not None and 'r' in node.permission]
 
         if len(nodelist):
             return nodelist
@@ -214,6 +275,27 @@ class RegParser(object):
                     return idx
                 idx = idx+1
 
+    def parse_expression(self, s):
+        '''
+        Evaluate the simple arithmetic that is used for addresses in the xml, e.g. 0x0174-0x16f
+        '''
+        def evaluate(node):
+            if isinstance(node, ast.Expression):
+                return evaluate(node.body)
+            if isinstance(node, ast.Constant) and isinstance(node.value, int):
+                return node.value
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+                return -evaluate(node.operand)
+            if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult)):
+                left, right = evaluate(node.left), evaluate(node.right)
+                if isinstance(node.op, ast.Add):
+                    return left + right
+                if isinstance(node.op, ast.Sub):
+                    return left - right
+                return left * right
+            raise ValueError(f"Can't parse address {s}")
+        return evaluate(ast.parse(str(s).strip(), mode='eval'))
+
     def parse_int(self, s):
         if s is None:
             return None
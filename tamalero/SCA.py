@@ -1,5 +1,6 @@
 import os
 import random
+import threading
 from tamalero.utils import read_mapping, get_config
 from functools import wraps
 import time
@@ -128,6 +129,15 @@ def gpio_byname(gpio_func):
 
     return wrapper
 
+def locked(func):
+    # the SC interface handles one SCA command at a time, also if several threads talk to the SCA
+    @wraps(func)
+    def wrapper(sca, *args, **kwargs):
+        with sca.lock:
+            return func(sca, *args, **kwargs)
+
+    return wrapper
+
 class SCA:
 
     def __init__(self, rb=0, flavor='small', ver=0, config='default', poke=False, verbose=False):
@@ -141,6 +151,8 @@ class SCA:
         self.set_gpio_mapping()
         self.verbose = verbose
         self.i2c_enabled = 0
+        self.lock = threading.RLock()
+        self.transid = random.randint(1, 2**8-2)
         if poke:
             self.verbose = False
 
@@ -175,13 +187,35 @@ class SCA:
         channel = (reg >> 8) & 0xFF
         return self.rw_cmd(cmd, channel, data, adr, transid)
 
-    def rw_cmd(self, cmd, channel, data, adr=0x0, transid=0x00, time_out=1.3, verbose=False):
-        """
-        adr = chip address (0x0 by default)
-        """
-        if transid == 0:
-            transid = random.randint(1, 2**8-2)  # transid of 0 or 255 gives error
-
+    def rw_regs(self, regs, time_out=1.3):
+        '''
+        Pipelined version of rw_reg.
+        regs - list of (reg, data)
+        Returns a list of the 32 bit reply data
+        '''
+        return self.rw_cmds([(reg & 0xFF, (reg >> 8) & 0xFF, data) for reg, data in regs], time_out=time_out)
+
+    def next_transid(self):
+        self.transid = self.transid % 254 + 1  # transid of 0 or 255 gives error
+        return self.transid
+
+    def print_errors(self, err):
+        if (err & 0x1):
+            print("SCA Read Error :: Generic Error Flag")
+        if (err & 0x2):
+            print("SCA Read Error :: Invalid Channel Request")
+        if (err & 0x4):
+            print("SCA Read Error :: Invalid Command Request")
+        if (err & 0x8):
+            print("SCA Read Error :: Invalid Transaction Number Request")
+        if (err & 0x10):
+            print("SCA Read Error :: Invalid Length")
+        if (err & 0x20):
+            print("SCA Read Error :: Channel Not Enabled")
+        if (err & 0x40):
+            print("SCA Read Error :: Command In Treatment")
+
+    def queue_command(self, b, transid, cmd, channel, data, adr=0x0):
         # request packet structure
         # sof
         # address : destination packet address (chip id)
@@ -195,25 +229,14 @@ class SCA:
         # }
         # fcs
         # eof
-
-        if verbose:
-            print("SCA r/w:")
-            print(f"transid={transid}, channel={channel}, cmd={cmd}, adr={adr}, data={data}")
-
-
-        self.kcu.toggle_dispatch()
-
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CHANNEL" % self.rb, channel)
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CMD" % self.rb, cmd)
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_ADDRESS" % self.rb, adr)
-    
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_TRANSID" % self.rb, transid)
-    
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_DATA" % self.rb, data)
-        self.kcu.action("READOUT_BOARD_%d.SC.START_COMMAND" % self.rb)
-
-        self.kcu.dispatch()
-    
+        b.write("READOUT_BOARD_%d.SC.TX_CHANNEL" % self.rb, channel)
+        b.write("READOUT_BOARD_%d.SC.TX_CMD" % self.rb, cmd)
+        b.write("READOUT_BOARD_%d.SC.TX_ADDRESS" % self.rb, adr)
+        b.write("READOUT_BOARD_%d.SC.TX_TRANSID" % self.rb, transid)
+        b.write("READOUT_BOARD_%d.SC.TX_DATA" % self.rb, data)
+        b.action("READOUT_BOARD_%d.SC.START_COMMAND" % self.rb)
+
+    def queue_reply(self, b):
         # reply packet structure
         # sof
         # address
@@ -227,62 +250,141 @@ class SCA:
         # }
         # fcs
         # eof
-    
-        # TODO: read reply
-        err = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_ERR" % self.rb).value()  # 8 bit
-        if err > 0:
-            if (err & 0x1):
-                print("SCA Read Error :: Generic Error Flag")
-            if (err & 0x2):
-                print("SCA Read Error :: Invalid Channel Request")
-            if (err & 0x4):
-                print("SCA Read Error :: Invalid Command Request")
-            if (err & 0x8):
-                print("SCA Read Error :: Invalid Transaction Number Request")
-            if (err & 0x10):
-                print("SCA Read Error :: Invalid Length")
-            if (err & 0x20):
-                print("SCA Read Error :: Channel Not Enabled")
-            if (err & 0x40):
-                print("SCA Read Error :: Command In Treatment")
-
-        self.kcu.toggle_dispatch()
-        rx_rec  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_RECEIVED" % self.rb)  # flag pulse
-        rx_ch   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CHANNEL" % self.rb)  # channel reply
-        rx_len  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_LEN" % self.rb)
-        rx_ad   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_ADDRESS" % self.rb)
-        rx_ctrl = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CONTROL" % self.rb)
-        self.kcu.dispatch()
-
-        # dispatch and get the read values
-        rx_rec  = rx_rec.value()  # flag pulse
-        rx_ch   = rx_ch.value()  # channel reply
-        rx_len  = rx_len.value()
-        rx_ad   = rx_ad.value()
-        rx_ctrl = rx_ctrl.value()
-
-        if verbose:
-            print(f"Received: err={err}, rx_rec={rx_rec}, rx_ch={rx_ch}, rx_len={rx_len}, rx_ad={rx_ad}, rx_ctrl={rx_ctrl}")
-
-        # NOTE I2C transaction can be slow, so try reading the transid several times before it times out
+        return (
+            b.read("READOUT_BOARD_%d.SC.RX.RX_TRANSID" % self.rb),
+            b.read("READOUT_BOARD_%d.SC.RX.RX_ERR" % self.rb),  # 8 bit
+            b.read("READOUT_BOARD_%d.SC.RX.RX_CHANNEL" % self.rb),
+            b.read("READOUT_BOARD_%d.SC.RX.RX_DATA" % self.rb),  # 32 bit read data
+        )
+
+    def wait_reply(self, transids, time_out=1.3, verbose=False):
+        '''
+        Read the reply register until it holds the reply of one of the transaction IDs in transids.
+        Returns transid, error flags, channel and data of the reply.
+        '''
         start_time = time.time()
-        while not transid == self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_TRANSID" % self.rb):
-            self.kcu.write_node("READOUT_BOARD_%d.SC.RX_RESET" % self.rb, 0x01)
-            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_RESET" % self.rb, 0x01)
+        while True:
+            with self.kcu.batch() as b:
+                reply = self.queue_reply(b)
+            transid, err, channel = (x.value() for x in reply[:3])
+            if transid in transids:
+                if verbose:
+                    print(f"Received: transid={transid}, err={err}, rx_ch={channel}, data={reply[3].value()}")
+                return transid, err, channel, reply[3]
             if time.time() - start_time > time_out:
                 if verbose:
-                    print(f"data: {self.kcu.read_node('READOUT_BOARD_%d.SC.RX.RX_DATA' % self.rb)}")
+                    print(f"data: {reply[3].value()}")
                     print("SCA Read Error :: Transaction ID Does Not Match")
                     print("SCA Read Error :: Resetting RX/TX")
+                with self.kcu.batch() as b:
+                    b.write("READOUT_BOARD_%d.SC.RX_RESET" % self.rb, 0x01)
+                    b.write("READOUT_BOARD_%d.SC.TX_RESET" % self.rb, 0x01)
                 raise TimeoutError("SCA Error :: Transaction timed out.")
 
-        return self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_DATA" % self.rb)  # 32 bit read data
+    @locked
+    def rw_cmd(self, cmd, channel, data, adr=0x0, transid=0x00, time_out=1.3, verbose=False):
+        """
+        adr = chip address (0x0 by default)
+        """
+        if transid == 0:
+            transid = self.next_transid()
+
+        if verbose:
+            print("SCA r/w:")
+            print(f"transid={transid}, channel={channel}, cmd={cmd}, adr={adr}, data={data}")
+
+        # NOTE I2C transaction can be slow, so try reading the transid several times before it times out
+        start_time = time.time()
+        while True:
+            with self.kcu.batch() as b:
+                self.queue_command(b, transid, cmd, channel, data, adr)
+            transid, err, rx_ch, rx_data = self.wait_reply([transid], time_out=time_out, verbose=verbose)
+            if not (err & 0x40) or time.time() - start_time > time_out:
+                break
+            # the channel was still busy with an earlier command, send it again
+            transid = self.next_transid()
+
+        if err > 0:
+            self.print_errors(err)
+
+        return rx_data
+
+    @locked
+    def rw_cmds(self, commands, time_out=1.3, verbose=False):
+        '''
+        Pipelined version of rw_cmd.
+        commands - list of (cmd, channel, data) or (cmd, channel, data, adr)
+        Returns a list of the 32 bit reply data.
+        Every command gets its own transaction ID, and the reply of one command is read
+        in the same dispatch that sends the next one. Replies are matched by transaction ID.
+        The firmware only keeps the last reply, so if a reply was not there in time (e.g. slow I2C transactions)
+        the two commands in flight are sent again one at a time. Only use this for commands that can be repeated.
+        '''
+        commands = [tuple(command) for command in commands]
+        transids = [self.next_transid() for command in commands]
+        replies = [None]*len(commands)
+
+        prev = None  # command that was sent, but whose reply has not been seen yet
+        i = 0
+        while i < len(commands) or prev is not None:
+            with self.kcu.batch() as b:
+                reply = self.queue_reply(b) if prev is not None else None
+                if i < len(commands):
+                    self.queue_command(b, transids[i], *commands[i])
+            sent = i if i < len(commands) else None
+            i += 1
+            if prev is None:
+                prev = sent
+                continue
+
+            transid, err, rx_ch = (x.value() for x in reply[:3])
+            rx_data = reply[3]
+            missed = transid != transids[prev]
+            if missed:
+                expected = [transids[prev]] if sent is None else [transids[prev], transids[sent]]
+                transid, err, rx_ch, rx_data = self.wait_reply(expected, time_out=time_out, verbose=verbose)
+                if sent is not None and transid == transids[sent] and err & 0x40:
+                    # sent was rejected while prev was still running, the reply of prev is still to come
+                    try:
+                        transid, err, rx_ch, rx_data = self.wait_reply([transids[prev]], time_out=time_out, verbose=verbose)
+                    except TimeoutError:
+                        pass  # the reply of prev got lost as well, both are repeated below
+
+            if transid != transids[prev] or err & 0x40:
+                # reply got lost, or the channel was still busy: fall back to one command at a time
+                if verbose:
+                    print(f"SCA pipeline :: repeating transactions {transids[prev]} and {transids[sent] if sent is not None else ''}")
+                if not missed and sent is not None:
+                    # the reply of sent comes after the one of prev that was just read, so it can't be lost
+                    self.wait_reply([transids[sent]], time_out=time_out, verbose=verbose)
+                replies[prev] = self.rw_cmd(*commands[prev], time_out=time_out, verbose=verbose)
+                if sent is not None:
+                    replies[sent] = self.rw_cmd(*commands[sent], time_out=time_out, verbose=verbose)
+                prev = None
+                continue
+
+            if err > 0:
+                self.print_errors(err)
+            replies[prev] = rx_data
+            if missed and sent is not None:
+                # sent went out while prev was still executing, and its reply (e.g. a busy error)
+                # may have been overwritten by the one of prev already: don't wait for it, send it again
+                if verbose:
+                    print(f"SCA pipeline :: repeating transaction {transids[sent]}")
+                replies[sent] = self.rw_cmd(*commands[sent], time_out=time_out, verbose=verbose)
+                prev = None
+                continue
+            prev = sent
+
+        return replies
 
     def read_control_registers(self, verbose=False):
         # don't need to read CRC
-        crb_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRB) >> 24
-        crc_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRC) >> 24
-        crd_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRD) >> 24
+        crb_rd, crc_rd, crd_rd = (x.value() >> 24 for x in self.rw_regs([
+            (SCA_CONTROL.CTRL_R_CRB, 0x0),
+            (SCA_CONTROL.CTRL_R_CRC, 0x0),
+            (SCA_CONTROL.CTRL_R_CRD, 0x0),
+        ]))
 
         en_gpio = (crb_rd >> SCA_CRB.ENGPIO) & 1
         en_spi = (crb_rd >> SCA_CRB.ENSPI) & 1
@@ -307,6 +409,7 @@ class SCA:
         else:
             raise RuntimeError(f"SCA only has 16 I2C channels, don't know what to do with channel {channel}")
 
+    @locked
     def enable_I2C(self, channel=0):
         '''
         just enable a single i2c channel
@@ -348,9 +451,11 @@ class SCA:
         crd |= ENI2CE << SCA_CRD.ENI2CE
         crd |= ENI2CF << SCA_CRD.ENI2CF
 
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRB, crb << 24)
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRC, crc << 24)
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRD, crd << 24)
+        self.rw_regs([
+            (SCA_CONTROL.CTRL_W_CRB, crb << 24),
+            (SCA_CONTROL.CTRL_W_CRC, crc << 24),
+            (SCA_CONTROL.CTRL_W_CRD, crd << 24),
+        ])
 
         self.i2c_enabled = self.i2c_enabled | ( 1 << channel )
 
@@ -419,13 +524,14 @@ class SCA:
         crd |= en_adc << SCA_CRD.ENADC
         crd |= en_dac << SCA_CRD.ENDAC
 
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRB, crb << 24)
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRC, crc << 24)
-        self.rw_reg(SCA_CONTROL.CTRL_W_CRD, crd << 24)
-    
-        crb_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRB) >> 24
-        crc_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRC) >> 24
-        crd_rd = self.rw_reg(SCA_CONTROL.CTRL_R_CRD) >> 24
+        crb_rd, crc_rd, crd_rd = (x.value() >> 24 for x in self.rw_regs([
+            (SCA_CONTROL.CTRL_W_CRB, crb << 24),
+            (SCA_CONTROL.CTRL_W_CRC, crc << 24),
+            (SCA_CONTROL.CTRL_W_CRD, crd << 24),
+            (SCA_CONTROL.CTRL_R_CRB, 0x0),
+            (SCA_CONTROL.CTRL_R_CRC, 0x0),
+            (SCA_CONTROL.CTRL_R_CRD, 0x0),
+        ])[3:])
     
         if (crb != crb_rd or crc != crc_rd or crd != crd_rd):
             print("SCA Control Register Readback Error, Not configured Correctly")
@@ -460,20 +566,30 @@ class SCA:
             if not raw:
                 conv = self.adc_mapping[pin]['conv'] / (2**12 - 1)
             pin = self.adc_mapping[pin]['pin']
-        self.enable_adc() #enable ADC
-        self.rw_reg(SCA_ADC.ADC_W_MUX, pin) #configure register we want to read
-        val = self.rw_reg(SCA_ADC.ADC_GO, 0x01).value() #execute and read ADC_GO command
-        self.rw_reg(SCA_ADC.ADC_W_MUX, 0x0) #reset register to default (0)
+        val = self.read_adc_pins([pin])[0]
         return val*conv
 
+    def read_adc_pins(self, pins):
+        '''
+        Read the raw ADC values of a list of pins, with one pipelined sequence of SCA commands
+        '''
+        self.enable_adc() #enable ADC
+        regs = []
+        for pin in pins:
+            regs.append((SCA_ADC.ADC_W_MUX, pin)) #configure register we want to read
+            regs.append((SCA_ADC.ADC_GO, 0x01)) #execute and read ADC_GO command
+        regs.append((SCA_ADC.ADC_W_MUX, 0x0)) #reset register to default (0)
+        res = self.rw_regs(regs)
+        return [res[2*i+1].value() for i in range(len(pins))]
+
     def read_adcs(self, check=False, strict_limits=False): #read and print all adc values
         adc_dict = self.adc_mapping
         table=[]
         will_fail = False
-        for adc_reg in adc_dict.keys():
+        values = self.read_adc_pins([adc_dict[adc_reg]['pin'] for adc_reg in adc_dict.keys()])
+        for adc_reg, value in zip(adc_dict.keys(), values):
             pin = adc_dict[adc_reg]['pin']
             comment = adc_dict[adc_reg]['comment']
-            value = self.read_adc(pin)
             input_voltage = value / (2**12 - 1) * adc_dict[adc_reg]['conv']
             if check:
                 try:
@@ -557,16 +673,36 @@ class SCA:
         gpio_dict = self.gpio_mapping
         if verbose:
             print("Configuring SCA GPIO Pins...")
+        self.enable_gpio()  # enable GPIO
+        dataout, direction = (x.value() for x in self.rw_regs([
+            (SCA_GPIO.GPIO_R_DATAOUT, 0x0),
+            (SCA_GPIO.GPIO_R_DIRECTION, 0x0),
+        ]))
         for gpio_reg in gpio_dict.keys():
             pin         = gpio_dict[gpio_reg]['pin']
-            direction   = int(gpio_dict[gpio_reg]['direction'] == 'out')
+            output      = gpio_dict[gpio_reg]['direction'] == 'out'
             comment     = gpio_dict[gpio_reg]['comment']
             default     = gpio_dict[gpio_reg]['default']
             if self.verbose:
                 print("Setting SCA GPIO pin %s (%s) to %s with value %s"%(pin, comment, gpio_dict[gpio_reg]['direction'], default))
-            self.set_gpio(pin, default)  # NOTE this is important because otherwise the GPIO pin can be set to a false default value when switched to output
-            self.set_gpio_direction(pin, direction)
-            if not self.read_gpio(pin) == default:
+            if default == 1:
+                dataout |= (1 << pin)
+            elif default == 0:
+                dataout &= ~(1 << pin)
+            if output:
+                direction |= (1 << pin)
+            else:
+                direction &= ~(1 << pin)
+        # NOTE the defaults are written first, because otherwise the GPIO pin can be set to a false default value when switched to output
+        datain = self.rw_regs([
+            (SCA_GPIO.GPIO_W_DATAOUT, dataout),
+            (SCA_GPIO.GPIO_W_DIRECTION, direction),
+            (SCA_GPIO.GPIO_R_DATAIN, 0x0),
+        ])[2].value()
+        for gpio_reg in gpio_dict.keys():
+            pin         = gpio_dict[gpio_reg]['pin']
+            default     = gpio_dict[gpio_reg]['default']
+            if not ((datain >> pin) & 1) == default:
                 self.set_gpio(pin, default)  # redundant but keep it
 
     def get_I2C_channel(self, channel):
@@ -576,6 +712,7 @@ class SCA:
         else:
             raise RuntimeError(f"SCA only has 16 I2C channels, don't know what to do with channel {channel}")
 
+    @locked
     def I2C_write(self, reg=0x0, val=0x0, master=3, slave_addr=0x48, adr_nbytes=2, freq=2):
         # wrapper function to have similar interface as lpGBT I2C_write
         self.enable_I2C(channel=master)
@@ -588,6 +725,7 @@ class SCA:
             raise("data must be an int or list of ints")
         self.I2C_write_multi(adr_bytes + data_bytes, channel=master, servant=slave_addr, freq=freq)
 
+    @locked
     def I2C_read(self, reg=0x0, master=3, slave_addr=0x48, nbytes=1, adr_nbytes=2, freq=2, timeout=0.1):
         # wrapper function to have similar interface as lpGBT I2C_read
         if nbytes > 1 or adr_nbytes>1:
@@ -662,37 +800,63 @@ class SCA:
         res = self.rw_cmd(SCA_I2C.I2C_R_CTRL, self.get_I2C_channel(channel), 0x0).value()
         return res >> 24
 
+    def get_I2C_write_cmds(self, data, channel, servant, freq=2):
+        '''
+        SCA commands of a multi-byte I2C write: configure NBYTES, fill the data registers and execute I2C_M_7B_W
+        '''
+        nbytes = len(data)
+        i2c_channel = self.get_I2C_channel(channel)
+        #configure NBYTES in the control register
+        cmds = [(SCA_I2C.I2C_W_CTRL, i2c_channel, (nbytes<<2 | freq) << 24)]
+        #begin writing to the data registers [I2C_W_DATA0, I2C_W_DATA1, I2C_W_DATA2, I2C_W_DATA3]
+        data_registers = [SCA_I2C.I2C_W_DATA0 + SCA_I2C.I2C_RW_DATA_OFFSET * n for n in range(((nbytes-1)//4) + 1)]
+        for page in range(((nbytes-1)//4) + 1):
+            cmd_val = 0x0
+            for byte in range(4):
+                if (byte + (4 * page)) < nbytes:
+                    write_byte = data[byte + (4*page)] << (8 * (3 - byte))
+                    cmd_val = cmd_val + write_byte #append the data byte to the correct position in the command value
+            cmds.append((data_registers[page], i2c_channel, cmd_val))
+        #once data registers are filled, execute I2C_M_7B_W
+        cmds.append((SCA_I2C.I2C_M_7B_W, i2c_channel, servant<<24))
+        return cmds
+
     def I2C_read_multi(self, channel=3, servant=0x48, nbytes=1, reg=0x0, adr_nbytes=2, freq=2):
         adr_bytes = [ ((reg >> (8*i)) & 0xff) for i in range(adr_nbytes) ]
         #enable channel
         if (self.i2c_enabled & (1<<channel)) == 0:
             self.enable_I2C(channel=channel)
 
-        #configure NBYTES in the control register
-        self.I2C_write_ctrl(channel, nbytes<<2 | freq)
+        i2c_channel = self.get_I2C_channel(channel)
         # write to the pointer reg
-        self.I2C_write_multi(adr_bytes, channel, servant)
-        #self.I2C_write_single_byte(channel=channel, servant=servant, data=reg)
-        #multi-byte read
-        start_time = time.time()
-        cmd_res = self.rw_cmd(SCA_I2C.I2C_M_7B_R, self.get_I2C_channel(channel), (servant<<24)).value()
-        status = cmd_res >> 24
-        success = status & 4
-        while not success:
-            cmd_res = self.rw_cmd(SCA_I2C.I2C_M_7B_R, self.get_I2C_channel(channel), (servant<<24)).value()
-            status = cmd_res >> 24
-            success = status & 4
-            if time.time() - start_time > 0.1:
-                raise TimeoutError("I2C_M_7B_R not successful, status = {}".format(status))
-
+        cmds = self.get_I2C_write_cmds(adr_bytes, channel, servant, freq=freq)
+        i_write = len(cmds) - 1
+        #configure NBYTES in the control register, and do the multi-byte read
+        cmds.append((SCA_I2C.I2C_W_CTRL, i2c_channel, (nbytes<<2 | freq) << 24))
+        cmds.append((SCA_I2C.I2C_M_7B_R, i2c_channel, servant<<24))
+        i_read = len(cmds) - 1
         #read data register
         #we are counting backwards because we need to call I2C_R_DATA3 to get data bytes 0, 1, 2, 3, and so on.
         #[I2C_R_DATA3, I2C_R_DATA2, I2C_R_DATA1, I2C_R_DATA0]
         data_registers = [SCA_I2C.I2C_R_DATA3 - SCA_I2C.I2C_RW_DATA_OFFSET * n for n in range(((nbytes-1)//4) + 1)]
-        out_bytes = []
+        for page in range((((nbytes-1)//4) + 1)):
+            cmds.append((data_registers[page], i2c_channel, 0x0))
+
+        # all commands are sent as one pipelined sequence, repeated until the I2C transactions succeed
+        start_time = time.time()
+        while True:
+            res = self.rw_cmds(cmds)
+            status = res[i_write].value() >> 24
+            if status & 4:
+                status = res[i_read].value() >> 24
+                if status & 4:
+                    break
+            if time.time() - start_time > 0.1:
+                raise TimeoutError("I2C_M_7B_R not successful, status = {}".format(status))
 
+        out_bytes = []
         for page in range((((nbytes-1)//4) + 1)):
-            page_value = self.rw_cmd(data_registers[page], self.get_I2C_channel(channel), 0x0).value() #execute I2C_R_DATA[3,2,1,0]
+            page_value = res[i_read + 1 + page].value()
             for byte in range(4):
                 if (byte + 4*page) < nbytes:
                     mask = 255 << (8 * (3 - byte))
@@ -707,30 +871,16 @@ class SCA:
     def I2C_write_multi(self, data, channel=3, servant=0x48, freq=2):
         if not type(data) == list:
             data = [data]
-        nbytes = len(data)
         #enable channel
         if (self.i2c_enabled & (1<<channel)) == 0:
             self.enable_I2C(channel=channel)
-        #configure NBYTES in the control register
-        self.I2C_write_ctrl(channel, nbytes<<2 | freq)
-        #begin writing to the data registers [I2C_W_DATA0, I2C_W_DATA1, I2C_W_DATA2, I2C_W_DATA3]
-        data_registers = [SCA_I2C.I2C_W_DATA0 + SCA_I2C.I2C_RW_DATA_OFFSET * n for n in range(((nbytes-1)//4) + 1)]
-        for page in range(((nbytes-1)//4) + 1):
-            cmd_val = 0x0
-            for byte in range(4):
-                if (byte + (4 * page)) < nbytes:
-                    write_byte = data[byte + (4*page)] << (8 * (3 - byte))
-                    cmd_val = cmd_val + write_byte #append the data byte to the correct position in the command value
-            self.rw_cmd(data_registers[page], self.get_I2C_channel(channel), cmd_val)
-
-        #once data registers are filled, execute I2C_M_7B_W
+        cmds = self.get_I2C_write_cmds(data, channel, servant, freq=freq)
         start_time = time.time()
-        data_field = (servant<<24)
-        cmd_res = self.rw_cmd(SCA_I2C.I2C_M_7B_W, self.get_I2C_channel(channel), data_field).value()
+        cmd_res = self.rw_cmds(cmds)[-1].value()
         status = cmd_res >> 24
         success = status & 4
         while not success:
-            cmd_res = self.rw_cmd(SCA_I2C.I2C_M_7B_W, self.get_I2C_channel(channel), data_field).value()
+            cmd_res = self.rw_cmd(*cmds[-1]).value()
             status = cmd_res >> 24
             success = status & 4
             if time.time() - start_time > 0.3:
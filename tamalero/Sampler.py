@@ -0,0 +1,304 @@
+"""
+Environmental monitoring with a single sampler thread.
+Probes are declared as a list (e.g. from yaml), each with its own sampling period.
+Every probe gets the IPbus link through the LinkArbiter of the KCU, i.e. in the gaps between DAQ reads,
+so that monitoring can keep running during data taking. The sampler has to run in the process
+that takes the data, e.g. with daq.py --monitor.
+Samples are kept in a fixed-size ring buffer, and appended to a compact binary file.
+"""
+import os
+import time
+import heapq
+import threading
+import numpy as np
+from yaml import load, dump
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+# one record per sampled value, 14 bytes
+sample_dtype = np.dtype([('time', '<f8'), ('id', '<u2'), ('value', '<f4')])
+
+# default probes of a readout board, see rb_sampler
+default_probes = [
+    {'name': 'lpgbt_adc', 'method': 'DAQ_LPGBT.sweep_adcs', 'period': 10, 'key': 'name', 'fields': ['voltage', 'current']},
+    {'name': 'temp', 'method': 'read_temp', 'period': 30},
+]
+
+def flatten(name, value, key=None, fields=None):
+    '''
+    Turn the result of a probe into {name: float}.
+    Dictionaries and lists are flattened into name.key / name.index, non-numeric values and NaN are dropped.
+    key, fields - for tables (dictionary of arrays, e.g. LPGBT.sweep_adcs) the rows are named by the column key,
+                  and only the given fields are kept (all by default)
+    '''
+    if value is None or isinstance(value, str):
+        return {}
+    if isinstance(value, dict):
+        res = {}
+        if key is not None and key in value:
+            fields = [f for f in value if f != key] if fields is None else fields
+            for i, row in enumerate(value[key]):
+                for field in fields:
+                    res.update(flatten(f"{name}.{row}.{field}", value[field][i]))
+        else:
+            for k, v in value.items():
+                res.update(flatten(f"{name}.{k}", v))
+        return res
+    if isinstance(value, (list, tuple, np.ndarray)):
+        res = {}
+        for i, v in enumerate(value):
+            res.update(flatten(f"{name}.{i}", v))
+        return res
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return {}
+    return {} if np.isnan(value) else {name: value}
+
+
+class Probe:
+
+    def __init__(self, name, fun, period=10, args=(), kwargs={}, key=None, fields=None):
+        '''
+        name - name of the probe, values are stored as name or name.<key> (see flatten)
+        fun - function returning a number, or a (nested) dictionary / list of numbers
+        period - time in s between two samples
+        args, kwargs - passed to fun
+        key, fields - see flatten
+        '''
+        self.name = name
+        self.fun = fun
+        self.period = period
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.fields = fields
+
+    @classmethod
+    def from_config(cls, config, obj):
+        '''
+        Probe from a dictionary like
+            {'name': 'lpgbt_adc', 'method': 'DAQ_LPGBT.sweep_adcs', 'period': 10, 'kwargs': {'n_avg': 2}}
+        method is looked up as an attribute of obj, e.g. a ReadoutBoard.
+        '''
+        fun = obj
+        for attr in config['method'].split('.'):
+            fun = getattr(fun, attr)
+        return cls(
+            config['name'],
+            fun,
+            period = config.get('period', 10),
+            args = config.get('args', ()),
+            kwargs = config.get('kwargs', {}),
+            key = config.get('key', None),
+            fields = config.get('fields', None),
+        )
+
+    def sample(self):
+        return flatten(self.name, self.fun(*self.args, **self.kwargs), key=self.key, fields=self.fields)
+
+
+class RingBuffer:
+
+    def __init__(self, size=100000):
+        '''
+        Fixed-size in-memory buffer of the latest samples, old samples are overwritten.
+        size - number of samples
+        '''
+        self.size = size
+        self.data = np.zeros(size, dtype=sample_dtype)
+        self.n = 0  # total number of samples ever added
+        self.lock = threading.Lock()
+
+    def append(self, records):
+        records = records[-self.size:]
+        with self.lock:
+            start = self.n % self.size
+            n_end = min(len(records), self.size - start)
+            self.data[start:start+n_end] = records[:n_end]
+            self.data[:len(records)-n_end] = records[n_end:]
+            self.n += len(records)
+
+    def get(self, ids=None):
+        '''
+        Samples that are in the buffer in chronological order, optionally only of the given channel ids
+        '''
+        with self.lock:
+            if self.n <= self.size:
+                data = self.data[:self.n].copy()
+            else:
+                start = self.n % self.size
+                data = np.concatenate([self.data[start:], self.data[:start]])
+        if ids is not None:
+            data = data[np.isin(data['id'], ids)]
+        return data
+
+
+class SampleWriter:
+
+    def __init__(self, f_out, fsync=False):
+        '''
+        Append-only binary file of samples, little-endian records of time (f8), channel id (u2) and value (f4).
+        Channel names are stored in f_out.yaml, an existing file is continued with the same channel ids.
+        f_out - output file
+        fsync - fsync after every write
+        '''
+        self.f_out = f_out
+        self.f_index = f_out + '.yaml'
+        self.fsync = fsync
+        self.channels = []
+        if os.path.isfile(self.f_index):
+            with open(self.f_index, 'r') as f:
+                self.channels = load(f, Loader=Loader)['channels']
+        self._file = open(f_out, 'ab')
+
+    def write(self, records, channels):
+        '''
+        records - numpy array of sample_dtype
+        channels - list of all channel names, indexed by channel id
+        '''
+        if len(channels) != len(self.channels):
+            # the index is tiny, and only rewritten when a new channel shows up
+            self.channels = list(channels)
+            with open(self.f_index + '.tmp', 'w') as f:
+                dump({'format': [list(d) for d in sample_dtype.descr], 'channels': self.channels}, f, Dumper=Dumper)
+            os.replace(self.f_index + '.tmp', self.f_index)
+        records.tofile(self._file)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def read_samples(f_in):
+    '''
+    Read a file written by SampleWriter.
+    Returns {channel name: {'time': array, 'value': array}}
+    '''
+    with open(f_in + '.yaml', 'r') as f:
+        channels = load(f, Loader=Loader)['channels']
+    data = np.fromfile(f_in, dtype=sample_dtype)
+    # an interrupted write can leave a partial record at the end, which np.fromfile drops
+    return {name: {'time': data['time'][data['id'] == i], 'value': data['value'][data['id'] == i]} for i, name in enumerate(channels)}
+
+
+class Sampler:
+
+    def __init__(self, probes, kcu=None, obj=None, f_out=None, buffer_size=100000, max_wait=None, fsync=False, verbose=False):
+        '''
+        probes - list of Probes, or of dictionaries for Probe.from_config
+        kcu - KCU whose link is shared with the DAQ, probes run without arbitration if None
+        obj - object the methods of probe dictionaries are looked up in, e.g. a ReadoutBoard
+        f_out - append the samples to this file, see SampleWriter
+        buffer_size - number of samples kept in memory
+        max_wait - maximum time in s a probe waits for a gap in the DAQ reads, see KCU.LinkArbiter
+        '''
+        self.probes = [p if isinstance(p, Probe) else Probe.from_config(p, obj) for p in probes]
+        self.kcu = kcu
+        self.max_wait = max_wait
+        self.verbose = verbose
+        self.buffer = RingBuffer(buffer_size)
+        self.writer = SampleWriter(f_out, fsync=fsync) if f_out is not None else None
+        self.channels = list(self.writer.channels) if self.writer is not None else []
+        self.ids = {name: i for i, name in enumerate(self.channels)}
+        self.n_samples = {p.name: 0 for p in self.probes}
+        self.n_errors = {p.name: 0 for p in self.probes}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.writer is not None:
+            self.writer.close()
+
+    def get_id(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.channels)
+            self.channels.append(name)
+        return self.ids[name]
+
+    def sample(self, probe):
+        '''
+        Run a single probe and store its values. Returns {name: value}.
+        '''
+        try:
+            if self.kcu is not None:
+                with self.kcu.arbiter.background(max_wait=self.max_wait):
+                    values = probe.sample()
+            else:
+                values = probe.sample()
+        except Exception as e:
+            self.n_errors[probe.name] += 1
+            print(f"Probe {probe.name} failed: {e}")
+            return {}
+        timestamp = time.time()
+
+        records = np.zeros(len(values), dtype=sample_dtype)
+        records['time'] = timestamp
+        records['id'] = [self.get_id(name) for name in values]
+        records['value'] = list(values.values())
+        self.buffer.append(records)
+        if self.writer is not None:
+            self.writer.write(records, self.channels)
+        self.n_samples[probe.name] += 1
+        if self.verbose:
+            print(f"{probe.name}: {values}")
+        return values
+
+    def run(self):
+        # probes are kept in a heap ordered by the next time they are due
+        now = time.time()
+        queue = [(now, i) for i in range(len(self.probes))]
+        heapq.heapify(queue)
+        while not self._stop.is_set():
+            due, i = queue[0]
+            if self._stop.wait(max(0, due - time.time())):
+                break
+            probe = self.probes[i]
+            self.sample(probe)
+            # samples that were missed (e.g. while the DAQ was busy) are skipped, not caught up
+            heapq.heapreplace(queue, (max(due + probe.period, time.time()), i))
+
+    def get(self, name):
+        '''
+        Samples of a channel that are still in the ring buffer, as arrays of time and value
+        '''
+        if name not in self.ids:
+            return np.array([]), np.array([])
+        data = self.buffer.get(ids=[self.ids[name]])
+        return data['time'], data['value']
+
+    def latest(self):
+        '''
+        Latest sample of every channel in the ring buffer, as {name: (time, value)}
+        '''
+        data = self.buffer.get()
+        res = {}
+        for t, i, value in data:
+            res[self.channels[i]] = (float(t), float(value))
+        return res
+
+def rb_sampler(rb, probes=default_probes, f_out=None, **kwargs):
+    '''
+    Sampler of a ReadoutBoard, started in the background. Stop it with Sampler.stop.
+    probes - list of probe dictionaries, methods are looked up in rb
+    '''
+    return Sampler(probes, kcu=rb.kcu, obj=rb, f_out=f_out, **kwargs).start()
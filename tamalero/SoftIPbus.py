@@ -0,0 +1,1031 @@
+"""
+Software stand-in for the KCU105 and its IPbus interface, for hardware-free DAQ testing.
+
+It implements the part of the uhal API that tamalero uses (getDevice, getNode, read, write,
+readBlock, dispatch, getClient().write, ValWord, ...) on top of an emulated register space
+that is built from the same address table as the firmware.
+The DAQ path is modelled: the RX FIFOs of the readout boards are filled with ETROC2 emulator
+data by a software L1A generator, and RX_FIFO_OCCUPANCY, DAQ_RB{n}, L1A_RATE, L1A_RATE_CNT,
+EVENT_CNT etc. behave like in the firmware.
+
+Local use, without any network:
+    kcu = KCU(ipb_path="soft://localhost?occupancy=0.01&n_etrocs=2", adr_table=...)
+
+The emulated board can also be served over UDP with the IPbus 2.0 protocol,
+so that uhal or controlhub clients can connect to it:
+    python3 -m tamalero.SoftIPbus --port 50001
+    kcu = KCU(ipb_path="ipbusudp-2.0://localhost:50001", adr_table=...)
+If uhal is not installed, ipbusudp-2.0 URIs are handled by the simple UDP client in this module
+when TAMALERO_SOFT_IPBUS=1 is set, see tamalero.KCU.use_soft_ipbus.
+"""
+import os
+import re
+import time
+import socket
+import struct
+import threading
+import numpy as np
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import uhal
+    NodePermission = uhal.NodePermission
+    BlockReadWriteMode = uhal.BlockReadWriteMode
+    _core = uhal._core
+    exception = uhal._core.exception
+    NonValidatedMemory = getattr(uhal, 'NonValidatedMemory', exception)
+except ModuleNotFoundError:
+    class NodePermission:
+        READ = 1
+        WRITE = 2
+        READWRITE = 3
+
+    class BlockReadWriteMode:
+        SINGLE = 0
+        INCREMENTAL = 1
+        NON_INCREMENTAL = 2
+        HIERARCHICAL = 3
+
+    class exception(Exception):
+        pass
+
+    class NonValidatedMemory(exception):
+        pass
+
+    class _core:
+        exception = exception
+
+    uhal = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# IPbus 2.0 transaction types
+READ = 0
+WRITE = 1
+NI_READ = 2
+NI_WRITE = 3
+RMW_BITS = 4
+RMW_SUM = 5
+
+CONTROL = 0
+STATUS = 1
+RESEND = 2
+
+max_transaction_words = 255
+
+permissions = {
+    'r': NodePermission.READ,
+    'read': NodePermission.READ,
+    'w': NodePermission.WRITE,
+    'write': NodePermission.WRITE,
+    'rw': NodePermission.READWRITE,
+    'readwrite': NodePermission.READWRITE,
+}
+
+modes = {
+    'single': BlockReadWriteMode.SINGLE,
+    'incremental': BlockReadWriteMode.INCREMENTAL,
+    'block': BlockReadWriteMode.INCREMENTAL,
+    'non-incremental': BlockReadWriteMode.NON_INCREMENTAL,
+    'port': BlockReadWriteMode.NON_INCREMENTAL,
+}
+
+def disableLogging():
+    pass
+
+def ffs(mask):
+    '''
+    position of the lowest set bit of mask
+    '''
+    return (mask & -mask).bit_length() - 1
+
+def parse_parameters(parameters):
+    '''
+    parameters="default=0x1;foo=bar" -> {'default': '0x1', 'foo': 'bar'}
+    '''
+    res = {}
+    for par in parameters.split(';'):
+        if '=' in par:
+            key, val = par.split('=', 1)
+            res[key.strip()] = val.strip()
+    return res
+
+tables = {}
+
+def parse_address_table(f_name):
+    '''
+    Read a uhal address table, following module includes relative to the including file.
+    Returns a dictionary of node path (without TOP) -> node properties, with absolute addresses.
+    Tables are only parsed once per process.
+    '''
+    f_name = os.path.abspath(f_name.replace('file://', ''))
+    if f_name in tables:
+        return tables[f_name]
+    nodes = {}
+
+    def parse(element, path, address, directory):
+        for child in element.findall('node'):
+            child_path = f"{path}.{child.get('id')}" if path else child.get('id')
+            child_address = address + int(child.get('address', '0'), 0)
+            node = {
+                'id': child.get('id'),
+                'path': child_path,
+                'address': child_address,
+                'mask': int(child.get('mask', '0xffffffff'), 0),
+                'permission': permissions[child.get('permission', 'rw').lower()],
+                'mode': modes[child.get('mode', 'single').lower()],
+                'size': int(child.get('size', '1'), 0),
+                'parameters': parse_parameters(child.get('parameters', '')),
+                'description': child.get('description', ''),
+                'children': [],
+            }
+            nodes[child_path] = node
+            if path:
+                nodes[path]['children'].append(child.get('id'))
+            if child.get('module'):
+                module = os.path.join(directory, child.get('module').replace('file://', ''))
+                parse(ET.parse(module).getroot(), child_path, child_address, os.path.dirname(module))
+            else:
+                parse(child, child_path, child_address, directory)
+            if node['children']:
+                node['mode'] = BlockReadWriteMode.HIERARCHICAL
+
+    parse(ET.parse(f_name).getroot(), '', 0, os.path.dirname(f_name))
+    tables[f_name] = nodes
+    return nodes
+
+
+class ValHeader:
+    '''
+    Result of a write transaction, valid after dispatch
+    '''
+    def __init__(self):
+        self._valid = False
+
+    def valid(self):
+        return self._valid
+
+    def _set(self, values):
+        self._valid = True
+
+
+class ValWord(ValHeader):
+    '''
+    Result of a single word read, with the mask of the node applied. Valid after dispatch.
+    '''
+    def __init__(self, mask=0xffffffff):
+        super().__init__()
+        self._mask = mask
+        self._value = 0
+
+    def _set(self, values):
+        self._value = (values[0] & self._mask) >> ffs(self._mask)
+        self._valid = True
+
+    def value(self):
+        if not self._valid:
+            raise NonValidatedMemory("ValWord has not been dispatched yet")
+        return self._value
+
+    def mask(self):
+        return self._mask
+
+    def __int__(self):
+        return self.value()
+
+    def __index__(self):
+        return self.value()
+
+    def __eq__(self, other):
+        return self.value() == int(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return hex(self.value()) if self._valid else "not valid"
+
+
+class ValVector(ValHeader):
+    '''
+    Result of a block read, valid after dispatch
+    '''
+    def __init__(self, size=0):
+        super().__init__()
+        self._size = size
+        self._values = []
+
+    def _set(self, values):
+        self._values = list(values)
+        self._valid = True
+
+    def value(self):
+        if not self._valid:
+            raise NonValidatedMemory("ValVector has not been dispatched yet")
+        return self._values
+
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        return self.value()[i]
+
+    def __iter__(self):
+        return iter(self.value())
+
+
+class Node:
+    '''
+    Node of the address table, bound to a HwInterface. Reads and writes are queued until dispatch.
+    '''
+    def __init__(self, hw, spec):
+        self.hw = hw
+        self.spec = spec
+
+    def getNode(self, id):
+        return self.hw.getNode(f"{self.spec['path']}.{id}")
+
+    def getNodes(self, regex=None):
+        prefix = self.spec['path'] + '.'
+        ids = [path[len(prefix):] for path in self.hw.nodes if path.startswith(prefix)]
+        if regex is not None:
+            ids = [id for id in ids if re.fullmatch(regex, id)]
+        return ids
+
+    def getId(self):
+        return self.spec['id']
+
+    def getPath(self):
+        return 'TOP.' + self.spec['path']
+
+    def getAddress(self):
+        return self.spec['address']
+
+    def getMask(self):
+        return self.spec['mask']
+
+    def getPermission(self):
+        return self.spec['permission']
+
+    def getMode(self):
+        return self.spec['mode']
+
+    def getSize(self):
+        return self.spec['size']
+
+    def getParameters(self):
+        return self.spec['parameters']
+
+    def getDescription(self):
+        return self.spec['description']
+
+    def read(self):
+        return self.hw.client.read(self.spec['address'], self.spec['mask'])
+
+    def write(self, value):
+        return self.hw.client.write(self.spec['address'], value, self.spec['mask'])
+
+    def readBlock(self, size):
+        return self.hw.client.readBlock(self.spec['address'], size, self.spec['mode'])
+
+    def writeBlock(self, values):
+        return self.hw.client.writeBlock(self.spec['address'], values, self.spec['mode'])
+
+
+class Client:
+    '''
+    Queues transactions and executes them on dispatch.
+    The queue is a list of (type, address, data, result), see SoftKCU.execute.
+    '''
+    def __init__(self, uri):
+        self._uri = uri
+        self.queue = []
+        self.lock = threading.Lock()
+
+    def uri(self):
+        return self._uri
+
+    def _queue(self, transaction):
+        with self.lock:
+            self.queue.append(transaction)
+        return transaction[3]
+
+    def read(self, address, mask=0xffffffff):
+        return self._queue((READ, address, 1, ValWord(mask)))
+
+    def write(self, address, value, mask=0xffffffff):
+        if mask == 0xffffffff:
+            return self._queue((WRITE, address, [value & 0xffffffff], ValHeader()))
+        # masked writes are read-modify-write bits transactions, like in uhal
+        return self._queue((RMW_BITS, address, (~mask & 0xffffffff, (value << ffs(mask)) & mask), ValHeader()))
+
+    def readBlock(self, address, size, mode=BlockReadWriteMode.INCREMENTAL):
+        return self._queue((NI_READ if mode == BlockReadWriteMode.NON_INCREMENTAL else READ, address, size, ValVector(size)))
+
+    def writeBlock(self, address, values, mode=BlockReadWriteMode.INCREMENTAL):
+        return self._queue((NI_WRITE if mode == BlockReadWriteMode.NON_INCREMENTAL else WRITE, address, [v & 0xffffffff for v in values], ValHeader()))
+
+    def dispatch(self):
+        with self.lock:
+            queue, self.queue = self.queue, []
+        if queue:
+            self.execute(queue)
+
+    def execute(self, queue):
+        raise NotImplementedError
+
+
+class LocalClient(Client):
+    '''
+    Executes transactions directly on an emulated board in the same process
+    '''
+    def __init__(self, uri, device):
+        super().__init__(uri)
+        self.device = device
+
+    def execute(self, queue):
+        with self.device.lock:
+            for type, address, data, result in queue:
+                result._set(self.device.execute(type, address, data))
+
+
+class UdpClient(Client):
+    '''
+    Minimal IPbus 2.0 UDP client, used for ipbusudp-2.0 URIs if uhal is not installed.
+    Transactions are packed into as few packets as the maximum payload size allows.
+    '''
+    def __init__(self, uri, timeout=1.0, retries=3):
+        super().__init__(uri)
+        parsed = urlparse(uri)
+        self.target = (parsed.hostname, parsed.port)
+        try:
+            self.max_payload_size = int(parse_qs(parsed.query)['max_payload_size'][0])
+        except (KeyError, ValueError):
+            self.max_payload_size = 1472
+        self.retries = retries
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.packet_id = None
+
+    def send(self, payload, packet_id):
+        self.socket.sendto(payload, self.target)
+        for i in range(self.retries + 1):
+            try:
+                while True:
+                    res, _ = self.socket.recvfrom(65536)
+                    # drop late replies to earlier packets
+                    if (struct.unpack('>I', res[:4])[0] >> 8) & 0xffff == packet_id:
+                        return res
+            except socket.timeout:
+                if packet_id == 0 or i == self.retries:
+                    break
+                self.socket.sendto(struct.pack('>I', packet_header(packet_id, RESEND)), self.target)
+        raise exception(f"No reply from {self._uri} for IPbus packet {packet_id}")
+
+    def status(self):
+        res = self.send(struct.pack('>16I', packet_header(0, STATUS), *[0]*15), 0)
+        return struct.unpack('>16I', res[:64])
+
+    def next_id(self):
+        if self.packet_id is None:
+            self.packet_id = (self.status()[3] >> 8) & 0xffff
+        packet_id = self.packet_id
+        self.packet_id = packet_id % 0xffff + 1
+        return packet_id
+
+    def execute(self, queue):
+        # split into transactions of at most max_transaction_words words
+        transactions = []
+        for type, address, data, result in queue:
+            if type in [READ, NI_READ] and data > max_transaction_words:
+                parts = [(type, address + i*(type == READ), min(max_transaction_words, data - i)) for i in range(0, data, max_transaction_words)]
+            elif type in [WRITE, NI_WRITE] and len(data) > max_transaction_words:
+                parts = [(type, address + i*(type == WRITE), data[i:i+max_transaction_words]) for i in range(0, len(data), max_transaction_words)]
+            else:
+                parts = [(type, address, data)]
+            for i, part in enumerate(parts):
+                transactions.append(part + (result if i == len(parts) - 1 else None, ))
+
+        max_words = self.max_payload_size // 4 - 1
+        values = []
+        packet = []
+        n_request, n_reply = 0, 0
+        for transaction in transactions + [None]:
+            if transaction is not None:
+                request, reply = transaction_words(transaction[0], transaction[2])
+            if transaction is None or n_request + request > max_words or n_reply + reply > max_words:
+                values += self.send_packet(packet)
+                packet, n_request, n_reply = [], 0, 0
+                if transaction is None:
+                    break
+            packet.append(transaction)
+            n_request += request
+            n_reply += reply
+
+        # hand the results to the ValWords, merging split block reads
+        collected = []
+        for (type, address, data, result), res in zip(transactions, values):
+            collected += res
+            if result is not None:
+                result._set(collected)
+                collected = []
+
+    def send_packet(self, packet):
+        if not packet:
+            return []
+        packet_id = self.next_id()
+        words = [packet_header(packet_id, CONTROL)]
+        for i, (type, address, data, result) in enumerate(packet):
+            words += encode_request(i, type, address, data)
+        res = self.send(struct.pack(f'>{len(words)}I', *words), packet_id)
+        reply = struct.unpack(f'>{len(res)//4}I', res)
+        values = []
+        pos = 1
+        for type, address, data, result in packet:
+            header = reply[pos]
+            if header & 0xf != 0:
+                raise exception(f"IPbus transaction at address {hex(address)} failed with info code {header & 0xf}")
+            n = (header >> 8) & 0xff
+            if type in [READ, NI_READ]:
+                values.append(list(reply[pos+1:pos+1+n]))
+                pos += 1 + n
+            elif type in [RMW_BITS, RMW_SUM]:
+                values.append([reply[pos+1]])
+                pos += 2
+            else:
+                values.append([])
+                pos += 1
+        return values
+
+
+def packet_header(packet_id, type):
+    return (0x2 << 28) | ((packet_id & 0xffff) << 8) | 0xf0 | type
+
+def transaction_header(id, n_words, type, info=0xf):
+    return (0x2 << 28) | ((id & 0xfff) << 16) | ((n_words & 0xff) << 8) | (type << 4) | info
+
+def transaction_words(type, data):
+    '''
+    Number of request and reply words of a transaction
+    '''
+    if type in [READ, NI_READ]:
+        return 2, 1 + data
+    if type in [WRITE, NI_WRITE]:
+        return 2 + len(data), 1
+    if type == RMW_BITS:
+        return 4, 2
+    return 3, 2
+
+def encode_request(id, type, address, data):
+    if type in [READ, NI_READ]:
+        return [transaction_header(id, data, type), address]
+    if type in [WRITE, NI_WRITE]:
+        return [transaction_header(id, len(data), type), address] + list(data)
+    if type == RMW_BITS:
+        return [transaction_header(id, 1, type), address, data[0], data[1]]
+    return [transaction_header(id, 1, type), address, data]
+
+
+class HwInterface:
+    '''
+    Same interface as uhal.HwInterface, for the nodes of the address table
+    '''
+    def __init__(self, id, uri, nodes, client):
+        self.id = id
+        self.uri = uri
+        self.nodes = nodes
+        self.client = client
+
+    def getNode(self, id):
+        if id not in self.nodes:
+            raise exception(f"Node {id} does not exist in the address table")
+        return Node(self, self.nodes[id])
+
+    def getNodes(self, regex=None):
+        if regex is None:
+            return list(self.nodes.keys())
+        return [id for id in self.nodes if re.fullmatch(regex, id)]
+
+    def getClient(self):
+        return self.client
+
+    def getId(self):
+        return self.id
+
+    def getUri(self):
+        return self.uri
+
+    def dispatch(self):
+        self.client.dispatch()
+
+
+class EventPool:
+    '''
+    Pre-generated ETROC2 emulator data for a number of L1As.
+    The pool is repeated with new L1A counters and BCIDs, so that high L1A rates
+    can be emulated without running the emulator for every L1A.
+    '''
+    def __init__(self, n_etrocs=1, occupancy=0.01, size=200, seed=None):
+        '''
+        n_etrocs - number of ETROCs read out per L1A, on elinks 0, 1, ...
+        occupancy - fraction of pixels with a hit per L1A
+        size - number of L1As that are run on the emulator
+        '''
+        from statistics import NormalDist
+        from tamalero.ETROC_Emulator import ETROC2_Emulator
+        from tamalero.DataFrame import DataFrame
+
+        if seed is not None:
+            np.random.seed(seed)
+        emulators = []
+        for i in range(n_etrocs):
+            em = ETROC2_Emulator(chipid=(i+1)<<2, elink=i)
+            # flat baseline and noise, so that the occupancy is the same for all pixels
+            em.bl_means = [[700.]*16 for y in range(16)]
+            em.bl_stdevs = [[1.]*16 for y in range(16)]
+            em.set_Vth_mV(700 + NormalDist().inv_cdf(1 - min(max(occupancy, 1e-6), 1 - 1e-6)))
+            emulators.append(em)
+
+        events = []
+        for i in range(size):
+            words = []
+            for em in emulators:
+                words += [w | (em.elink << 40) for w in em.run(1)]
+            events.append(np.array(words, dtype=np.uint64))
+        self.words = np.concatenate(events)
+        self.length = np.array([len(ev) for ev in events])
+        self.start = np.cumsum(self.length) - self.length
+        self.size = size
+        self.mean_length = self.length.mean()
+
+        data_format = DataFrame('ETROC2').format
+        header = data_format['data']['header']
+        identifier = data_format['identifiers']['header']
+        self.is_header = (self.words & np.uint64(identifier['mask'])) == np.uint64(identifier['frame'])
+        self.l1counter_mask = np.uint64(header['l1counter']['mask'])
+        self.l1counter_shift = np.uint64(header['l1counter']['shift'])
+        self.bcid_mask = np.uint64(header['bcid']['mask'])
+        self.bcid_shift = np.uint64(header['bcid']['shift'])
+        self.pos = 0
+
+    def take(self, l1counter, bcid):
+        '''
+        64 bit words for the next len(l1counter) L1As of the pool, with the given L1A counters and BCIDs
+        '''
+        n = len(l1counter)
+        idx = (self.pos + np.arange(n)) % self.size
+        self.pos = (self.pos + n) % self.size
+        length = self.length[idx]
+        offset = np.cumsum(length) - length
+        select = np.repeat(self.start[idx] - offset, length) + np.arange(length.sum())
+        words = self.words[select]
+        headers = self.is_header[select]
+        event = np.repeat(np.arange(n), length)[headers]
+        words[headers] = (words[headers] & ~(self.l1counter_mask | self.bcid_mask)) \
+            | ((np.asarray(l1counter, dtype=np.uint64)[event] << self.l1counter_shift) & self.l1counter_mask) \
+            | ((np.asarray(bcid, dtype=np.uint64)[event] << self.bcid_shift) & self.bcid_mask)
+        return words
+
+
+class DAQModel:
+    '''
+    RX FIFO and event counters of one readout board
+    '''
+    def __init__(self, pool, depth=2**20):
+        '''
+        pool - EventPool that provides the data
+        depth - FIFO depth in 32 bit words
+        '''
+        self.pool = pool
+        self.depth = depth
+        self.fifo = np.zeros(depth, dtype=np.uint32)
+        self.head = 0
+        self.n_words = 0
+        self.lost = 0
+        self.event_cnt = 0
+        self.l1counter = 0
+
+    def reset(self):
+        self.head = 0
+        self.n_words = 0
+
+    def push(self, words):
+        n = min(len(words), self.depth - self.n_words)
+        self.lost += len(words) - n
+        tail = (self.head + self.n_words) % self.depth
+        first = min(n, self.depth - tail)
+        self.fifo[tail:tail+first] = words[:first]
+        self.fifo[:n-first] = words[first:n]
+        self.n_words += n
+
+    def pop(self, n):
+        '''
+        Read n words, words beyond the FIFO content are returned as 0
+        '''
+        res = np.zeros(n, dtype=np.uint32)
+        k = min(n, self.n_words)
+        first = min(k, self.depth - self.head)
+        res[:first] = self.fifo[self.head:self.head+first]
+        res[first:k] = self.fifo[:k-first]
+        self.head = (self.head + k) % self.depth
+        self.n_words -= k
+        return res
+
+    def trigger(self, bcid):
+        '''
+        Process L1As with the given BCIDs
+        '''
+        n = len(bcid)
+        l1counter = self.l1counter + np.arange(n)
+        self.l1counter += n
+        self.event_cnt += n
+        # only generate the data that still fits into the FIFO, the rest is lost anyway
+        n_fit = min(n, int((self.depth - self.n_words) / (2*self.pool.mean_length)) + 1)
+        words = self.pool.take(l1counter[:n_fit], bcid[:n_fit])
+        if len(words) % 2:
+            # the firmware reads the FIFO in units of 4 words, fill up with an empty entry
+            words = np.append(words, np.uint64(0))
+        self.push(words.astype('<u8').view('<u4'))
+        self.lost += int((n - n_fit) * 2*self.pool.mean_length)
+
+    def occupancy(self):
+        return self.n_words // 4
+
+
+class SoftKCU:
+    '''
+    Emulated register space of the KCU105, with the DAQ path of every readout board modelled.
+    Registers without a model behave like plain memory, with the defaults of the address table.
+    '''
+
+    clock_frequencies = {
+        'FW_INFO.CLK125_FREQ': 125000000,
+        'FW_INFO.CLK320_FREQ': 320640000,
+        'FW_INFO.CLK_40_FREQ': 40080000,
+        'FW_INFO.REFCLK_FREQ': 320640000,
+        'FW_INFO.RXCLK0_FREQ': 320640000,
+        'FW_INFO.RXCLK1_FREQ': 320640000,
+        'FW_INFO.TXCLK0_FREQ': 320640000,
+        'FW_INFO.TXCLK1_FREQ': 320640000,
+    }
+
+    def __init__(self, adr_table, occupancy=0.01, n_etrocs=1, fifo_depth=2**20, pool_size=200, seed=None):
+        '''
+        adr_table - uhal address table of the firmware
+        occupancy - fraction of pixels with a hit per L1A
+        n_etrocs - number of ETROCs read out by every readout board
+        fifo_depth - depth of the RX FIFOs in 32 bit words
+        pool_size - number of L1As that are actually run on the emulator, see EventPool
+        '''
+        from tamalero import __fw_version__
+        self.nodes = parse_address_table(adr_table)
+        self.lock = threading.RLock()
+        self.occupancy = occupancy
+        self.n_etrocs = n_etrocs
+        self.fifo_depth = fifo_depth
+        self.pool_size = pool_size
+        self.seed = seed
+        self.pool = None
+
+        self.memory = {}
+        self.read_hooks = {}
+        self.write_hooks = {}
+        self.fifos = {}
+        self.pulses = {}
+        self.actions = {}
+        for path, node in self.nodes.items():
+            if node['children']:
+                continue
+            if 'default' in node['parameters']:
+                self.set(path, int(node['parameters']['default'], 0))
+            if node['permission'] == NodePermission.WRITE:
+                self.pulses.setdefault(node['address'], []).append((node['mask'], path))
+
+        major, minor, patch = (int(x) for x in __fw_version__.split('.'))
+        self.set('FW_INFO.HOG_INFO.GLOBAL_VER', (major << 24) | (minor << 16) | patch)
+        for path, freq in self.clock_frequencies.items():
+            if path in self.nodes:
+                self.set(path, freq)
+
+        # L1A generator
+        self.t_last = time.perf_counter()
+        self.t_start = self.t_last
+        self.frac = 0.
+        self.hook('SYSTEM.L1A_RATE_CNT', read=lambda: int(round(self.get_trigger_rate())))
+        self.actions['SYSTEM.L1A_PULSE'] = lambda: self.trigger()
+        self.actions['SYSTEM.QINJ_PULSE'] = lambda: self.get('SYSTEM.QINJ_MAKES_L1A') and self.trigger()
+
+        self.daq = {}
+        rb = 0
+        while f'READOUT_BOARD_{rb}' in self.nodes:
+            self.add_readout_board(rb)
+            rb += 1
+
+    def add_readout_board(self, rb):
+        daq = DAQModel(None, depth=self.fifo_depth)
+        self.daq[rb] = daq
+        prefix = f'READOUT_BOARD_{rb}'
+        self.set(f'{prefix}.ETROC_LOCKED', (1 << self.n_etrocs) - 1)
+        self.hook(f'{prefix}.RX_FIFO_OCCUPANCY', read=daq.occupancy)
+        self.hook(f'{prefix}.RX_FIFO_LOST_WORD_CNT', read=lambda: daq.lost & 0xffffffff)
+        self.hook(f'{prefix}.RX_FIFO_FULL', read=lambda: int(daq.n_words >= daq.depth))
+        self.hook(f'{prefix}.EVENT_CNT', read=lambda: daq.event_cnt & 0xffffffff)
+        self.hook(f'{prefix}.PACKET_RX_RATE', read=lambda: int(round(self.get_trigger_rate() * self.n_etrocs)))
+        self.actions[f'{prefix}.FIFO_RESET'] = daq.reset
+        self.actions[f'{prefix}.EVENT_CNT_RESET'] = lambda: setattr(daq, 'event_cnt', 0)
+        self.actions[f'{prefix}.L1A_PULSE'] = lambda: self.trigger([rb])
+        self.actions[f'{prefix}.L1A_QINJ_PULSE'] = lambda: self.trigger([rb])
+        if f'DAQ_RB{rb}.FIFO' in self.nodes:
+            fifo = self.nodes[f'DAQ_RB{rb}.FIFO']
+            self.fifos[fifo['address']] = (fifo['size'], daq.pop)
+
+    def hook(self, path, read=None, write=None):
+        '''
+        Model the register of node path by functions, read() returns the register value
+        and write(value) is called after every write to the register
+        '''
+        if path not in self.nodes:
+            return
+        address = self.nodes[path]['address']
+        if read is not None:
+            self.read_hooks[address] = read
+        if write is not None:
+            self.write_hooks[address] = write
+
+    def set(self, path, value):
+        node = self.nodes[path]
+        mask = node['mask']
+        self.memory[node['address']] = (self.memory.get(node['address'], 0) & ~mask) | ((value << ffs(mask)) & mask)
+
+    def get(self, path):
+        node = self.nodes[path]
+        return (self.memory.get(node['address'], 0) & node['mask']) >> ffs(node['mask'])
+
+    def get_trigger_rate(self):
+        '''
+        L1A rate in Hz, inverse of the setting in FIFO.set_trigger_rate
+        '''
+        return self.get('SYSTEM.L1A_RATE') * 25E-9 * 0xffffffff / 10000
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = EventPool(n_etrocs=self.n_etrocs, occupancy=self.occupancy, size=self.pool_size, seed=self.seed)
+            for daq in self.daq.values():
+                daq.pool = self.pool
+        return self.pool
+
+    def trigger(self, rbs=None, times=None):
+        '''
+        Send L1As to the readout boards rbs (default all), at the given times (default now)
+        '''
+        if times is None:
+            times = np.array([time.perf_counter()])
+        self.get_pool()
+        bcid = (np.round((times - self.t_start) * 40.08E6) % 3564).astype(np.uint64)
+        for rb in (rbs if rbs is not None else self.daq.keys()):
+            self.daq[rb].trigger(bcid)
+        return True
+
+    def advance(self):
+        '''
+        Run the L1A generator up to now
+        '''
+        now = time.perf_counter()
+        rate = self.get_trigger_rate()
+        expected = (now - self.t_last) * rate + self.frac
+        n = int(expected)
+        self.frac = expected - n
+        if n > 0:
+            self.trigger(times=now - (n - 1 - np.arange(n) + self.frac) / rate)
+        self.t_last = now
+
+    def get_fifo(self, address):
+        '''
+        The whole address range of a FIFO reads from the FIFO, also for incremental block reads
+        '''
+        for base, (size, pop) in self.fifos.items():
+            if base <= address < base + size:
+                return pop
+        return None
+
+    def read(self, address):
+        if address in self.read_hooks:
+            return self.read_hooks[address]() & 0xffffffff
+        return self.memory.get(address, 0)
+
+    def write(self, address, value):
+        for mask, path in self.pulses.get(address, []):
+            if value & mask:
+                if path in self.actions:
+                    self.actions[path]()
+                # pulses are not stored
+                value &= ~mask
+        self.memory[address] = value
+        if address in self.write_hooks:
+            self.write_hooks[address](value)
+
+    def execute(self, type, address, data):
+        '''
+        Execute one IPbus transaction and return the words of the reply
+        type - READ, WRITE, NI_READ, NI_WRITE, RMW_BITS or RMW_SUM
+        data - number of words for reads, list of words for writes, (and, or) for RMW_BITS, addend for RMW_SUM
+        '''
+        with self.lock:
+            self.advance()
+            if type in [READ, NI_READ]:
+                fifo = self.get_fifo(address)
+                if fifo is not None:
+                    return fifo(data).tolist()
+                if type == NI_READ:
+                    return [self.read(address) for i in range(data)]
+                return [self.read(address + i) for i in range(data)]
+            if type in [WRITE, NI_WRITE]:
+                for i, value in enumerate(data):
+                    self.write(address + i*(type == WRITE), value)
+                return []
+            old = self.read(address)
+            if type == RMW_BITS:
+                self.write(address, ((old & data[0]) | data[1]) & 0xffffffff)
+            elif type == RMW_SUM:
+                self.write(address, (old + data) & 0xffffffff)
+            else:
+                raise exception(f"Unknown IPbus transaction type {type}")
+            return [old]
+
+
+devices = {}
+
+def get_soft_device(uri, adr_table):
+    '''
+    Emulated board for a soft:// URI. Devices are shared within a process,
+    so that all connections to the same URI see the same registers and FIFOs.
+    Options are given as URI query, e.g. soft://localhost?occupancy=0.01&n_etrocs=2&fifo_depth=1048576&seed=1
+    '''
+    key = (uri, os.path.abspath(adr_table.replace('file://', '')))
+    if key not in devices:
+        options = {k: v[0] for k, v in parse_qs(urlparse(uri).query).items()}
+        devices[key] = SoftKCU(
+            adr_table,
+            occupancy = float(options.get('occupancy', 0.01)),
+            n_etrocs = int(options.get('n_etrocs', 1)),
+            fifo_depth = int(options.get('fifo_depth', 2**20)),
+            pool_size = int(options.get('pool_size', 200)),
+            seed = int(options['seed']) if 'seed' in options else None,
+        )
+    return devices[key]
+
+def getDevice(id, uri, adr_table):
+    '''
+    Same as uhal.getDevice, for soft:// URIs (emulated board in this process)
+    and ipbusudp-2.0:// URIs (e.g. an IPbusServer)
+    '''
+    nodes = parse_address_table(adr_table)
+    if uri.startswith('soft'):
+        client = LocalClient(uri, get_soft_device(uri, adr_table))
+    elif uri.startswith('ipbusudp-2.0'):
+        client = UdpClient(uri)
+    else:
+        raise exception(f"Protocol of {uri} is not supported without uhal")
+    return HwInterface(id, uri, nodes, client)
+
+
+class IPbusServer:
+    '''
+    Serves an emulated board over UDP with the IPbus 2.0 protocol,
+    including status and resend requests for reliable clients like uhal and controlhub.
+    '''
+    def __init__(self, device, host='localhost', port=50001, n_buffers=16, mtu=1500):
+        self.device = device
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.1)
+        self.n_buffers = n_buffers
+        self.mtu = mtu
+        self.next_id = 1
+        self.replies = {}
+        self.received = [0]*4
+        self.sent = [0]*4
+        self._running = False
+        self.thread = None
+
+    def address(self):
+        return self.socket.getsockname()
+
+    def start(self):
+        '''
+        Serve in a background thread
+        '''
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.socket.close()
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            try:
+                request, client = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            reply = self.handle(request)
+            if reply is not None:
+                self.socket.sendto(reply, client)
+
+    def handle(self, request):
+        '''
+        Reply to one IPbus packet, or None if the packet is dropped
+        '''
+        if len(request) < 4 or len(request) % 4:
+            return None
+        # the byte order qualifier tells us the endianness of the client
+        for order in '><':
+            header = struct.unpack(f'{order}I', request[:4])[0]
+            if header >> 28 == 2 and (header >> 4) & 0xf == 0xf:
+                break
+        else:
+            return None
+        words = struct.unpack(f'{order}{len(request)//4}I', request)
+        packet_id = (header >> 8) & 0xffff
+        type = header & 0xf
+
+        if type == STATUS:
+            reply = [header, self.mtu, self.n_buffers, packet_header(self.next_id, CONTROL)] + [0]*4 + self.received + self.sent
+        elif type == RESEND:
+            if packet_id not in self.replies:
+                return None
+            return self.replies[packet_id]
+        elif type == CONTROL:
+            if packet_id != 0 and packet_id != self.next_id:
+                # a repeated packet gets the stored reply, everything else is dropped
+                return self.replies.get(packet_id)
+            reply = [header] + self.execute(words[1:])
+            self.received = self.received[1:] + [header]
+            self.sent = self.sent[1:] + [header]
+        else:
+            return None
+
+        reply = struct.pack(f'{order}{len(reply)}I', *reply)
+        if type == CONTROL and packet_id != 0:
+            self.replies[packet_id] = reply
+            self.replies.pop((packet_id - self.n_buffers - 1) % 0xffff + 1, None)
+            self.next_id = packet_id % 0xffff + 1
+        return reply
+
+    def execute(self, words):
+        reply = []
+        pos = 0
+        while pos < len(words):
+            header = words[pos]
+            n = (header >> 8) & 0xff
+            type = (header >> 4) & 0xf
+            id = (header >> 16) & 0xfff
+            address = words[pos+1]
+            if type in [READ, NI_READ]:
+                data = self.device.execute(type, address, n)
+                pos += 2
+            elif type in [WRITE, NI_WRITE]:
+                data = self.device.execute(type, address, list(words[pos+2:pos+2+n]))
+                pos += 2 + n
+            elif type == RMW_BITS:
+                data = self.device.execute(type, address, (words[pos+2], words[pos+3]))
+                pos += 4
+            elif type == RMW_SUM:
+                data = self.device.execute(type, address, words[pos+2])
+                pos += 3
+            else:
+                # bad transaction type, reply with an error and stop processing the packet
+                reply.append(transaction_header(id, 0, type, info=0x1))
+                break
+            reply += [transaction_header(id, n, type, info=0x0)] + data
+        return reply
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argParser = argparse.ArgumentParser(description = "Serve an emulated KCU over UDP with the IPbus 2.0 protocol")
+    argParser.add_argument('--host', action='store', default='localhost', help="Host to bind to")
+    argParser.add_argument('--port', action='store', default=50001, type=int, help="UDP port")
+    argParser.add_argument('--adr_table', action='store', default=os.path.join(here, '../address_table/generic/etl_test_fw.xml'), help="Address table")
+    argParser.add_argument('--occupancy', action='store', default=0.01, type=float, help="Fraction of pixels with a hit per L1A")
+    argParser.add_argument('--n_etrocs', action='store', default=1, type=int, help="Number of ETROCs per readout board")
+    argParser.add_argument('--fifo_depth', action='store', default=2**20, type=int, help="RX FIFO depth in 32 bit words")
+    argParser.add_argument('--seed', action='store', default=None, type=int, help="Random seed")
+    args = argParser.parse_args()
+
+    device = SoftKCU(args.adr_table, occupancy=args.occupancy, n_etrocs=args.n_etrocs, fifo_depth=args.fifo_depth, seed=args.seed)
+    server = IPbusServer(device, host=args.host, port=args.port)
+    print(f"Serving emulated KCU on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+"""
+Bounded-memory writer for raw DAQ streams.
+Filled FIFO buffers are handed over through a bounded queue, and a dedicated
+thread appends them to disk as little-endian uint32 words.
+"""
+import os
+import time
+import numpy as np
+from queue import Queue
+from threading import Thread
+
+class StreamWriter:
+
+    def __init__(self, f_out, max_queue=256, rotate_size=None, rotate_time=None, fsync=None):
+        '''
+        f_out - output file. Rotated files are called f_out.1, f_out.2, ...
+        max_queue - maximum number of buffers waiting to be written.
+                    put blocks once the queue is full, so memory use stays flat.
+        rotate_size - start a new file once the current one exceeds this size (in bytes)
+        rotate_time - start a new file after this time (in s)
+        fsync - None: leave flushing to the OS
+                'close': fsync every file before it is closed (also on rotation)
+                'always': fsync after every buffer
+                float: fsync at most every fsync seconds, and on close
+        '''
+        if not (fsync is None or fsync in ['close', 'always'] or isinstance(fsync, (int, float))):
+            raise ValueError(f"Unknown fsync policy {fsync}, use None, 'close', 'always' or a time in seconds")
+        self.f_out = f_out
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.fsync = fsync
+        self._sync_interval = fsync if isinstance(fsync, (int, float)) else None
+
+        self.files = []
+        self.n_words = 0
+        self.n_bytes_file = 0
+        self.error = None
+
+        self._queue = Queue(maxsize=max_queue)
+        self._file = None
+        self._file_start = 0
+        self._last_sync = 0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def start(self):
+        if self._running:
+            # already started, e.g. start() followed by a with statement
+            return self
+        self._open()
+        self._running = True
+        self._thread.start()
+        return self
+
+    def put(self, data):
+        '''
+        Queue a buffer for writing. Accepts uhal ValVectors (after dispatch),
+        lists of 32 bit words or numpy arrays.
+        '''
+        if self.error is not None:
+            raise self.error
+        if not self._running:
+            raise RuntimeError("StreamWriter is not running")
+        self._queue.put(data)
+
+    def close(self):
+        '''
+        Write everything that is still queued and close the current file.
+        Returns the list of files that have been written.
+        '''
+        if self._running:
+            self._queue.put(None)
+            self._thread.join()
+            self._running = False
+        if self.error is not None:
+            raise self.error
+        return self.files
+
+    def _open(self):
+        f_name = self.f_out if len(self.files) == 0 else f"{self.f_out}.{len(self.files)}"
+        self._file = open(f_name, mode="wb")
+        self.files.append(f_name)
+        self.n_bytes_file = 0
+        self._file_start = time.time()
+        self._last_sync = self._file_start
+
+    def _close_file(self):
+        if self.fsync is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    def _need_rotation(self):
+        if self.n_words % 2:
+            # never split the two 32 bit halves of a FIFO word into different files
+            return False
+        if self.rotate_size is not None and self.n_bytes_file >= self.rotate_size:
+            return True
+        if self.rotate_time is not None and time.time() - self._file_start >= self.rotate_time:
+            return True
+        return False
+
+    def _write(self, data):
+        if hasattr(data, 'value'):
+            # uhal ValVector
+            data = data.value()
+        buf = np.asarray(data, dtype='<u4')
+        if len(buf) == 0:
+            return
+        if self._need_rotation():
+            self._close_file()
+            self._open()
+        self._file.write(buf.tobytes())
+        self.n_words += len(buf)
+        self.n_bytes_file += buf.nbytes
+        if self.fsync == 'always' or (self._sync_interval is not None and time.time() - self._last_sync > self._sync_interval):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._last_sync = time.time()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self.error is not None:
+                # keep draining the queue so that producers never block
+                continue
+            try:
+                self._write(data)
+            except Exception as e:
+                self.error = e
+        self._close_file()
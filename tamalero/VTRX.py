@@ -98,6 +98,15 @@ class VTRX:
         # self.master.I2C_write(adr, val=data, master=2, slave_addr=0x50, adr_nbytes=1, ignore_response=ignore_response)
         self.master.I2C_write(adr, val=data, master=0, slave_addr=0x50, adr_nbytes=1, ignore_response=ignore_response)
 
+    def rd_adrs(self, adr, nbytes):
+        return self.master.I2C_read(adr, master=0, slave_addr=0x50, nbytes=nbytes, adr_nbytes=1)
+
+    def wr_adrs(self, adr, data, ignore_response=False):
+        '''
+        Write a list of bytes to consecutive registers, starting at adr, as an I2C burst
+        '''
+        self.wr_adr(adr, list(data), ignore_response=ignore_response)
+
     def rd_reg(self, reg):
         adr   = self.regs[reg]['adr']
         shift = self.regs[reg]['shift']
@@ -211,6 +220,27 @@ class VTRX:
     def set_emphasis_amplitude(self, channel=0, amplitude=0x0):
         self.wr_reg_ch('CHxEMP', ch, amplitude)
 
+    def configure_channel(self, ch=0, bias=None, modulation=None, emphasis=None, ignore_response=False):
+        '''
+        Set the bias current, modulation current and emphasis amplitude of a channel at once.
+        The registers are consecutive, so they are read and written with a single I2C transaction each.
+        Settings that are None are left unchanged.
+        '''
+        settings = {'CHxBIAS': bias, 'CHxMOD': modulation, 'CHxEMP': emphasis}
+        adrs = [self.regs[reg]['adr'][ch] for reg in settings]
+        start = min(adrs)
+        current = self.rd_adrs(start, max(adrs) - start + 1)
+        if not isinstance(current, list):
+            current = [current]
+        for reg, val in settings.items():
+            if val is None:
+                continue
+            i     = self.regs[reg]['adr'][ch] - start
+            shift = self.regs[reg]['shift'][ch]
+            mask  = self.regs[reg]['mask'][ch]
+            current[i] = ((val<<shift)&mask)|(current[i]&(~mask))
+        self.wr_adrs(start, current, ignore_response=ignore_response)
+
 
     def get_temp(self):
         v_ref = self.master.read_dac()
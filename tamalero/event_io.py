@@ -0,0 +1,110 @@
+"""
+Reading and writing of the event files produced by data_dumper.
+Events are stored as Parquet (columnar, compressed, with row groups) or,
+for backwards compatibility, as the awkward JSON string inside a JSON file.
+"""
+import os
+import json
+import awkward as ak
+from yaml import load
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+formats = {'.parquet': 'parquet', '.json': 'json'}
+
+def get_format(f_name):
+    ext = os.path.splitext(f_name)[1]
+    if ext not in formats:
+        raise ValueError(f"Unknown event file format {ext}, use one of {list(formats.keys())}")
+    return formats[ext]
+
+def find_events_file(f_name):
+    '''
+    Return the parquet version of f_name if it exists, otherwise the json version.
+    f_name can be given with either extension (or none).
+    '''
+    base = f_name
+    for ext in formats:
+        # only strip a known extension, run names like run_1.5fC contain dots
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    for ext in formats:
+        if os.path.isfile(base + ext):
+            return base + ext
+    raise FileNotFoundError(f"No event file found for {base}, tried {list(formats.keys())}")
+
+def load_daq_log(f_in):
+    '''
+    Load the DAQ log that belongs to a raw data file, i.e. log_run_X_rbY.yaml for output_run_X_rbY.dat.
+    Returns an empty dictionary if there is no log.
+    '''
+    log_file = os.path.join(
+        os.path.dirname(f_in),
+        os.path.basename(f_in).replace('output_run_', 'log_run_').replace('.dat', '.yaml'),
+    )
+    if log_file == f_in or not os.path.isfile(log_file):
+        return {}
+    with open(log_file, 'r') as f:
+        return load(f, Loader=Loader)
+
+def write_events(events, f_out, metadata={}, compression='zstd', row_group_size=100000):
+    '''
+    events - awkward array of events
+    f_out - output file, the format is taken from the extension (.parquet or .json)
+    metadata - dictionary of run information (e.g. the DAQ log), stored in the parquet schema
+    compression - parquet compression codec (zstd, snappy, gzip, lz4, brotli or None)
+    row_group_size - number of events per parquet row group
+    '''
+    if get_format(f_out) == 'json':
+        with open(f_out, "w") as f:
+            json.dump(ak.to_json(events), f)
+        return f_out
+
+    import pyarrow.parquet as pq
+    table = ak.to_arrow_table(events)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b'tamalero'] = json.dumps(metadata, default=str).encode()
+    table = table.replace_schema_metadata(schema_metadata)
+    pq.write_table(table, f_out, compression=compression, row_group_size=row_group_size)
+    return f_out
+
+def read_events(f_in, columns=None):
+    '''
+    Read events from a parquet or json file written by data_dumper.
+    columns - only read these fields (parquet only)
+    '''
+    if get_format(f_in) == 'json':
+        with open(f_in, "r") as f:
+            events = ak.from_json(json.load(f))
+        if columns is not None:
+            events = events[columns]
+        return events
+    return ak.from_parquet(f_in, columns=columns)
+
+def read_metadata(f_in):
+    '''
+    Run information that has been stored with the events, empty for json files
+    '''
+    if get_format(f_in) == 'json':
+        return {}
+    import pyarrow.parquet as pq
+    schema_metadata = pq.read_schema(f_in).metadata or {}
+    if b'tamalero' not in schema_metadata:
+        return {}
+    return json.loads(schema_metadata[b'tamalero'])
+
+def iterate_events(f_in, row_groups=1):
+    '''
+    Iterate over the events of a file, row_groups parquet row groups at a time.
+    Json files are returned in one go.
+    '''
+    if get_format(f_in) == 'json':
+        yield read_events(f_in)
+        return
+    import pyarrow.parquet as pq
+    n_groups = pq.ParquetFile(f_in).num_row_groups
+    for i in range(0, n_groups, row_groups):
+        yield ak.from_parquet(f_in, row_groups=range(i, min(i + row_groups, n_groups)))
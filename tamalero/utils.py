@@ -6,6 +6,7 @@ from yaml import load, dump
 import os
 
 from tamalero.KCU import KCU
+from tamalero.yaml_utils import yaml_cache, yaml_cache_lock, load_yaml, get_cache_entry, load_register_map
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -142,11 +143,6 @@ def load_alignment_from_file(f_in):
         res = load(f, Loader=Loader)
     return res
 
-def load_yaml(f_in):
-    with open(f_in, 'r') as f:
-        res = load(f, Loader=Loader)
-    return res
-
 def ffs(x):
     '''
     Returns the index, counting from 0, of the
@@ -219,6 +215,30 @@ def make_version_header(res):
 def chunk(in_list, n):
     return [in_list[i * n:(i + 1) * n] for i in range((len(in_list) + n - 1) // n )] 
 
+def get_bursts(values, max_len=None, block=None, ordered=False):
+    '''
+    Group a dictionary {address: value} into runs of consecutive addresses, for I2C burst writes.
+    Returns a list of (start address, [values]).
+    max_len - maximum number of values per run
+    block - runs don't cross multiples of this (e.g. 32 for the registers of an ETROC pixel)
+    ordered - keep the order of values (dictionary or list of (address, value)),
+              only addresses that directly follow each other in values are merged. Otherwise the addresses are sorted.
+    '''
+    items = list(values.items()) if isinstance(values, dict) else list(values)
+    if not ordered:
+        items = sorted(items, key=lambda item: item[0])
+    bursts = []
+    for adr, val in items:
+        if bursts:
+            start, vals = bursts[-1]
+            if adr == start + len(vals) \
+                    and (max_len is None or len(vals) < max_len) \
+                    and (block is None or adr % block != 0):
+                vals.append(val)
+                continue
+        bursts.append((adr, [val]))
+    return bursts
+
 def get_last_commit_sha(version):
     import requests
     import json
@@ -308,9 +328,12 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
         else:
             print(f"NOT using control hub on host={host}, kcu_address={kcu_address}")
 
-    import uhal
+    from tamalero.SoftIPbus import exception as uhal_exception
     import time
-    if control_hub:
+    if kcu_address.startswith('soft'):
+        # software stand-in, see tamalero.SoftIPbus
+        ipb_path = kcu_address
+    elif control_hub:
         ipb_path = f"chtcp-2.0://{host}:10203?target={kcu_address}:50001"
     else:
         ipb_path = f"ipbusudp-2.0://{kcu_address}:50001"
@@ -324,7 +347,7 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
                         ipb_path=ipb_path,
                         adr_table=os.path.expandvars(f"$TAMALERO_BASE/address_table/generic/etl_test_fw.xml"))
             break
-        except uhal.exception or uhal._core.exception:
+        except uhal_exception:
             if control_hub:
                 # we could be checking if control hub is running earlier, but since the control hub path is hardcoded
                 # I only want to do it if really necessary. if controlhub is running happily from another directory, that's fine too
@@ -353,7 +376,11 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
 
     #last_commit = get_last_commit_sha(xml_sha)
     #if not os.path.isdir(f"address_table/{last_commit}"):
-    xml_sha = download_address_table(xml_sha, quiet=quiet)
+    if ipb_path.startswith('soft'):
+        # the emulated board is built from the generic address table
+        xml_sha = 'generic'
+    else:
+        xml_sha = download_address_table(xml_sha, quiet=quiet)
     #else:
     #    xml_sha = last_commit
 
@@ -0,0 +1,62 @@
+"""
+Cached loading of yaml files and register maps.
+Kept separate from tamalero.utils, so that it can be used without importing the KCU.
+"""
+import os
+import threading
+from yaml import load
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+# parsed yaml files, shared by the whole process: {path: (mtime, content, compiled)}
+yaml_cache = {}
+yaml_cache_lock = threading.Lock()
+
+def load_yaml(f_in, cached=False):
+    '''
+    f_in - yaml file
+    cached - return the parsed file from the process wide cache. The file is only parsed again if it was modified.
+             The returned object is shared between all users, it must not be modified!
+    '''
+    if cached:
+        return get_cache_entry(f_in)[1]
+    with open(f_in, 'r') as f:
+        res = load(f, Loader=Loader)
+    return res
+
+def get_cache_entry(f_in):
+    f_in = os.path.abspath(os.path.expandvars(f_in))
+    mtime = os.stat(f_in).st_mtime_ns
+    with yaml_cache_lock:
+        entry = yaml_cache.get(f_in)
+        if entry is None or entry[0] != mtime:
+            with open(f_in, 'r') as f:
+                entry = (mtime, load(f, Loader=Loader), {})
+            yaml_cache[f_in] = entry
+    return entry
+
+def load_register_map(f_in):
+    '''
+    Load a register map (e.g. address_table/ETROC2_example.yaml) from the cache, together with the
+    precompiled layout of every register: {reg: {'address', 'mask', 'shift', 'n_bits', 'offset', 'n_bits_total'}},
+    with the shift of every mask, its number of bits, and the position of its bits in the register value.
+    Both dictionaries are shared, don't modify them.
+    '''
+    _, regs, compiled = get_cache_entry(f_in)
+    with yaml_cache_lock:
+        if 'layout' not in compiled:
+            layout = {}
+            for reg, info in regs.items():
+                n_bits = [bin(mask).count('1') for mask in info['mask']]  # same as utils.bit_count
+                layout[reg] = {
+                    'address': list(info['address']),
+                    'mask': list(info['mask']),
+                    'shift': [(mask&-mask).bit_length()-1 for mask in info['mask']],  # same as utils.ffs
+                    'n_bits': n_bits,
+                    'offset': [sum(n_bits[:i]) for i in range(len(n_bits))],
+                    'n_bits_total': sum(n_bits),
+                }
+            compiled['layout'] = layout
+    return regs, compiled['layout']
@@ -11,12 +11,14 @@ import os
 import glob
 from emoji import emojize
 import argparse
+import numpy as np
 
 from yaml import load, CLoader as Loader, CDumper as Dumper
 from tamalero.ReadoutBoard import ReadoutBoard
 from tamalero.utils import get_kcu, load_yaml
 from tamalero.FIFO import FIFO
 from tamalero.DataFrame import DataFrame
+from tamalero.Calibration import calibrate_thresholds
 
 '''
 Configuration of the module telescope
@@ -128,6 +130,24 @@ if __name__ == '__main__':
                 mod.show_status()
 
         print("Configuring ETROCs")
+        if args.offset == 'auto':
+            offset = args.offset
+        else:
+            offset = int(args.offset)
+
+        calibration = None
+        if not args.test_config and not args.subset and not args.reuse_thresholds:
+            # calibrate the thresholds of all ETROCs at once, ETROCs on different I2C masters run in parallel
+            etrocs = {}
+            for rb in rbs:
+                for mod in rbs[rb].modules:
+                    if mod.connected:
+                        for etroc in mod.ETROCs:
+                            if etroc.is_connected():
+                                etroc.set_power_mode(pm)
+                                etrocs[(rb, etroc.module_id, etroc.chip_no)] = etroc
+            calibration = calibrate_thresholds(etrocs, offset=offset, use=False, out_dir=out_dir)
+
         for rb in rbs:
             for mod in rbs[rb].modules:
                 if mod.connected:
@@ -149,13 +169,12 @@ if __name__ == '__main__':
                             ]
                         else:
                             test_pixels = False
-                        if args.offset == 'auto':
-                            offset = args.offset
-                        else:
-                            offset = int(args.offset)
 
                         for etroc in mod.ETROCs:
-                            if args.reuse_thresholds:
+                            if calibration is not None and (rb, etroc.module_id, etroc.chip_no) in calibration.names:
+                                thresholds = np.minimum(calibration.thresholds((rb, etroc.module_id, etroc.chip_no), offset=offset), 1023)
+                                etroc.physics_config(offset=offset, L1Adelay=int(args.delay), subset=test_pixels, thresholds=thresholds, out_dir=out_dir, powerMode=pm)
+                            elif args.reuse_thresholds:
                                 
                                 with open(f'{latest_out_dir}/thresholds_module_{etroc.module_id}_etroc_{etroc.chip_no}.yaml', 'r') as f:
                                     thresholds = load(f, Loader=Loader)
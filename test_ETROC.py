@@ -953,9 +953,7 @@ if __name__ == '__main__':
             with open(args.threshold, 'r') as f:
                 threshold_matrix = load(f)
 
-            for row in range(16):
-                for col in range(16):
-                    etroc.wr_reg('DAC', int(threshold_matrix[row][col]), row=row, col=col)
+            etroc.set_pixel_map('DAC', np.array(threshold_matrix, dtype=int))
 
         if args.pixelscan == 'simple':
             row = 4
@@ -534,9 +534,7 @@ def readout_tests(etroc, masked_pixels, rb_0, args, result_dir = None, out_dir =
         with open(args.threshold, 'r') as f:
             threshold_matrix = load(f)
 
-        for row in range(16):
-            for col in range(16):
-                etroc.wr_reg('DAC', int(threshold_matrix[row][col]), row=row, col=col)
+        etroc.set_pixel_map('DAC', np.array(threshold_matrix, dtype=int))
     tmp_temp = check_temp(etroc)
     temperatures.append((time.time(), tmp_temp))
     print('Current ETROC Temperature Reading:', tmp_temp)
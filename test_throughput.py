@@ -13,9 +13,7 @@ from daq import stream_daq
 def set_ETROC_occupancy(etroc, occ):
     assert occ < 128, "Occupancy value out of accepted range [0-127] (7bits)"
     assert type(occ)==int, "Occupancy value type not int"
-    for i in range (0,16): 
-        for j in range (0,16): 
-            etroc.set_selftest_occupancy(occ=occ,row=i,col=j) 
+    etroc.set_pixel_map('selfTestOccupancy', occ)
     print ( "ETROC occupancy set to {}%".format(round(occ/1.28,2)) )
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+#! /bin/bash
+# Smoke run of daq.py --stream on the software stand-in of the KCU (tamalero.SoftIPbus).
+# Run from the repository root:
+#     bash tests/daq_stream_smoke.sh
+
+#### Predefined variables and functions ####
+RED='\033[1;31m'
+GREEN='\033[1;32m'
+BLUE='\033[1;34m'
+NC='\033[0m'
+
+function info() { echo -e "${BLUE}${@}${NC}"; }
+function error() { echo -e "${RED}${@}${NC}"; }
+function success() { echo -e "${GREEN}${@}${NC}"; }
+
+BASE=$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)
+export TAMALERO_BASE=${TAMALERO_BASE:-$BASE}
+export PYTHONPATH=$BASE:$PYTHONPATH
+WORKDIR=$(mktemp -d)
+mkdir -p $WORKDIR/ETROC_output
+cd $WORKDIR
+
+info "Running daq.py --stream on the soft board..."
+timeout 120 /usr/bin/env python3 $BASE/daq.py --kcu soft://localhost --stream --run_time 1 --run 1
+EXIT=$?
+if [ ${EXIT} -ne 0 ]; then
+	error "Failure when running daq.py --stream; exit code is ${EXIT}."
+	exit ${EXIT}
+fi
+if [ ! -f ETROC_output/output_run_1_rb0.dat ] || [ ! -f ETROC_output/log_run_1_rb0.yaml ]; then
+	error "daq.py --stream did not write the output and log files."
+	exit 1
+fi
+if [ -f ETROC_output/output_run_1_rb0.dat.1 ]; then
+	error "daq.py --stream opened a second output file without rotation."
+	exit 1
+fi
+cd $BASE
+rm -rf $WORKDIR
+success "Success! daq.py --stream exit with code ${EXIT}"
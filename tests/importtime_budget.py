@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+'''
+Check that importing tamalero stays fast, using python -X importtime.
+Fails if the import takes longer than the budget, or if any plotting / analysis
+package is pulled in (these have to be imported in the functions that use them).
+
+Run from the repository root:
+    python3 tests/importtime_budget.py --budget 1.0
+'''
+import os
+import sys
+import argparse
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+base = os.path.dirname(here)
+
+# packages that must not be imported by the control software at startup
+heavy_modules = ['matplotlib', 'mplhep', 'scipy', 'pandas', 'ROOT', 'tqdm', 'rich', 'uproot', 'awkward', 'pyarrow', 'hist']
+
+def measure(module):
+    '''
+    Import module in a fresh interpreter.
+    Returns the total import time in s, and a list of (cumulative time in s, module name) of all imports.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = base + os.pathsep + env.get('PYTHONPATH', '')
+    env.setdefault('TAMALERO_BASE', base)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=base, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise RuntimeError(f"Import of {module} failed")
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative)/1e6, name[1:].rstrip()))  # nested imports are indented
+    total = sum(t for t, name in imports if not name.startswith(' '))
+    return total, imports
+
+if __name__ == '__main__':
+
+    argParser = argparse.ArgumentParser(description = "Argument parser")
+    argParser.add_argument('--module', action='store', default='tamalero.ReadoutBoard', help="Module to import")
+    argParser.add_argument('--budget', action='store', default=1.0, type=float, help="Maximum import time in s")
+    argParser.add_argument('--repeat', action='store', default=3, type=int, help="Number of measurements, the fastest one is used")
+    argParser.add_argument('--top', action='store', default=10, type=int, help="Show the slowest imports")
+    args = argParser.parse_args()
+
+    total, imports = min((measure(args.module) for i in range(args.repeat)), key=lambda x: x[0])
+
+    print(f"Import of {args.module} took {total:.3f} s (budget {args.budget:.3f} s)")
+    print("Slowest imports:")
+    for t, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"  {t:.3f} s  {name.strip()}")
+
+    failed = False
+    loaded = sorted({name.strip().split('.')[0] for t, name in imports} & set(heavy_modules))
+    if loaded:
+        print(f"FAIL: {args.module} imports {', '.join(loaded)}")
+        failed = True
+    if total > args.budget:
+        print(f"FAIL: import time is over budget")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print("OK")